@@ -4,6 +4,7 @@ import subprocess
 import paramsurvey
 
 import paramsurvey_multimpi.client as client
+import paramsurvey_multimpi.planner as planner
 
 
 # Google cloud HPC checklist https://cloud.google.com/architecture/best-practices-for-using-mpi-on-compute-engine#checklist
@@ -29,19 +30,10 @@ def main():
         }
     paramsurvey.init(**kwargs)
 
-    psets = [
-        {'kind': 'leader', 'ncores': 1, 'run_args': 'mpirun -np {} ./a.out', 'wanted': 3},
-        {'kind': 'follower', 'ncores': 1},
-        {'kind': 'follower', 'ncores': 1},
-    ]
+    jobs = [{'run_args': 'mpirun -np 3 ./a.out', 'wanted': 3}] * 3
 
-    psets = psets * 3
-
-    # this is how ray backend args are specified
-    # XXX shouldn't paramsurvey hide this?
-    for p in psets:
-        if 'ncores' in p:
-            p['ray'] = {'num_cores': p.get('ncores')}
+    # leader and follower psets sized for this cluster's nodes, including the ray resources
+    psets = planner.plan(jobs)
 
     # example of how to return stdout from the cli process
     run_kwargs = {
@@ -51,7 +43,13 @@ def main():
     user_kwargs['run_kwargs'] = run_kwargs
     user_kwargs['mpi'] = 'openmpi'
 
+    # a status line every 10 seconds while the survey runs
+    client.start_progress()
+
+    # persistent followers exit as soon as all of the leaders are done
+    client.start_survey(psets)
     results = paramsurvey.map(client.multimpi_worker, psets, user_kwargs=user_kwargs)
+    client.drain_multimpi_server()
 
     client.end_multimpi_server()
 
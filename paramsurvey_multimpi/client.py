@@ -10,18 +10,46 @@ import tempfile
 from collections import defaultdict
 import shutil
 import shlex
-
-import requests
+import base64
+import hashlib
+import fcntl
+import threading
+import atexit
+import ctypes
+import ctypes.util
+import select
+import json
+import http.client
+import urllib.parse
+import random
 
 import paramsurvey_multimpi
 
 
 url = "http://localhost:8889/jsonrpc"
 timeout = (4, 1)  # connect, read
+backoff_cap = 10.0  # seconds, longest wait between failed checkins
+busy_until = 0.0  # the server said it was busy, and to come back after this time
 sigint_count = 0
 leader_exceptions = []
 follower_exceptions = []
 helper_server_proc = None
+rpc_local = threading.local()  # .conn kept alive between checkins, and .key, the (url, pid) it was made for
+server_ready_timeout = 30.0  # seconds for the server to start listening
+server_socket_dir = None  # holds the server's Unix socket, removed at teardown
+trace_file = None  # driver writes the chrome trace here at end_multimpi_server()
+tracing = False  # workers record spans of their job phases and send them to the server
+trace_spans = []  # [name, start, end]
+trace_mark = None  # (name, start) of the current phase
+progress_thread = None  # driver thread printing the server's stats(), see start_progress()
+progress_stop = threading.Event()
+
+# in-memory index of ~/.ssh/authorized_keys, so repeat deploys do not reread the file
+authorized_keys_index = {'stat': None, 'fingerprints': set()}
+authorized_keys_lock = threading.Lock()  # flock() below protects against other processes
+deployed_fingerprints = set()  # keys this process added, for cleanup_pubkeys()
+dvm = None  # persistent MPI daemons, reused by later jobs on the same hosts
+mounts = {}  # directory: bucket, for gcsfuse mounts made by this process
 
 
 def initial_seq():
@@ -38,40 +66,200 @@ def get_pubkey():
         return f.read()
 
 
+def pubkey_fingerprint(pubkey):
+    # same as the SHA256 fingerprint printed by ssh-keygen -l
+    fields = pubkey.split()
+    for i, field in enumerate(fields[:-1]):
+        # authorized_keys lines might have options before the key type
+        if field.startswith(('ssh-', 'ecdsa-', 'sk-')):
+            try:
+                blob = base64.b64decode(fields[i+1], validate=True)
+            except ValueError:
+                break
+            return 'SHA256:' + base64.b64encode(hashlib.sha256(blob).digest()).decode().rstrip('=')
+    # not an ssh key we understand, fall back to the whole line
+    return 'line:' + hashlib.sha256(pubkey.strip().encode()).hexdigest()
+
+
+def keyfile_stat(keyfile):
+    try:
+        st = os.stat(keyfile)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def index_authorized_keys(f, keyfile):
+    # call with the keyfile flocked
+    fingerprints = set(pubkey_fingerprint(line) for line in f if line.strip())
+    authorized_keys_index['fingerprints'] = fingerprints
+    authorized_keys_index['stat'] = keyfile_stat(keyfile)
+    return fingerprints
+
+
+def pubkey_is_deployed(fingerprint):
+    keyfile = os.path.expanduser('~/.ssh/authorized_keys')
+    with authorized_keys_lock:
+        if authorized_keys_index['stat'] is not None and authorized_keys_index['stat'] == keyfile_stat(keyfile):
+            return fingerprint in authorized_keys_index['fingerprints']
+        if not os.path.exists(keyfile):
+            return False
+        with open(keyfile) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return fingerprint in index_authorized_keys(f, keyfile)
+
+
 def deploy_pubkey(pubkey):
     if pubkey == '':
         # this happens in the CI
         return
 
+    fingerprint = pubkey_fingerprint(pubkey)
     keyfile = os.path.expanduser('~/.ssh/authorized_keys')
-    if os.path.exists(keyfile):
-        with open(keyfile) as f:
-            existing = f.read()
-        if pubkey in existing:
-            return
-
-    keydir = os.path.dirname(keyfile)
-    if not os.path.isdir(keydir):
-        raise FileNotFoundError('~/.ssh does not exist')
 
-    with open(keyfile, 'a') as f:
-        f.write(pubkey)
-    os.chmod(keyfile, 0o600)
+    with authorized_keys_lock:
+        if authorized_keys_index['stat'] is not None and authorized_keys_index['stat'] == keyfile_stat(keyfile):
+            if fingerprint in authorized_keys_index['fingerprints']:
+                return
+
+        keydir = os.path.dirname(keyfile)
+        if not os.path.isdir(keydir):
+            raise FileNotFoundError('~/.ssh does not exist')
+
+        with open(keyfile, 'a') as f:
+            # local followers on this host might be appending at the same time
+            fcntl.flock(f, fcntl.LOCK_EX)
+            with open(keyfile) as existing:
+                fingerprints = index_authorized_keys(existing, keyfile)
+            if fingerprint in fingerprints:
+                return
+            if not pubkey.endswith('\n'):
+                pubkey += '\n'
+            f.write(pubkey)
+            f.flush()
+            os.chmod(keyfile, 0o600)
+            fingerprints.add(fingerprint)
+            authorized_keys_index['stat'] = keyfile_stat(keyfile)
+            deployed_fingerprints.add(fingerprint)
+
+
+def cleanup_pubkeys(keep=()):
+    # remove the keys this process added to authorized_keys, except keep, which other jobs on this host still use
+    deployed_fingerprints.difference_update(keep)
+    if not deployed_fingerprints:
+        return
+    keyfile = os.path.expanduser('~/.ssh/authorized_keys')
+    with authorized_keys_lock:
+        with open(keyfile, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            lines = f.readlines()
+            keep = [line for line in lines if not line.strip() or pubkey_fingerprint(line) not in deployed_fingerprints]
+            f.seek(0)
+            f.writelines(keep)
+            f.truncate()
+            f.flush()
+            f.seek(0)
+            index_authorized_keys(f, keyfile)
+        print('driver: removed {} keys from authorized_keys'.format(len(lines) - len(keep)), file=sys.stderr)
+        deployed_fingerprints.clear()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def unix_url(path):
+    # same convention as requests-unixsocket: the socket path is the quoted netloc
+    return 'http+unix://{}/jsonrpc'.format(urllib.parse.quote(path, safe=''))
+
+
+class ServerBusy(ValueError):
+    pass
 
 
-def leader_checkin(cores, wanted_cores, pubkey, state, lseq):
+def rpc_connection():
+    # one connection per thread, so the driver's progress thread has its own.
+    # Workers forked from the driver inherit its thread's connection but must not share its socket, hence the pid
+    conn = getattr(rpc_local, 'conn', None)
+    if conn is not None:
+        if rpc_local.key == (url, os.getpid()):
+            return conn
+        if rpc_local.key[1] == os.getpid():
+            conn.close()
+    if url.startswith('http+unix://'):
+        netloc, _, path = url[len('http+unix://'):].partition('/')
+        conn = UnixHTTPConnection(urllib.parse.unquote(netloc), timeout=timeout[0])
+    else:
+        parts = urllib.parse.urlsplit(url)
+        conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        conn = conn_class(parts.hostname, parts.port, timeout=timeout[0])
+    rpc_local.conn = conn
+    rpc_local.key = (url, os.getpid())
+    return conn
+
+
+def rpc_post(payload, priority=False):
+    # stdlib http.client instead of requests, which is slow to import in every worker
+    # priority marks checkins from jobs that are scheduled or running, which a busy server still admits
+    global busy_until
+    conn = rpc_connection()
+    path = '/' + url.split('://', 1)[1].partition('/')[2]
+    headers = {'Content-Type': 'application/json'}
+    if priority:
+        headers['X-Multimpi-Priority'] = 'running'
+    try:
+        if conn.sock is None:
+            conn.connect()
+            conn.sock.settimeout(timeout[1])
+        conn.request('POST', path, body=json.dumps(payload), headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+    except Exception:
+        # reconnect next time
+        conn.close()
+        rpc_local.conn = None
+        raise
+    if response.status == 503:
+        busy_until = time.time() + float(response.getheader('Retry-After', 1.0))
+        raise ServerBusy('multimpi server is busy')
+    if response.status != 200:
+        raise ValueError('multimpi server returned http status {}'.format(response.status))
+    return json.loads(body)
+
+
+def checkin_delay(exceptions, base):
+    # jittered, and exponential after failed checkins, so that thousands of workers do not retry in lockstep
+    delay = base
+    if exceptions:
+        delay = min(backoff_cap, base * 2 ** min(len(exceptions), 10))
+    delay = max(delay, busy_until - time.time())
+    return delay * random.uniform(0.5, 1.5)
+
+
+def leader_checkin(cores, wanted_cores, pubkey, state, lseq, status=None, job=None, priority=False):
     pid = os.getpid()
     ip = socket.gethostname()
     payload = {
         'method': 'leader_checkin',
-        'params': [ip, cores, pid, wanted_cores, pubkey, state, lseq],
+        'params': [ip, cores, pid, wanted_cores, pubkey, state, lseq, status, job],
         'jsonrpc': '2.0',
         'id': 0,
     }
 
     try:
-        response = requests.post(url, json=payload, timeout=timeout).json()
+        response = rpc_post(payload, priority=priority or state != 'waiting')
+        leader_exceptions.clear()
+    except ServerBusy:
+        # the server is up, just busy: not a failure, see checkin_delay()
         leader_exceptions.clear()
+        response = {'result': None}
     except Exception as e:
         leader_exceptions.append(str(e))
         if len(leader_exceptions) > 100:
@@ -80,19 +268,23 @@ def leader_checkin(cores, wanted_cores, pubkey, state, lseq):
     return response
 
 
-def follower_checkin(cores, state, fseq):
+def follower_checkin(cores, state, fseq, info=None):
     pid = os.getpid()
     ip = socket.gethostname()
     payload = {
         'method': 'follower_checkin',
-        'params': [ip, cores, pid, state, fseq],
+        'params': [ip, cores, pid, state, fseq, info],
         'jsonrpc': '2.0',
         'id': 0,
     }
 
     try:
-        response = requests.post(url, json=payload, timeout=timeout).json()
+        response = rpc_post(payload, priority=state != 'available')
+        follower_exceptions.clear()
+    except ServerBusy:
+        # the server is up, just busy: not a failure, see checkin_delay()
         follower_exceptions.clear()
+        response = {'result': None}
     except Exception as e:
         follower_exceptions.append(str(e))
         if len(follower_exceptions) > 100:
@@ -109,7 +301,7 @@ def hello_world():
         'id': 0,
     }
     try:
-        response = requests.post(url, json=payload, timeout=timeout).json()
+        response = rpc_post(payload)
         #print(response, file=sys.stderr)
         assert response['result']['hello'] == 'world!'
     except Exception as e:
@@ -117,21 +309,350 @@ def hello_world():
     return 'pass'
 
 
+def drain_multimpi_server():
+    payload = {
+        'method': 'drain',
+        'params': [],
+        'jsonrpc': '2.0',
+        'id': 0,
+    }
+    return rpc_post(payload)
+
+
+def start_survey(psets):
+    '''Tell the server a survey of these psets is starting, so its persistent followers exit once every leader is done.'''
+    leaders = sum(1 for p in psets if p.get('kind') == 'leader')
+    return rpc_call('start_survey', [leaders])
+
+
+def rpc_call(method, params):
+    payload = {
+        'method': method,
+        'params': params,
+        'jsonrpc': '2.0',
+        'id': 0,
+    }
+    return rpc_post(payload)
+
+
+def trace_phase(name):
+    # ends the current phase of this worker's job and starts the next one. None just ends it
+    global trace_mark
+    if not tracing:
+        return
+    now = time.time()
+    if trace_mark is not None:
+        trace_spans.append([trace_mark[0], trace_mark[1], now])
+    trace_mark = (name, now) if name else None
+
+
+def send_trace(kind):
+    trace_phase(None)
+    if not tracing or not trace_spans:
+        return
+    try:
+        rpc_call('add_trace', [socket.gethostname(), os.getpid(), kind, trace_spans])
+    except Exception as e:
+        print('driver: {} {} could not send its trace: {}'.format(kind, os.getpid(), e), file=sys.stderr)
+    trace_spans.clear()
+
+
+def write_trace(path):
+    # merges the server's view with the spans that workers sent it
+    trace = rpc_call('trace', [])['result']
+    with open(path, 'w') as f:
+        json.dump(trace, f)
+    print('driver: wrote {} trace events to {}'.format(len(trace['traceEvents']), path), file=sys.stderr)
+
+
+def format_progress(stats):
+    jobs = stats['jobs']
+    wait = stats['queue_wait']
+    line = 'driver: jobs running {} waiting {} finished {} (failed {}, retried {}) | cores busy {} idle {} | queue wait'.format(
+        jobs.get('running', 0) + jobs.get('scheduled', 0), jobs.get('waiting', 0), stats['jobs_finished'],
+        stats['jobs_failed'], stats['jobs_retried'], stats['cores']['busy'], stats['cores']['idle'])
+    if wait['n']:
+        line += ' p50 {}s p90 {}s'.format(wait['p50'], wait['p90'])
+    else:
+        line += ' n/a'
+    line += ' | failures {}'.format(stats['failures'])
+    if stats['recent_failures']:
+        line += ', last: ' + stats['recent_failures'][-1]
+    return line
+
+
+def progress_loop(interval, snapshot_file):
+    while not progress_stop.wait(interval):
+        try:
+            stats = rpc_call('stats', [])['result']
+        except Exception as e:
+            print('driver: progress could not get server stats:', repr(e), file=sys.stderr)
+            continue
+        print(format_progress(stats), file=sys.stderr)
+        sys.stderr.flush()
+        if snapshot_file:
+            # write to a temporary name so that readers never see a partial file
+            tmp = snapshot_file + '.partial'
+            with open(tmp, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp, snapshot_file)
+
+
+def start_progress(interval=10.0, snapshot_file=None):
+    '''Print a status line of the survey every interval seconds while paramsurvey.map() runs.
+
+    With snapshot_file, the server's full stats() are also written there as json each time.'''
+    global progress_thread
+    if progress_thread is not None:
+        raise ValueError('progress is already running')
+    progress_stop.clear()
+    progress_thread = threading.Thread(target=progress_loop, args=(interval, snapshot_file),
+                                       name='multimpi_progress', daemon=True)
+    progress_thread.start()
+
+
+def stop_progress():
+    global progress_thread
+    if progress_thread is None:
+        return
+    progress_stop.set()
+    progress_thread.join()
+    progress_thread = None
+
+
 def unkey(key):
     return key.rsplit('_', 1)
 
 
+def parse_cpulist(cpulist):
+    # sysfs format, e.g. 0-3,8-11
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.extend(range(int(lo), int(hi)+1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def read_sysfs(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def get_topology():
+    # cpus we are allowed to use, grouped by numa node, with socket:core names for rankfiles
+    try:
+        affinity = set(os.sched_getaffinity(0))
+    except AttributeError:
+        affinity = set(range(os.cpu_count()))
+
+    numa = []
+    nodedir = '/sys/devices/system/node'
+    nodes = [n for n in os.listdir(nodedir) if n.startswith('node') and n[4:].isdigit()] if os.path.isdir(nodedir) else []
+    for node in sorted(nodes, key=lambda n: int(n[4:])):
+        cpus = [c for c in parse_cpulist(read_sysfs(os.path.join(nodedir, node, 'cpulist'), '')) if c in affinity]
+        if cpus:
+            numa.append(cpus)
+    if not numa:
+        numa = [sorted(affinity)]
+
+    # openmpi rankfiles want socket:core, with core numbered within the socket
+    cpu_ids = {}
+    for cpu in affinity:
+        topo = '/sys/devices/system/cpu/cpu{}/topology/'.format(cpu)
+        socket_id = int(read_sysfs(topo + 'physical_package_id', 0))
+        core_id = int(read_sysfs(topo + 'core_id', cpu))
+        cpu_ids[cpu] = (socket_id, core_id)
+    core_index = {}
+    for socket_id in set(s for s, _ in cpu_ids.values()):
+        core_ids = sorted(set(c for s, c in cpu_ids.values() if s == socket_id))
+        core_index.update({(socket_id, c): i for i, c in enumerate(core_ids)})
+
+    slots = {}
+    for cpu, (socket_id, core_id) in cpu_ids.items():
+        slots[str(cpu)] = '{}:{}'.format(socket_id, core_index[(socket_id, core_id)])
+
+    topology = {'numa': numa, 'slots': slots}
+    # the server hands out these to slices of shared followers, so jobs on one host never share a cpu
+    topology['cpus'] = topology_cpus(topology)
+    return topology
+
+
+def get_resources(pset, user_kwargs):
+    # what a follower offers besides cores, for jobs with requires in their pset
+    memory = pset.get('memory')
+    if memory is None:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    scratch_dir = pset.get('scratch_dir') or user_kwargs.get('scratch_dir') or tempfile.gettempdir()
+    scratch = shutil.disk_usage(scratch_dir).free if os.path.isdir(scratch_dir) else 0
+    return {'memory': memory, 'scratch': scratch, 'labels': list(pset.get('labels', []))}
+
+
+def topology_cpus(topology):
+    # logical cpus, the same unit as a worker's ncores: one per physical core numa node by numa node,
+    # then the other hwthreads of those cores
+    first = []
+    rest = []
+    seen = set()
+    for cpus in topology['numa']:
+        for cpu in cpus:
+            slot = topology['slots'][str(cpu)]
+            (rest if slot in seen else first).append(str(cpu))
+            seen.add(slot)
+    return first + rest
+
+
+def rankfile_openmpi(ret, leader_topology):
+    # openmpi: rank 0=host1 slot=0:0
+    # each process's ranks go on the logical cpus in its own affinity mask, as reported in its topology,
+    # one rank per physical core before doubling up on hwthreads. Processes on the same host never
+    # share a cpu, even if their masks overlap
+    procs = [(socket.gethostname(), ret['lcores'], leader_topology, None)]
+    for f in ret['followers']:
+        # a slice of a shared follower must use the cores the server gave it, other leaders have the rest
+        procs.append((unkey(f['fkey'])[0], f['cores'], f.get('topology'), f.get('slots')))
+
+    rankfile = ''
+    rank = 0
+    used = defaultdict(set)  # cpus
+    for host in unique_resources(ret):
+        for phost, cores, topology, given in procs:
+            if phost != host or not cores:
+                continue
+            if topology is None:
+                raise ValueError('no topology reported for host {}, cannot write a rankfile'.format(host))
+            cpus = topology_cpus(topology)
+            if given is not None:
+                cpus = [cpu for cpu in given if cpu in topology['slots']]
+            cpus = [cpu for cpu in cpus if cpu not in used[host]]
+            if len(cpus) < cores:
+                raise ValueError('host {} has {} free cpus but {} slots were requested'.format(host, len(cpus), cores))
+            for cpu in cpus[:cores]:
+                used[host].add(cpu)
+                rankfile += 'rank {}={} slot={}\n'.format(rank, host, topology['slots'][cpu])
+                rank += 1
+    return rankfile
+
+
 def unique_resources(ret):
     sums = defaultdict(int)
     sums[socket.gethostname()] += ret['lcores']
     for f in ret['followers']:
-        follower = unkey(f['fkey'])[0]
-        cores = f['cores']
-        sums[follower] += cores
+        sums[f['fkey'].rsplit('_', 1)[0]] += f['cores']
     return sums
 
 
-def machinefile_openmp_DiFX(user_kwargs, sums):
+def spread_rounds(nhosts, count):
+    # a spread role gets at most this many ranks per host. This is the same limit
+    # the original DiFX code had: it cycled over a node list that was doubled until
+    # it was at least count long, and then doubled once more.
+    rounds = 1
+    while rounds * nhosts < count:
+        rounds *= 2
+    return rounds * 2
+
+
+def layout_ranks(roles, sums):
+    # returns a list of (host, role name, threads), one per rank, in rank order
+    #
+    # each role is a dict:
+    #   name: used in error messages
+    #   count: number of ranks, or 'rest' for one rank per host that still has free cores
+    #   threads: cores per rank, default 1. With count 'rest' it can also be 'rest',
+    #            meaning all of the remaining cores on that host
+    #   on: 'leader' puts every rank of this role on the leader's host
+    #   spread: True deals ranks round-robin over hosts (anti-affinity), else they are packed
+    #   threadfile: True lists the threads of each rank of this role in the threads file
+
+    leader = socket.gethostname()  # can't use localhost, openmpi will turn that into this hostname
+    hosts = list(sums.keys())
+    counts = [sums[h] for h in hosts]
+    if leader not in sums:
+        hosts.append(leader)
+        counts.append(0)
+    leader_index = hosts.index(leader)
+
+    ranks = []
+    for role in roles:
+        name = role.get('name', 'rank')
+        count = role['count']
+        threads = role.get('threads', 1)
+
+        if role.get('on') == 'leader':
+            for _ in range(count):
+                ranks.append((leader, name, threads))
+            counts[leader_index] -= count * threads
+        elif count == 'rest':
+            for i, c in enumerate(counts):
+                if c <= 0:
+                    continue
+                if threads == 'rest':
+                    ranks.append((hosts[i], name, c))
+                    counts[i] = 0
+                else:
+                    for _ in range(c // threads):
+                        ranks.append((hosts[i], name, threads))
+                    counts[i] -= (c // threads) * threads
+        elif role.get('spread'):
+            active = [i for i, c in enumerate(counts) if c >= threads]
+            placed = 0
+            for _ in range(spread_rounds(len(hosts), count)):
+                if placed == count or not active:
+                    break
+                still_active = []
+                for i in active:
+                    if placed == count:
+                        break
+                    ranks.append((hosts[i], name, threads))
+                    counts[i] -= threads
+                    placed += 1
+                    if counts[i] >= threads:
+                        still_active.append(i)
+                active = still_active
+            if placed < count:
+                raise ValueError('too few cores to configure {} ranks of role {}'.format(count, name))
+        else:
+            placed = 0
+            for i, c in enumerate(counts):
+                while placed < count and counts[i] >= threads:
+                    ranks.append((hosts[i], name, threads))
+                    counts[i] -= threads
+                    placed += 1
+            if placed < count:
+                raise ValueError('too few cores to configure {} ranks of role {}'.format(count, name))
+
+    return ranks
+
+
+def layout_machinefile(layout, sums):
+    # machinefile with one bare hostname per rank, which both openmpi and hydra accept,
+    # and a threads file with the threads of the ranks whose role asks for it
+    ranks = layout_ranks(layout['roles'], sums)
+    threadfile_roles = set(r.get('name', 'rank') for r in layout['roles'] if r.get('threadfile'))
+
+    machinefile = ''.join(host + '\n' for host, _, _ in ranks)
+    threadfile = ''.join(str(threads) + '\n' for _, name, threads in ranks if name in threadfile_roles)
+    return machinefile, threadfile
+
+
+def layout_wanted_cores(layout):
+    # total cores, if the layout does not depend on what the scheduler finds
+    total = 0
+    for role in layout['roles']:
+        if role['count'] == 'rest' or role.get('threads', 1) == 'rest':
+            return None
+        total += role['count'] * role.get('threads', 1)
+    return total
+
+
+def layout_DiFX(user_kwargs):
     # DiFX is a little unique:
     # Rank 0 is the manager
     # Ranks 1-N are the N datastreams.
@@ -140,90 +661,171 @@ def machinefile_openmp_DiFX(user_kwargs, sums):
     # The number of threads for Core objects is recorded in the threads file
 
     # openmpi does not allow repeats in the machinefile, so we do not use slots= syntax
+    difx_job = user_kwargs.get('DiFX_jobname')
+    return {
+        'roles': [
+            {'name': 'manager', 'count': 1, 'on': 'leader'},
+            {'name': 'datastream', 'count': user_kwargs['DiFX_datastreams'], 'spread': True},
+            {'name': 'core', 'count': 'rest', 'threads': 'rest', 'threadfile': True},
+        ],
+        'machines': difx_job + '.machines' if difx_job else None,
+        'threads': difx_job + '.threads' if difx_job else None,
+    }
 
-    machinefile = ''
 
-    leader = socket.gethostname()  # can't use localhost, openmpi will turn that into this hostname
-    machinefile += leader + '\n'
-    sums[leader] -= 1
-    print('GREG: leader:', leader)
-
-    datastreams = user_kwargs['DiFX_datastreams']
-
-    nodelist = list(sums.keys())
-    while len(nodelist) < datastreams:
-        # more datastreams than nodes, lengthen the list
-        nodelist += nodelist
-    nodelist += nodelist  # add extra in case some nodes have all cores used
-    print('GREG using nodelist', nodelist)
-
-    # allocate datastreams, iterating over eligible nodes
-    ds_count = 0
-    while ds_count < datastreams:
-        try:
-            ds = nodelist.pop(0)
-        except IndexError:
-            raise ValueError('too few cores to configure datastreams')
-        if sums[ds] > 0:
-            print('GREG: datastream:', ds)
-            machinefile += ds + '\n'
-            sums[ds] -= 1
-            ds_count += 1
-
-    # allocate compute nodes, running one MPI process per node
-    threadfile = ''
-    for f in sums:
-        if sums[f] > 0:
-            machinefile += f + '\n'
-            threadfile += str(sums[f]) + '\n'
-            print('GREG: Core:', f, 'with threads', sums[f])
+layouts = {
+    'DiFX': layout_DiFX,
+}
+
+
+def get_layout(user_kwargs):
+    # user_kwargs['layout'] is a layout dict or the name of one in layouts
+    layout = user_kwargs.get('layout')
+    if layout is None and user_kwargs.get('machinefile') == 'DiFX':
+        layout = 'DiFX'  # older spelling
+    if isinstance(layout, str):
+        if layout not in layouts:
+            raise ValueError('unknown layout {}, options are: {}'.format(layout, list(layouts.keys())))
+        layout = layouts[layout](user_kwargs)
+    return layout
+
+
+def machinefile_layout(layout, sums):
+    # writes the files named in the layout. If it names a machines file,
+    # returns '' because the command line does not use %MACHINEFILE%
+    machinefile, threadfile = layout_machinefile(layout, sums)
+
+    if layout.get('threads'):
+        with open(layout['threads'], 'w') as tf:
+            tf.write(threadfile)
+
+    if layout.get('machines'):
+        with open(layout['machines'], 'w') as mf:
+            mf.write(machinefile)
+        return ''
+    return machinefile
 
-    return machinefile, threadfile
+
+def machinefile_openmp_DiFX(user_kwargs, sums):
+    return layout_machinefile(layout_DiFX(user_kwargs), sums)
 
 
 def machinefile_openmp_DiFX_file(user_kwargs, sums):
-    machinefile, threadfile = machinefile_openmp_DiFX(user_kwargs, sums)
-    difx_job = user_kwargs['DiFX_jobname']
+    return machinefile_layout(layout_DiFX(user_kwargs), sums)
+
+
+def placement_by_slot(sums):
+    # each host once with all of its cores, so consecutive ranks share a host
+    return [(host, sums[host]) for host in sums]
+
+
+def placement_by_node(sums):
+    # one slot per host per round, so consecutive ranks are on different hosts
+    entries = []
+    remaining = dict(sums)
+    while remaining:
+        for host in list(remaining):
+            entries.append((host, 1))
+            remaining[host] -= 1
+            if remaining[host] <= 0:
+                del remaining[host]
+    return entries
+
+
+placements = {
+    'by-slot': placement_by_slot,
+    'by-node': placement_by_node,
+    'numa': placement_by_slot,  # filled in slot order, the binding comes from placement_mpirun_args
+}
+
+# openmpi merges repeated hostfile entries, so it needs to be told how to map
+placement_mpirun_args = {
+    ('openmpi', 'by-node'): ['--map-by', 'node'],
+    ('openmpi', 'numa'): ['--map-by', 'numa', '--bind-to', 'core'],
+    ('mpich', 'numa'): ['-bind-to', 'numa'],
+    ('intelmpi', 'numa'): ['-bind-to', 'numa'],
+}
+
+# slices of shared followers without a rankfile, which would otherwise all be bound from core 0 up
+unbound_mpirun_args = {
+    'openmpi': ['--bind-to', 'none'],
+    'mpich': ['-bind-to', 'none'],
+    'intelmpi': ['-genv', 'I_MPI_PIN', 'off'],
+}
+
+
+def without_binding(args):
+    ret = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in {'--bind-to', '-bind-to'}:
+            skip = True
+        else:
+            ret.append(arg)
+    return ret
 
-    with open(difx_job + '.machines', 'w') as mf:
-        mf.write(machinefile)
-        mf.close()
 
-    with open(difx_job + '.threads', 'w') as tf:
-        tf.write(threadfile)
-        tf.close()
+def machinefile_lines(ret, wanted, user_kwargs, line_format):
+    sums = unique_resources(ret)
+    if sum(sums.values()) < wanted:
+        raise ValueError('too few cores')
 
-    return ''
+    placement = user_kwargs.get('placement', 'by-slot')
+    if placement not in placements:
+        raise ValueError('unknown placement {}, options are: {}'.format(placement, list(placements.keys())))
+    return ''.join(line_format.format(host, slots) for host, slots in placements[placement](sums))
 
 
 def machinefile_openmpi(pset, ret, wanted, user_kwargs):
     # openmpi: host1 slots=2
 
-    machinefile = ''
-    sums = unique_resources(ret)
+    layout = get_layout(user_kwargs)
+    if layout:
+        return machinefile_layout(layout, unique_resources(ret))
 
-    if user_kwargs.get('machinefile') == 'DiFX':
-        return machinefile_openmp_DiFX_file(user_kwargs, sums)
+    return machinefile_lines(ret, wanted, user_kwargs, '{} slots={}\n')
 
-    for f in sums:
-        wanted -= sums[f]
-        machinefile += '{} slots={}\n'.format(f, sums[f])
 
-    if wanted > 0:
-        raise ValueError('too few cores')
+def machinefile_mpich(pset, ret, wanted, user_kwargs):
+    # mpich and intel mpi (both use hydra): host1:2
 
-    return machinefile
+    layout = get_layout(user_kwargs)
+    if layout:
+        # bare hostnames mean one slot each in hydra, too
+        return machinefile_layout(layout, unique_resources(ret))
 
+    return machinefile_lines(ret, wanted, user_kwargs, '{}:{}\n')
+
+
+machinefile_backends = {
+    'openmpi': machinefile_openmpi,
+    'mpich': machinefile_mpich,
+    'intelmpi': machinefile_mpich,
+}
 
-def machinefile_mpich(pset, ret, wanted, user_kwargs):
-    # mpich: host1:2
-    pass
+
+def register_machinefile_backend(mpi, func, placement_args=None):
+    # func(pset, ret, wanted, user_kwargs) returns the machinefile contents
+    # placement_args maps a placement name to extra mpirun args for this mpi
+    machinefile_backends[mpi] = func
+    for placement, args in (placement_args or {}).items():
+        placement_mpirun_args[(mpi, placement)] = args
 
 
 def do_google_mount(bucket, directory):
+    if mounts.get(directory) == bucket and os.path.ismount(directory):
+        # mounted by an earlier job in this process
+        return
+
     os.makedirs(directory, exist_ok=True)
     if not os.path.isdir(directory):
         raise ValueError('mount point '+directory+' is not a directory')
+    if os.path.ismount(directory):
+        # another worker on this host mounted it, and it stays mounted for later jobs
+        mounts[directory] = bucket
+        return
     # todo: mountpoint is empty?
 
     exe = shutil.which('gcsfuse')
@@ -231,22 +833,126 @@ def do_google_mount(bucket, directory):
         raise ValueError('cannot find gcsfuse comand in the PATH')
 
     try:
-        ret = subprocess.call('gcsfuse --implicit-dirs {} {}'.format(bucket, directory))
+        ret = subprocess.call([exe, '--implicit-dirs', bucket, directory])
         if ret < 0:
-            raise ValueError('gcsfuse terminated by signal '+int(-ret))
+            raise ValueError('gcsfuse terminated by signal '+str(-ret))
         elif ret > 0:
-            raise ValueError('gcsfuse returned '+int(ret))
+            raise ValueError('gcsfuse returned '+str(ret))
     except OSError as e:
-        raise ValueError('gcsfuse failed: '+e)
+        raise ValueError('gcsfuse failed: '+str(e))
+    mounts[directory] = bucket
 
 
-def leader_start_mpi(pset, ret, wanted, user_kwargs):
-    if user_kwargs['mpi'] == 'openmpi':
-        machinefile = machinefile_openmpi(pset, ret, wanted, user_kwargs)
-    elif user_kwargs['mpi'] == 'mpich':
-        machinefile = machinefile_mpich(pset, ret, wanted, user_kwargs)
-    else:
-        raise ValueError('unknown mpi implementation: '+user_kwargs['mpi'])
+def local_datasets():
+    # dataset names this host has warm, reported to the server for scheduling
+    return sorted(set(bucket for directory, bucket in mounts.items() if os.path.ismount(directory)))
+
+
+def stage_spec(pset, user_kwargs):
+    # inputs copied to a local cache on every node of the job, see staging.stage()
+    inputs = pset.get('stage_inputs') or user_kwargs.get('stage_inputs')
+    if not inputs:
+        return
+    return {'inputs': list(inputs),
+            'staging_dir': user_kwargs.get('staging_dir'),
+            'max_bytes': user_kwargs.get('staging_max_bytes')}
+
+
+def stage_inputs(spec, mounts=()):
+    # after the mounts, because inputs are often in the bucket
+    for bucket, directory in mounts:
+        do_google_mount(bucket, directory)
+    if spec:
+        from . import staging  # imported when needed, to keep worker startup fast
+        return staging.stage(**spec)
+
+
+def release_staged(stagedir=None):
+    # the staging cache can remove this worker's staged directories once its job is done
+    if 'paramsurvey_multimpi.staging' in sys.modules:
+        sys.modules['paramsurvey_multimpi.staging'].release(stagedir)
+
+
+def release_finished(staged, jobs):
+    # staged is leader key -> staged directory, released once the leader's job is no longer in jobs
+    for lkey in list(staged):
+        if lkey not in jobs:
+            stagedir = staged.pop(lkey)
+            if stagedir not in staged.values():
+                release_staged(stagedir)
+
+
+def in_background(func, *args):
+    # mounts and staging can take minutes, and the server times out workers that stop checking in
+    result = {}
+
+    def run():
+        try:
+            result['value'] = func(*args)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, name='multimpi_prepare', daemon=True)
+    thread.start()
+    return thread, result
+
+
+def background_done(background):
+    # True once it has finished, raising its exception if it failed
+    thread, result = background
+    if thread.is_alive():
+        return False
+    if 'error' in result:
+        raise result['error']
+    return True
+
+
+def upload_outputs(pset, user_kwargs):
+    # followers are already released. Returns the upload status for the leader's result
+    outputs = pset.get('upload_outputs') or user_kwargs.get('upload_outputs')
+    if not outputs:
+        return
+    dest = pset.get('upload_dest') or user_kwargs.get('upload_dest')
+    if not dest:
+        raise ValueError('upload_outputs needs an upload_dest directory')
+    from . import upload  # imported when needed, to keep worker startup fast
+    future = upload.upload(outputs, dest, part_size=user_kwargs.get('upload_part_size'),
+                           workers=user_kwargs.get('upload_workers'))
+    if not user_kwargs.get('upload_wait', True):
+        # the upload continues while this worker moves on, and failures are only printed
+        return {'state': 'pending'}
+    # by default the result is not returned until its outputs are safely uploaded
+    try:
+        return {'state': 'done', 'files': future.result()}
+    except Exception as e:
+        print('driver: leader {} upload failed: {}'.format(os.getpid(), repr(e)), file=sys.stderr)
+        return {'state': 'failed', 'error': repr(e)}
+
+
+def schedule_key(ret):
+    return ret['lcores'], tuple((f['fkey'], f['cores']) for f in ret['followers'])
+
+
+def insert_mpirun_args(cmd, args):
+    return cmd[:1] + list(args) + cmd[1:]
+
+
+def leader_prepare_mpi(pset, ret, wanted, user_kwargs, prepared=None, staged=None):
+    # does everything needed before mpirun, while followers are still being assigned
+    # returns the previous preparation if the schedule has not changed since then
+    # staged is the directory of inputs if the caller already staged them
+    key = (schedule_key(ret), pset['run_args'])
+    if prepared is not None and prepared['key'] == key:
+        return prepared
+
+    mpi = user_kwargs['mpi']
+    if mpi not in machinefile_backends:
+        raise ValueError('unknown mpi implementation: '+mpi)
+    machinefile = machinefile_backends[mpi](pset, ret, wanted, user_kwargs)
+
+    if prepared is not None and prepared['mfname']:
+        # the schedule changed, so the old machinefile is stale
+        os.unlink(prepared['mfname'])
 
     if machinefile:
         # empty machinefile means the above code already wrote out the machinefile
@@ -257,43 +963,280 @@ def leader_start_mpi(pset, ret, wanted, user_kwargs):
     else:
         mfname = None
 
-    if 'mount_google_bucket' in user_kwargs:
-        # this mount needs to be done on datastream nodes (or just all of them)
-        # so far this is just the leader
-        # so far this doesn't do an unmount
-        # to mount on non-leader nodes paramsurvey needs a tweak
+    mounted = prepared is not None and prepared['mounted']
+    if 'mount_google_bucket' in user_kwargs and not mounted:
+        # followers mount it too, see leader_job(). Mounts stay up for later jobs
         do_google_mount(*user_kwargs['mount_google_bucket'])
-
-    cmd = pset['run_args'].replace('%MACHINEFILE%', mfname)
+        mounted = True
+
+    if staged is None and prepared is not None:
+        staged = prepared['staged']
+    spec = stage_spec(pset, user_kwargs)
+    if spec and staged is None:
+        staged = stage_inputs(spec)
+
+    if 'leader_prepare' in user_kwargs:
+        # user hook for staging inputs etc. Called again if the schedule changes.
+        user_kwargs['leader_prepare'](pset, ret, user_kwargs)
+
+    rfname = None
+    if prepared is not None and prepared['rfname']:
+        os.unlink(prepared['rfname'])
+    if user_kwargs.get('rankfile'):
+        if mpi != 'openmpi':
+            raise ValueError('rankfiles are only supported for openmpi')
+        rf = tempfile.NamedTemporaryFile(prefix='rankfile_', delete=False, mode='w')
+        rf.write(rankfile_openmpi(ret, get_topology()))
+        rf.close()
+        rfname = rf.name
+
+    cmd = pset['run_args']
+    insert_rankfile = rfname is not None and '%RANKFILE%' not in cmd
+    if mfname is not None:
+        cmd = cmd.replace('%MACHINEFILE%', mfname)
+    if rfname is not None:
+        cmd = cmd.replace('%RANKFILE%', rfname)
+    if staged is not None:
+        cmd = cmd.replace('%STAGED%', staged)
+    cmd = cmd.replace('%NP%', str(wanted))
     cmd = shlex.split(cmd)
+    if insert_rankfile:
+        cmd = insert_mpirun_args(cmd, ['--rankfile', rfname])
+    placement_args = placement_mpirun_args.get((mpi, user_kwargs.get('placement', 'by-slot'))) or []
+    if rfname is None and any('slots' in f for f in ret['followers']):
+        placement_args = without_binding(placement_args) + unbound_mpirun_args.get(mpi, [])
+    if placement_args and os.path.basename(cmd[0]) in {'mpirun', 'mpiexec'}:
+        cmd = insert_mpirun_args(cmd, placement_args)
+
+    return {'key': key, 'cmd': cmd, 'mfname': mfname, 'rfname': rfname, 'mounted': mounted,
+            'staged': staged}
+
+
+def dvm_flavor():
+    # returns the daemon executable and the mpirun flag that submits to it
+    if shutil.which('prte'):
+        return 'prte', '--dvm'  # openmpi 5
+    if shutil.which('orte-dvm'):
+        return 'orte-dvm', '--hnp'  # openmpi 4
+    raise ValueError('dvm mode needs prte (openmpi 5) or orte-dvm (openmpi 4) in the PATH')
+
+
+def set_pdeathsig():
+    # if this worker dies, take the dvm with it
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    PR_SET_PDEATHSIG = 1
+    if libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM) != 0:
+        raise OSError(ctypes.get_errno(), 'PR_SET_PDEATHSIG')
+
+
+def start_dvm(sums, timeout=30.0):
+    exe, flag = dvm_flavor()
+
+    hf = tempfile.NamedTemporaryFile(prefix='dvm_hostfile_', delete=False, mode='w')
+    for host in sorted(sums):
+        hf.write('{} slots={}\n'.format(host, sums[host]))
+    hf.close()
+    uf = tempfile.NamedTemporaryFile(prefix='dvm_uri_', delete=False)
+    uf.close()
+
+    proc = subprocess.Popen([exe, '--report-uri', uf.name, '--hostfile', hf.name], preexec_fn=set_pdeathsig)
+    d = {'sums': tuple(sorted(sums.items())), 'proc': proc, 'uri': uf.name, 'hostfile': hf.name, 'flag': flag}
+
+    t0 = time.time()
+    while os.path.getsize(uf.name) == 0:
+        status = proc.poll()
+        if status is not None:
+            remove_dvm_files(d)
+            raise ValueError('{} exited with status {} before reporting its uri'.format(exe, status))
+        if time.time() - t0 > timeout:
+            proc.kill()
+            remove_dvm_files(d)
+            raise ValueError('{} did not report its uri within {} seconds'.format(exe, timeout))
+        time.sleep(0.1)
+    print('driver: leader {} started {} on {} hosts'.format(os.getpid(), exe, len(sums)), file=sys.stderr)
+    return d
+
+
+def remove_dvm_files(d):
+    for name in (d['uri'], d['hostfile']):
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+
+def stop_dvm():
+    global dvm
+    if dvm is None:
+        return
+    proc = dvm['proc']
+    if proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10.0)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    remove_dvm_files(dvm)
+    dvm = None
+
+
+def get_dvm(sums):
+    global dvm
+    if dvm is not None:
+        if dvm['sums'] != tuple(sorted(sums.items())) or dvm['proc'].poll() is not None:
+            stop_dvm()
+    if dvm is None:
+        dvm = start_dvm(sums)
+        atexit.unregister(stop_dvm)  # only register once
+        atexit.register(stop_dvm)
+    return dvm
+
+
+def dvm_cmd(cmd, d):
+    # keeps run_args as-is, only pointing mpirun at the running daemons
+    if os.path.basename(cmd[0]) not in {'mpirun', 'mpiexec'}:
+        raise ValueError('dvm mode needs run_args starting with mpirun, saw '+cmd[0])
+    return insert_mpirun_args(cmd, [d['flag'], 'file:' + d['uri']])
+
+
+def leader_start_mpi(pset, ret, wanted, user_kwargs, prepared=None):
+    prepared = leader_prepare_mpi(pset, ret, wanted, user_kwargs, prepared=prepared)
+    cmd = prepared['cmd']
+
+    if user_kwargs.get('dvm'):
+        if user_kwargs['mpi'] != 'openmpi':
+            raise ValueError('dvm mode is only supported for openmpi')
+        # started here and not in leader_prepare_mpi because followers
+        # might not have deployed our pubkey until they are running
+        cmd = dvm_cmd(cmd, get_dvm(unique_resources(ret)))
 
     run_kwargs = pset.get('run_kwargs') or user_kwargs.get('run_kwargs') or {}
     mpi_proc = run_mpi(cmd, **run_kwargs)
     return mpi_proc
 
 
-def leader(pset, system_kwargs, user_kwargs):
-    #print('I am leader and my pid is {}'.format(os.getpid()))
-    pubkey = get_pubkey()
+def wanted_cores(pset, user_kwargs):
+    if 'min_cores' in pset:
+        return pset['min_cores']
+    if 'wanted' in pset:
+        return pset['wanted']
+    layout = get_layout(user_kwargs)
+    wanted = layout_wanted_cores(layout) if layout else None
+    if wanted is None:
+        raise ValueError('leader pset needs wanted, or a layout with a fixed number of cores')
+    return wanted
+
+
+def job_cores(ret, wanted, job):
+    # elastic jobs run on however many cores they were given
+    if not job.get('max_cores'):
+        return wanted
+    return ret['lcores'] + sum(f['cores'] for f in ret['followers'])
+
+
+def ready_followers(ret):
+    # followers added to a running malleable job join at its next phase, once they are running
+    return dict(ret, followers=[f for f in ret['followers'] if f.get('state', 'running') == 'running'])
+
+
+def leader_job(pset, user_kwargs, pubkey):
+    # describes this job to the server, beyond the basic leader_checkin arguments
+    job = {}
+    if pubkey:
+        job['fingerprint'] = pubkey_fingerprint(pubkey)
+    if pset.get('requires'):
+        # memory, scratch, labels, min_nodes, max_nodes -- see server.find_followers()
+        job['requires'] = pset['requires']
+    datasets = pset.get('datasets') or user_kwargs.get('datasets') or []
+    if 'mount_google_bucket' in user_kwargs:
+        job['mounts'] = [user_kwargs['mount_google_bucket']]
+        bucket = user_kwargs['mount_google_bucket'][0]
+        if bucket not in datasets:
+            datasets = list(datasets) + [bucket]
+    if datasets:
+        # the server prefers followers on hosts that already have these
+        job['datasets'] = list(datasets)
+    spec = stage_spec(pset, user_kwargs)
+    if spec:
+        job['stage'] = spec
+    # the server keeps runtimes of jobs like this one, see history.py
+    job['run_args'] = ' ; '.join(pset.get('phases') or [pset['run_args']])
+    if pset.get('max_cores'):
+        # elastic: start with wanted (or min_cores) and take up to max_cores
+        job['max_cores'] = pset['max_cores']
+        if len(pset.get('phases') or []) > 1:
+            # the server can add followers while it runs, used from the next phase
+            job['malleable'] = True
+    return job
+
+
+def leader_exit_checkin(ncores, wanted, pubkey, lseq, status, job):
+    # tell the server first, so it frees our followers before any upload
+    for _ in range(100):
+        ret = leader_checkin(ncores, wanted, pubkey, 'exiting', lseq, status=status, job=job)
+        #print('driver: leader {} checkin post-normal exit returned'.format(os.getpid()), ret)
+        ret = ret.get('result')
+        if ret and ret['state'] == 'exiting':
+            return
+        time.sleep(0.1)
+
+
+def leader_attempt(pset, user_kwargs, pubkey, lseq, last_attempt=True):
+    # returns (completed, retryable)
+    job = leader_job(pset, user_kwargs, pubkey)
+    wanted = wanted_cores(pset, user_kwargs)
+    told, final = False, True
+    try:
+        completed, retryable, told = leader_run(pset, user_kwargs, pubkey, lseq, job, wanted, last_attempt)
+        final = not retryable or last_attempt
+        return completed, retryable
+    finally:
+        if not told:
+            # every way out ends with an exit checkin, or the server waits for this leader before draining the pool
+            leader_exit_checkin(pset['ncores'], wanted, pubkey, lseq, None, dict(job, final=final))
+
+
+def leader_run(pset, user_kwargs, pubkey, lseq, job, wanted, last_attempt):
+    # returns (completed, retryable, whether the server has heard our exit)
     mpi_proc = None
+    prepared = None
     ncores = pset['ncores']
+    phases = pset.get('phases') or [pset['run_args']]
+    phase = 0
+    if job.get('malleable'):
+        # the server only grows the job while a later phase can use the new followers
+        job['phases_left'] = len(phases) - 1
+    wall = 0.0  # of all mpirun phases, for the server's runtime history
+    mpi_start = None
+    staging = None
+    if job.get('stage'):
+        # staged while we wait in the queue, and mpirun does not start until it is done
+        mounts = [user_kwargs['mount_google_bucket']] if 'mount_google_bucket' in user_kwargs else []
+        staging = in_background(stage_inputs, job['stage'], mounts)
 
-    lseq = initial_seq()
     state = 'waiting'
-    wanted = pset['wanted']
+    in_job = False  # scheduled or running, for checkin priority
+    trace_phase('waiting')
 
     #print('I am leader before loop')
     while True:
         #print('I am leader {} top of loop'.format(os.getpid()))
         sys.stdout.flush()
-        ret = leader_checkin(ncores, wanted, pubkey, state, lseq)
+        ret = leader_checkin(ncores, wanted, pubkey, state, lseq, job=job, priority=in_job)
         #print('driver: leader {} checkin returned'.format(os.getpid()), ret)
         sys.stdout.flush()
         ret = ret.get('result')
         if ret is None:
             # either server sent None or there was a network error
-            time.sleep(0.1)
+            time.sleep(checkin_delay(leader_exceptions, 0.1))
             continue
+        in_job = ret['state'] in {'scheduled', 'running'}
+        staged = None
+        if staging is not None and ret['state'] in {'scheduled', 'running'} and state != 'running':
+            if not background_done(staging):
+                time.sleep(0.1)
+                continue
+            staged = staging[1]['value']
         if ret['state'] == 'exiting':
             # XXX consolidate with the duplicate code below
             #print('driver: leader {}: received surprising exiting status'.format(os.getpid()))
@@ -306,13 +1249,26 @@ def leader(pset, system_kwargs, user_kwargs):
                 status = 0  # ??? XXX
                 completed = subprocess.CompletedProcess(args=None, returncode=status, stdout='', stderr='')
             sys.stdout.flush()
-            return {'cli': completed, 'node': socket.gethostname() + '_' + str(os.getpid()) + '_' + str(lseq)}
-
-        if ret['state'] == 'running':
+            # the server is shutting down, so there is nobody to requeue with
+            return completed, False, False
+
+        if ret['state'] == 'scheduled':
+            # followers are not running yet, get ready so mpirun starts as soon as they are
+            if trace_mark and trace_mark[0] == 'waiting':
+                trace_phase('scheduled')
+            prepared = leader_prepare_mpi(dict(pset, run_args=phases[phase]), ret, job_cores(ret, wanted, job),
+                                          user_kwargs, prepared=prepared, staged=staged)
+        elif ret['state'] == 'running':
             if state == 'running':
                 assert mpi_proc is not None
             else:
-                mpi_proc = leader_start_mpi(pset, ret, wanted, user_kwargs)
+                ret = ready_followers(ret)
+                trace_phase('mpirun' if len(phases) == 1 else 'mpirun phase {}'.format(phase + 1))
+                phase_pset = dict(pset, run_args=phases[phase])
+                prepared = leader_prepare_mpi(phase_pset, ret, job_cores(ret, wanted, job), user_kwargs, prepared=prepared,
+                                              staged=staged)
+                mpi_start = time.time()
+                mpi_proc = leader_start_mpi(phase_pset, ret, job_cores(ret, wanted, job), user_kwargs, prepared=prepared)
                 #print('driver: leader {} just started mpi proc and poll returns'.format(os.getpid()), check_mpi(mpi_proc))
                 state = 'running'
         elif ret['state'] == 'waiting' and mpi_proc is not None:
@@ -323,7 +1279,7 @@ def leader(pset, system_kwargs, user_kwargs):
             status = check_mpi(mpi_proc)
             #print('driver: leader {} bailing out on state==waiting post mpi_proc'.format(os.getpid()))
             sys.stdout.flush()
-            return {'cli': completed, 'node': socket.gethostname() + '_' + str(os.getpid()) + '_' + str(lseq)}
+            return completed, True, False
 
         if mpi_proc:
             status = check_mpi(mpi_proc)
@@ -331,6 +1287,7 @@ def leader(pset, system_kwargs, user_kwargs):
             if status is not None:
                 print('driver: leader {} checking mpirun:'.format(os.getpid()), status)
                 state = 'exiting'
+                wall += time.time() - mpi_start
 
                 try:
                     completed = finish_mpi(mpi_proc)  # should complete immediately
@@ -344,59 +1301,174 @@ def leader(pset, system_kwargs, user_kwargs):
                         raise
                     completed = subprocess.CompletedProcess(args=None, returncode=status, stdout='', stderr='')
 
-                for _ in range(100):
-                    ret = leader_checkin(ncores, wanted, pubkey, state, lseq)
-                    #print('driver: leader {} checkin post-normal exit returned'.format(os.getpid()), ret)
-                    ret = ret.get('result')
-                    if ret and ret['state'] == 'exiting':
-                        break
-                    time.sleep(0.1)
+                if status == 0 and phase + 1 < len(phases):
+                    # between phases, pick up any followers the server added to this job
+                    phase += 1
+                    if job.get('malleable'):
+                        job['phases_left'] = len(phases) - phase - 1
+                    state = 'waiting'  # so the next running checkin starts it
+                    trace_phase('between phases')
+                    print('driver: leader {} starting phase {} of {}'.format(os.getpid(), phase + 1, len(phases)))
+                    continue
+
+                trace_phase('exit handshake')
+                # final: this job will not be retried
+                leader_exit_checkin(ncores, wanted, pubkey, lseq, status, dict(job, wall=wall, final=status == 0 or last_attempt))
                 sys.stdout.flush()
-                return {'cli': completed, 'node': socket.gethostname() + '_' + str(os.getpid()) + '_' + str(lseq)}
+                return completed, status != 0, True
 
         if not mpi_proc:
-            time.sleep(0.1)
+            time.sleep(checkin_delay(leader_exceptions, 0.1))
 
     raise ValueError('notreached')
 
 
+def leader(pset, system_kwargs, user_kwargs):
+    #print('I am leader and my pid is {}'.format(os.getpid()))
+    pubkey = get_pubkey()
+    retries = pset.get('retries', user_kwargs.get('retries', 0))
+
+    lseq = initial_seq()
+
+    for attempt in range(retries + 1):
+        completed, retryable = leader_attempt(pset, user_kwargs, pubkey, lseq, last_attempt=attempt == retries)
+        if not retryable or attempt == retries:
+            break
+        print('driver: leader {} job failed with returncode {}, requeueing (retry {} of {})'.format(
+            os.getpid(), completed.returncode, attempt + 1, retries), file=sys.stderr)
+        # a new sequence number makes the server forget the old job and queue us again
+        lseq += 1
+        trace_phase('requeue')
+
+    release_staged()
+    trace_phase('upload')
+    uploaded = upload_outputs(pset, user_kwargs)
+
+    send_trace('leader')
+    ret = {'cli': completed, 'node': socket.gethostname() + '_' + str(os.getpid()) + '_' + str(lseq)}
+    if uploaded is not None:
+        ret['upload'] = uploaded
+    return ret
+
+
 def follower(pset, system_kwargs, user_kwargs):
     #print('I am follower and my pid is {}'.format(os.getpid()))
     fseq = initial_seq()
     state = 'available'
     ncores = pset['ncores']
 
+    # the leader uses our topology to write rankfiles, the server matches resources to jobs
+    info = {'topology': get_topology(), 'resources': get_resources(pset, user_kwargs)}
+    if user_kwargs.get('cleanup_pubkeys'):
+        # the server tells us which of our keys other jobs on this host still need
+        info['cleanup_pubkeys'] = True
+    if pset.get('shared', user_kwargs.get('shared_followers')):
+        # the server can give slices of our cores to several leaders at once
+        info['shared'] = True
+        info['persistent'] = True
+    if pset.get('persistent', user_kwargs.get('persistent_followers')):
+        # serve leaders one after another until the server says the pool is drained
+        info['persistent'] = True
+        if 'pool_idle_timeout' in user_kwargs:
+            info['idle_timeout'] = user_kwargs['pool_idle_timeout']
+    trace_phase('available')
+    preparing = None  # mounts and staging for the job, which run while we keep checking in
+    staged = {}  # leader key -> staged directory of that job
+    jobs = set()  # leader keys of our jobs, as last heard from the server
+
     while True:
         #print('driver: follower checkin with state', state)
         sys.stdout.flush()
-        ret = follower_checkin(ncores, state, fseq)
+        if preparing is not None:
+            try:
+                if background_done(preparing):
+                    if preparing[1].get('value'):
+                        staged[preparing_for] = preparing[1]['value']
+                        release_finished(staged, jobs)
+                    preparing = None
+                    trace_phase('in job')
+                    # the server waits for this checkin before the job can run
+                    state = 'assigned'
+            except Exception as e:
+                print('driver: follower {} failed to prepare for its job: {}'.format(os.getpid(), repr(e)), file=sys.stderr)
+                preparing = None
+                # the server drops us from the job, and the leader gets a new schedule
+                state = 'available'
+        info['datasets'] = local_datasets()
+        ret = follower_checkin(ncores, state, fseq, info=info)
         #print('driver: follower checkin returned', ret)
         sys.stdout.flush()
         ret = ret['result']
         if ret is None:
-            time.sleep(1.0)
+            time.sleep(checkin_delay(follower_exceptions, 1.0))
             continue
 
-        if ret['state'] == 'assigned' and state != 'assigned':
-            # do this only once
-            deploy_pubkey(ret['pubkey'])
+        if 'jobs' in ret or 'leader' in ret:
+            # a shared follower hears about all of its jobs, anyone else only has the one it was handed
+            jobs = set(ret['jobs'] if 'jobs' in ret else [ret['leader']])
+            release_finished(staged, jobs)
+
+        if ret['state'] == 'assigned' and 'leader' in ret:
+            # a new schedule, which a persistent follower can get before it hears its last job ended
+            trace_phase('preparing')
+            if 'pubkey' in ret:
+                deploy_pubkey(ret['pubkey'])
+            elif not pubkey_is_deployed(ret['fingerprint']):
+                # the server thinks an earlier follower on this host deployed it
+                print('driver: follower {} does not find leader key {} in authorized_keys, mpirun may fail'.format(
+                    os.getpid(), ret['fingerprint']), file=sys.stderr)
+            if ret.get('mounts') or ret.get('stage'):
+                preparing = in_background(stage_inputs, ret.get('stage'), ret.get('mounts') or [])
+                preparing_for = ret['leader']
+                state = 'preparing'
+                time.sleep(checkin_delay(follower_exceptions, 1.0))
+                continue
+            trace_phase('in job')
         elif ret['state'] == 'exiting':
             #print('driver: follower told to exit')
+            release_staged()
+            if (ret.get('survey_done') or ret.get('cleanup')) and user_kwargs.get('cleanup_pubkeys'):
+                cleanup_pubkeys(keep=ret.get('keep_fingerprints', ()))
             break
+        elif ret['state'] == 'available' and state != 'available':
+            print('driver: persistent follower {} finished a job, returning to the pool'.format(os.getpid()))
+            preparing = None  # for a job that went away before it could start
+            staged.clear()
+            jobs = set()
+            release_staged()
+            trace_phase('available')
 
         state = ret['state']
-        time.sleep(1.0)
+        time.sleep(checkin_delay(follower_exceptions, 1.0))
 
+    send_trace('follower')
     # for pandas type reasons, if cli is an object for the leader, it has to be an object for the follower
     # elsewise pandas will make the column a float
     sys.stdout.flush()
     return {'cli': 'hi pandas', 'node': socket.gethostname() + '_' + str(os.getpid()) + '_' + str(fseq)}
 
 
+def is_local_host(host):
+    if host in {'localhost', '127.0.0.1', '::1'}:
+        return True
+    # compare short names, getfqdn() can be a slow dns lookup
+    return host.split('.')[0] == socket.gethostname().split('.')[0]
+
+
+def choose_url(user_kwargs):
+    # workers on the server's host use its Unix socket, which only exists on that host
+    path = user_kwargs.get('multimpi_server_socket')
+    tcp_url = user_kwargs['multimpi_server_url']
+    if path and is_local_host(urllib.parse.urlsplit(tcp_url).hostname or '') and os.path.exists(path):
+        return unix_url(path)
+    return tcp_url
+
+
 def multimpi_worker(pset, system_kwargs, user_kwargs):
     if 'multimpi_server_url' in user_kwargs:
-        global url
-        url = user_kwargs['multimpi_server_url']
+        global url, tracing
+        url = choose_url(user_kwargs)
+        tracing = user_kwargs.get('multimpi_trace', False)
     else:
         raise ValueError('missing multimpi_server_url')
 
@@ -422,9 +1494,56 @@ def mysignal(helper_server_proc, signum, frame):
             print('driver: additional sigint ignored', file=sys.stderr)
 
 
-def start_multimpi_server(hostport=':8889', user_kwargs=None):
+def start_embedded_server(user_kwargs, history_file=None):
+    # the server runs on a thread of the driver, and workers on this host talk to it over a Unix socket
+    from . import server  # only the driver needs the server and aiohttp
+    global url, helper_server_proc, server_socket_dir
+    server_socket_dir = tempfile.mkdtemp(prefix='multimpi_')
+    path = os.path.join(server_socket_dir, 'server.sock')
+    if history_file:
+        server.history.load(history_file)
+    server.start_embedded(path)
+    url = unix_url(path)
+    user_kwargs['multimpi_server_url'] = url
+
+    hw = hello_world()
+    if hw != 'pass':
+        server.stop_embedded()
+        raise ValueError('hello world test of embedded multimpi server returned: '+hw)
+    helper_server_proc = server.embedded_thread
+    return helper_server_proc
+
+
+def enable_trace(path, user_kwargs):
+    global trace_file
+    trace_file = path
+    if path:
+        rpc_call('start_trace', [])
+        user_kwargs['multimpi_trace'] = True
+
+
+def start_multimpi_server(hostport=':8889', user_kwargs=None, mode='subprocess', unix_socket=True, trace_file=None,
+                          history_file=None, host_failure_limit=None):
+    '''mode='embedded' runs the server inside this process, for surveys with all workers on this host.
+
+    With unix_socket, the server also listens on a Unix socket, which workers on this host use instead of tcp.
+    With trace_file, end_multimpi_server() writes a chrome trace of every job there.
+    history_file keeps job runtimes across surveys for scheduling, None for the default location in ~/.cache,
+    '' for none.
+    With host_failure_limit, follower hosts with that many recent node failures are avoided.'''
     if user_kwargs is None:
         raise ValueError('must pass user_kwargs as a dict')
+    if history_file is None:
+        from . import history
+        history_file = history.default_history_file
+    if mode == 'embedded':
+        proc = start_embedded_server(user_kwargs, history_file=history_file)
+        enable_trace(trace_file, user_kwargs)
+        if host_failure_limit:
+            rpc_call('set_host_failure_limit', [host_failure_limit])
+        return proc
+    if mode != 'subprocess':
+        raise ValueError('unknown multimpi server mode: '+mode)
     if ':' not in hostport:
         hostport = hostport + ':8889'
     host, port = hostport.split(':', maxsplit=1)
@@ -436,11 +1555,23 @@ def start_multimpi_server(hostport=':8889', user_kwargs=None):
     url = 'http://{}:{}/jsonrpc'.format(host, port)
     user_kwargs['multimpi_server_url'] = url
 
-    global helper_server_proc
+    global helper_server_proc, server_socket_dir
     daemon = paramsurvey_multimpi.__file__.replace('/__init__.py', '/server.py')
-    helper_server_proc = subprocess.Popen(['python', daemon, host, port])
+    ready_r, ready_w = os.pipe()
+    args = ['python', daemon, host, port, str(ready_w)]
+    if unix_socket:
+        server_socket_dir = tempfile.mkdtemp(prefix='multimpi_')
+        path = os.path.join(server_socket_dir, 'server.sock')
+        user_kwargs['multimpi_server_socket'] = path
+        args.append(path)
+    else:
+        args.append('-')
+    args.append(history_file or '-')
+    helper_server_proc = subprocess.Popen(args, pass_fds=(ready_w,))
+    os.close(ready_w)
 
-    status = check_multimpi_server(helper_server_proc, timeout=3.0)
+    ready = wait_for_ready(ready_r)
+    status = check_multimpi_server(helper_server_proc, timeout=0)
     if status is not None:
         print('driver: mpi helper server exited immediately with status', status, file=sys.stderr)
         # at the moment this server doesn't use pipes so out,err are None
@@ -450,20 +1581,50 @@ def start_multimpi_server(hostport=':8889', user_kwargs=None):
         if errs:
             print('driver: mpi helper stderr is', errs, file=sys.stderr)
         raise ValueError('cannot continue without multimpi_server')
+    if not ready:
+        tear_down_multimpi_server(helper_server_proc)
+        raise ValueError('multimpi server did not start listening within {} seconds'.format(server_ready_timeout))
 
     hw = hello_world()
     if hw != 'pass':
         raise ValueError('hello world test of multimpi server returned: '+hw)
+    url = choose_url(user_kwargs)
+    if url != user_kwargs['multimpi_server_url']:
+        hw = hello_world()
+        if hw != 'pass':
+            raise ValueError('hello world test of multimpi server Unix socket returned: '+hw)
 
     # XXX add more checks, perhaps in a paramsurvey.map() timer function?
 
     mysignal_ = functools.partial(mysignal, helper_server_proc)
     signal.signal(signal.SIGINT, mysignal_)
+    enable_trace(trace_file, user_kwargs)
+    if host_failure_limit:
+        rpc_call('set_host_failure_limit', [host_failure_limit])
 
     return helper_server_proc
 
 
+def wait_for_ready(ready_r, timeout=None):
+    # the server writes a line on this pipe once it is listening, or closes it by exiting
+    with os.fdopen(ready_r) as f:
+        readable, _, _ = select.select([f], [], [], timeout or server_ready_timeout)
+        return bool(readable) and f.readline() == 'ready\n'
+
+
+def remove_server_socket():
+    global server_socket_dir
+    if server_socket_dir:
+        shutil.rmtree(server_socket_dir, ignore_errors=True)
+        server_socket_dir = None
+
+
 def tear_down_multimpi_server(helper_server_proc):
+    if isinstance(helper_server_proc, threading.Thread):
+        from . import server
+        server.stop_embedded()
+        remove_server_socket()
+        return
     helper_server_proc.send_signal(signal.SIGHUP)
     for _ in range(10):
         status = check_multimpi_server(helper_server_proc)
@@ -472,13 +1633,25 @@ def tear_down_multimpi_server(helper_server_proc):
         time.sleep(1.0)
     if status is None:
         helper_server_proc.kill()
+    remove_server_socket()
 
 
-def end_multimpi_server():    
+def end_multimpi_server():
+    stop_progress()
+    if isinstance(helper_server_proc, threading.Thread):
+        if trace_file:
+            write_trace(trace_file)
+        tear_down_multimpi_server(helper_server_proc)
+        return
     status = check_multimpi_server(helper_server_proc)
     if status is not None:
         print('looked at multimpi server and it had already exited with status', str(status), file=sys.stderr)
+        if trace_file:
+            print('driver: no trace written to', trace_file, file=sys.stderr)
+        remove_server_socket()
     else:
+        if trace_file:
+            write_trace(trace_file)
         print('multimpi server has not exited already, tearing it down', file=sys.stderr)
         tear_down_multimpi_server(helper_server_proc)
 
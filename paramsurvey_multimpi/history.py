@@ -0,0 +1,124 @@
+import os
+import os.path
+import re
+import json
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+# per user, so that one user's file never gets in the way of another's
+default_history_file = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                    'paramsurvey_multimpi', 'history.json')
+max_entries = 10000  # least recently used keys are evicted beyond this
+max_samples = 20  # most recent wall times kept per key
+save_interval = 10  # seconds between writes of the history file
+
+path = None  # no file, the history only lives as long as this process
+entries = OrderedDict()  # key -> [wall seconds, ...], least recently used first
+dirty = False
+last_save_t = 0
+saver = None  # thread writing the history file, so the server's event loop never waits on the disk
+
+
+def normalize(run_args):
+    # per-job names like out_0012.dat or run7 are the same job shape, numeric arguments like -n 1000 are not
+    tokens = []
+    for token in run_args.split():
+        if re.search(r'[^\d.+-]', token):
+            token = re.sub(r'\d+', '#', token)
+        tokens.append(token)
+    return ' '.join(tokens)
+
+
+def history_key(run_args, wanted_cores, max_cores=None):
+    return '{} |{}|{}'.format(normalize(run_args), wanted_cores, max_cores or wanted_cores)
+
+
+def load(history_file):
+    '''Use history_file for the history, reading any that is already there.'''
+    global path, entries, dirty
+    path = history_file
+    entries = OrderedDict()
+    dirty = False
+    try:
+        with open(path) as f:
+            entries.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print('server: ignoring unreadable runtime history {}: {}'.format(path, e))
+    evict()
+
+
+def write(history_file, text):
+    # write to a temporary name so that readers never see a partial file
+    tmp = None
+    try:
+        directory = os.path.dirname(os.path.abspath(history_file))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.partial_')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp, history_file)
+    except OSError as e:
+        print('server: could not save runtime history {}: {}'.format(history_file, e))
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def save(background=False):
+    global dirty, last_save_t, saver
+    last_save_t = time.time()
+    if not background and saver is not None:
+        # an older background write must not finish after, and on top of, this one
+        saver.join()
+    if path is None or not dirty:
+        return
+    if background and saver is not None and saver.is_alive():
+        # still writing the last one, this one is saved next time
+        return
+    text = json.dumps(entries)
+    dirty = False
+    if background:
+        saver = threading.Thread(target=write, args=(path, text), name='multimpi_history', daemon=True)
+        saver.start()
+    else:
+        write(path, text)
+
+
+def evict():
+    while len(entries) > max_entries:
+        entries.popitem(last=False)
+
+
+def record(key, wall):
+    '''Add the wall time of one finished job.'''
+    global dirty
+    samples = entries.pop(key, [])
+    samples.append(round(wall, 3))
+    entries[key] = samples[-max_samples:]
+    evict()
+    dirty = True
+    if time.time() - last_save_t > save_interval:
+        save(background=True)
+
+
+def estimate(key, quantile=0.5):
+    '''Estimated wall time for key, e.g. quantile=0.9 for a pessimistic one, or None if it has never run.'''
+    samples = entries.get(key)
+    if not samples:
+        return
+    entries.move_to_end(key)
+    samples = sorted(samples)
+    return samples[min(int(quantile * len(samples)), len(samples) - 1)]
+
+
+def clear():
+    global path, entries, dirty, last_save_t, saver
+    path = None
+    entries = OrderedDict()
+    dirty = False
+    last_save_t = 0
+    saver = None
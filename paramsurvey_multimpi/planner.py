@@ -0,0 +1,67 @@
+import math
+from collections import Counter
+
+
+def node_sizes():
+    # cores on each node of the cluster paramsurvey.init() connected to. ray head nodes can have none
+    import paramsurvey
+    return [r['num_cores'] for r in paramsurvey.current_resources() if r.get('num_cores')]
+
+
+def candidate_sizes(wanted, sizes, backend):
+    if backend == 'multiprocessing':
+        # each multiprocessing worker is one process with one core
+        return [1]
+    # sizes that tile every node exactly, so workers never strand cores on a node
+    g = 0
+    for s in sizes:
+        g = math.gcd(g, int(s))
+    if g == 1 and max(sizes) > 1:
+        # e.g. 16 and 15 core nodes, where only 1 core workers tile both. Plan for the most common
+        # node size instead (the larger one on a tie), and accept stranded cores on the other nodes
+        g = max(Counter(sizes).most_common(), key=lambda c: (c[1], c[0]))[0]
+    ret = [d for d in range(1, g + 1) if g % d == 0]
+    if wanted <= min(sizes) and wanted not in ret:
+        # the whole job in one worker, on one node
+        ret.append(wanted)
+    return ret
+
+
+def worker_cores(wanted, sizes, backend=None):
+    '''Cores per worker for a job of wanted cores: the fewest cores allocated beyond wanted, then the fewest workers.'''
+    def cost(g):
+        workers = math.ceil(wanted / g)
+        return workers * g - wanted, workers
+    return min(candidate_sizes(wanted, sizes, backend), key=cost)
+
+
+def plan(jobs, sizes=None, backend=None):
+    '''Make the psets for a survey of MPI jobs.
+
+    jobs is a list of dicts with at least 'wanted' cores, and whatever else the leader pset needs,
+    e.g. 'run_args'. sizes are the cores of each node, by default from the current paramsurvey cluster.
+    Each job gets a leader and enough followers, all of the same size, with ray resources filled in.'''
+    if backend is None or sizes is None:
+        import paramsurvey
+        backend = backend or paramsurvey.backend()
+        sizes = sizes or node_sizes()
+    sizes = [s for s in sizes if s > 0]
+    if not sizes:
+        raise ValueError('no nodes to plan for')
+
+    psets = []
+    for job in jobs:
+        # elastic jobs get enough followers to grow to max_cores
+        cores = int(job.get('max_cores') or job['wanted'])
+        if cores < 1:
+            raise ValueError('job wants {} cores'.format(cores))
+        if backend == 'ray' and cores > sum(sizes):
+            raise ValueError('job wants {} cores, more than the {} in the cluster'.format(cores, sum(sizes)))
+        g = worker_cores(cores, sizes, backend)
+        workers = [dict(job, kind='leader', ncores=g)]
+        workers.extend({'kind': 'follower', 'ncores': g} for _ in range(math.ceil(cores / g) - 1))
+        if backend == 'ray':
+            for p in workers:
+                p['ray'] = {'num_cores': g}
+        psets.extend(workers)
+    return psets
@@ -1,17 +1,26 @@
 import signal
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 import multiprocessing
 import os
 import sys
 import ctypes
 import ctypes.util
+import functools
+import asyncio
+import threading
 
 from aiohttp import web
 import aiohttp_rpc
 
 import psutil
 
+try:
+    from paramsurvey_multimpi import history
+except ImportError:
+    # run as a script from an uninstalled tree
+    import history
+
 exiting = False
 
 leaders = defaultdict(dict)
@@ -20,8 +29,181 @@ cache_lifetime = 30  # should be several times as long as the follower checkin t
 
 jobnumber = 0  # used to disambiguate states
 
+host_failures = defaultdict(list)  # times of node failures per follower host
+host_failure_limit = None  # followers on hosts with this many recent failures are avoided, None to never avoid them
+host_failure_decay = 600  # seconds until a failure no longer counts against its host
+
+host_pubkeys = defaultdict(set)  # fingerprints of leader keys already sent to followers on each host
+host_datasets = defaultdict(set)  # datasets that followers report having locally, per host
+host_shared = defaultdict(set)  # shared followers on each host, whose slices must not share cores
+prepare_keys = ('mounts', 'stage')  # job work done by each follower before it is running
+
+reservation_timeout = 30  # how long followers are held for a leader that cannot be scheduled yet
+reservation_stats = defaultdict(int)  # followers reserved, and how many of those the leader used or lost
+queue_order = 'sjf'  # or 'fifo'. sjf puts leaders with short runtimes in history.py ahead of those queued before them
+
+pool_idle_timeout = 60  # persistent followers exit after this long without any leader checkins
+no_leader_timeout = 600  # or this long after the pool started, if no leader ever checks in
+last_leader_t = None
+pool_start_t = None
+draining = False
+survey_leaders = None  # leaders in the current survey, from start_survey()
+leaders_done = 0  # of those, how many have finished for good
+
 sigint_count = 0
 
+admission_lag = 0.5  # seconds the event loop is behind before new arrivals are told to retry later
+admission_lag_running = 2.0  # the same, for checkins from workers whose job is scheduled or running
+admission_retry_after = 1.0  # seconds, scaled up by how far over the limit we are
+lag_interval = 0.05  # seconds between measurements of the event loop lag
+loop_lag = 0.0  # how late the last measurement ran, decaying once the loop catches up
+lag_deadline = None  # when the next measurement is due, None if nothing is measuring
+lag_monitor = None
+admission_stats = defaultdict(int)
+
+# for stats(), kept up to date at each checkin instead of scanning the tables
+observed = {}  # (kind, key) -> (state, ((state, cores), ...)) as of the last checkin
+state_counts = defaultdict(int)  # (kind, state) -> count
+state_cores = defaultdict(int)  # (kind, state) -> cores
+queue_waits = deque(maxlen=1000)  # seconds from arrival to schedule, of recent jobs
+recent_failures = deque(maxlen=20)  # (t, why)
+failure_count = 0
+jobs_finished = 0  # final outcomes only, a job that is retried counts once
+jobs_failed = 0  # of those, how many failed
+jobs_retried = 0  # failed attempts that were queued again
+
+tracing = False  # record state transitions for a chrome trace, see trace()
+trace_states = {}  # last traced state of each leader and follower
+trace_transitions = []  # (t, kind, key, state)
+worker_spans = []  # (kind, key, name, start, end) sent by workers with add_trace()
+
+embedded_loop = None  # event loop of the server thread, in embedded mode
+embedded_thread = None
+
+
+def trace_check(kind, k, entry):
+    state = entry.get('state') if entry else None
+    if trace_states.get(k) != state:
+        trace_states[k] = state
+        trace_transitions.append((time.time(), kind, k, state))
+
+
+def entry_cores(entry):
+    # a shared follower serving jobs is running, but its free cores are still available
+    if entry.get('jobs') and entry.get('state') == 'available':
+        free = free_cores(entry)
+        return 'running', (('running', entry['cores'] - free), ('available', free))
+    return entry.get('state'), ((entry.get('state'), entry.get('cores', 0)),)
+
+
+def observe(kind, k, entry):
+    global jobs_finished, jobs_failed, jobs_retried
+    new = entry_cores(entry) if entry else None
+    old = observed.get((kind, k))
+    if new == old:
+        return
+    if old:
+        state_counts[(kind, old[0])] -= 1
+        for state, cores in old[1]:
+            state_cores[(kind, state)] -= cores
+    if new:
+        observed[(kind, k)] = new
+        state_counts[(kind, new[0])] += 1
+        for state, cores in new[1]:
+            state_cores[(kind, state)] += cores
+    else:
+        observed.pop((kind, k), None)
+    if kind == 'leader' and new:
+        if (old is None or old[0] == 'waiting') and new[0] in {'scheduled', 'running'} and 'arrived_t' in entry:
+            queue_waits.append(time.time() - entry['arrived_t'])
+        if old and new[0] == 'exiting':
+            if not entry.get('final'):
+                jobs_retried += 1
+            else:
+                jobs_finished += 1
+                if entry.get('status'):
+                    jobs_failed += 1
+
+
+def forget(kind, k):
+    observe(kind, k, None)
+
+
+def traced(kind):
+    # after each checkin, record any state change of this leader (and its followers) or follower
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(ip, cores, pid, *args, **kwargs):
+            ret = func(ip, cores, pid, *args, **kwargs)
+            k = key(ip, pid)
+            table = leaders if kind == 'leader' else followers
+            observe(kind, k, table.get(k))
+            if tracing:
+                trace_check(kind, k, table.get(k))
+            if kind == 'leader' and k in leaders:
+                for f in leaders[k].get('fkeys') or []:
+                    observe('follower', f, followers.get(f))
+                    if tracing:
+                        trace_check('follower', f, followers.get(f))
+            return ret
+        return wrapper
+    return decorator
+
+
+def start_trace():
+    global tracing
+    tracing = True
+    return {'tracing': True}
+
+
+def add_trace(ip, pid, kind, spans):
+    '''workers send their own view of their job: [[name, start, end], ...]'''
+    k = key(ip, pid)
+    for name, start, end in spans:
+        worker_spans.append((kind, k, name, start, end))
+    return {'added': len(spans)}
+
+
+def trace():
+    '''Return everything traced so far in chrome trace-event format, for chrome://tracing or Perfetto.
+
+    The server's view of each leader and follower is one process, each worker's own view is another process per host.'''
+    now = time.time()
+    events = []
+    pids = {}
+    tids = {}
+
+    def ids(process, thread):
+        if process not in pids:
+            pids[process] = len(pids) + 1
+            events.append({'ph': 'M', 'name': 'process_name', 'pid': pids[process], 'args': {'name': process}})
+        if (process, thread) not in tids:
+            tids[(process, thread)] = len(tids) + 1
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pids[process],
+                           'tid': tids[(process, thread)], 'args': {'name': thread}})
+        return pids[process], tids[(process, thread)]
+
+    def span(process, thread, name, start, end, cat):
+        pid, tid = ids(process, thread)
+        events.append({'ph': 'X', 'name': name, 'cat': cat, 'pid': pid, 'tid': tid,
+                       'ts': int(start * 1e6), 'dur': max(int((end - start) * 1e6), 1)})
+
+    last = {}
+    for t, kind, k, state in trace_transitions:
+        if k in last and last[k][1] is not None:
+            span('server', '{} {}'.format(kind, k), last[k][1], last[k][0], t, 'server')
+        last[k] = (t, state, kind)
+    for k, (t, state, kind) in last.items():
+        if state not in {None, 'exiting'}:
+            # still in this state
+            span('server', '{} {}'.format(kind, k), state, t, now, 'server')
+
+    for kind, k, name, start, end in worker_spans:
+        host, pid = unkey(k)
+        span(host, '{} {}'.format(kind, pid), name, start, end, 'worker')
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
 
 def set_pdeathsig():
     libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
@@ -34,8 +216,41 @@ def clear():
     #print('clear')
     global leaders
     global followers
+    global host_failures
+    global host_pubkeys
+    global host_datasets, host_shared
+    global reservation_stats
+    global tracing, trace_states, trace_transitions, worker_spans
+    global observed, state_counts, state_cores, queue_waits, recent_failures, failure_count
+    global jobs_finished, jobs_failed, jobs_retried
+    global last_leader_t, pool_start_t
+    global draining, survey_leaders, leaders_done
     leaders = defaultdict(dict)
     followers = defaultdict(dict)
+    host_failures = defaultdict(list)
+    host_pubkeys = defaultdict(set)
+    host_datasets = defaultdict(set)
+    host_shared = defaultdict(set)
+    reservation_stats = defaultdict(int)
+    tracing = False
+    trace_states = {}
+    trace_transitions = []
+    worker_spans = []
+    observed = {}
+    state_counts = defaultdict(int)
+    state_cores = defaultdict(int)
+    queue_waits = deque(maxlen=1000)
+    recent_failures = deque(maxlen=20)
+    failure_count = 0
+    jobs_finished = 0
+    jobs_failed = 0
+    jobs_retried = 0
+    last_leader_t = None
+    pool_start_t = None
+    draining = False
+    survey_leaders = None
+    leaders_done = 0
+    history.clear()
 
 
 def cache_timeout():
@@ -55,6 +270,7 @@ def cache_timeout():
         if 'jobnumber' in followers[fkey] and followers[fkey].get('state') != 'exiting':
             print('server: follower {} in job {} timed out, that is a bad sign'.format(fkey, followers[fkey]['jobnumber']))
         del followers[fkey]
+        forget('follower', fkey)
 
     timeouts = []
     for k, v in leaders.items():
@@ -68,6 +284,7 @@ def cache_timeout():
         jobnumber = leaders[lkey].get('jobnumber')
         print('server: leader {} in state {} jobnumber {} timed out'.format(lkey, state, jobnumber))
         del leaders[lkey]
+        forget('leader', lkey)
 
 
 def cache_clean_exiting():
@@ -77,48 +294,326 @@ def cache_clean_exiting():
             nuke.add(l)
     for l in nuke:
         del leaders[l]
+        forget('leader', l)
     nuke = set()
     for f, v in followers.items():
         if v['state'] == 'exiting':
             nuke.add(f)
     for f in nuke:
         del followers[f]
+        forget('follower', f)
+
+
+def record_failure(hosts, why):
+    # hosts are the ones that look at fault, empty for a job that merely failed
+    global failure_count
+    failure_count += 1
+    now = time.time()
+    recent_failures.append((now, why))
+    for host in hosts:
+        host_failures[host].append(now)
+        count = host_failure_count(host)
+        print('server: host {} failure count is now {} because {}'.format(host, count, why))
+        if count == host_failure_limit:
+            print('server: host {} will be avoided'.format(host))
+
+
+def host_failure_count(host):
+    if host not in host_failures:
+        return 0
+    recent = [t for t in host_failures[host] if time.time() - t < host_failure_decay]
+    if recent:
+        host_failures[host] = recent
+    else:
+        del host_failures[host]
+    return len(recent)
+
+
+def host_avoided(host):
+    return host_failure_limit is not None and host_failure_count(host) >= host_failure_limit
+
+
+def node_failure(status):
+    # killed by a signal, or mpirun's 255 when it loses a remote daemon. Other statuses are the job's own
+    return status < 0 or status >= 128
+
+
+def set_host_failure_limit(limit=None, decay=None):
+    '''Avoid follower hosts with limit recent node failures, or never avoid them with None.'''
+    global host_failure_limit, host_failure_decay
+    host_failure_limit = limit
+    if decay is not None:
+        host_failure_decay = decay
+    return {'limit': host_failure_limit, 'decay': host_failure_decay}
 
 
-def find_followers(wanted_cores):
+def job_hosts(lkey, l):
+    hosts = set([unkey(lkey)[0]])
+    hosts.update(unkey(f)[0] for f in l.get('fkeys', []))
+    return hosts
+
+
+def follower_fits(f, requires):
+    # requires: memory and scratch are minimums in bytes, labels must all be present
+    resources = f.get('resources', {})
+    for k in ('memory', 'scratch'):
+        if k in requires and resources.get(k, 0) < requires[k]:
+            return False
+    if requires.get('labels') and not set(requires['labels']).issubset(resources.get('labels', [])):
+        return False
+    return True
+
+
+def free_cores(f):
+    if f.get('shared'):
+        return min(f['cores'] - sum(s['cores'] for s in f['jobs'].values()), len(free_slots(f)))
+    return f['cores']
+
+
+def free_slots(f):
+    # cpus of a shared follower that no slice on its host is using. These are the logical cpus
+    # in its affinity mask, the same unit as its cores, or just numbers if it reported no topology
+    slots = (f.get('topology') or {}).get('cpus') or list(range(f['cores']))
+    used = set()
+    for k in host_shared[f['host']]:
+        if k in followers and followers[k].get('shared'):
+            used.update(slot for fs in followers[k]['jobs'].values() for slot in fs['slots'])
+    return [slot for slot in slots if slot not in used]
+
+
+def find_followers(wanted_cores, requires=None, hosts=(), datasets=(), extra_cores=0, lkey=None, partial=False, exclude=()):
+    # returns [(fkey, cores)], where cores is all of an ordinary follower or a slice of a shared one
+    # hosts are the ones already in the job, which count towards min_nodes and max_nodes
+    # exclude are the followers already in the job, a shared one can only hold one slice per leader
+    # extra_cores are taken if available, for elastic jobs
+    # followers reserved for lkey are candidates, and partial returns what was found even if not enough
     #print('  schedule: find followers, want {} cores'.format(wanted_cores))
-    fkeys = []
+    requires = requires or {}
+    datasets = set(datasets)
+    candidates = []
+    avoided = set()
     for k, v in followers.items():
-        if v['state'] == 'available':
-            wanted_cores -= v['cores']
-            fkeys.append(k)
-            if wanted_cores <= 0:
-                break
-    if wanted_cores <= 0:
-        #print('  ff: did find enough cores:', ','.join(fkeys))
-        return fkeys
-    #print('  ff: did not find enough cores')
+        if k in exclude:
+            continue
+        mine = v['state'] == 'reserved' and lkey is not None and v.get('reserved_for') == lkey
+        if (v['state'] == 'available' or mine) and free_cores(v) > 0 and follower_fits(v, requires):
+            host = unkey(k)[0]
+            failures = host_failure_count(host)
+            if host_avoided(host):
+                avoided.add(k)
+            warm = len(datasets & host_datasets[host]) if datasets and host in host_datasets else 0
+            candidates.append(((not mine, failures, -warm), k))
+    # prefer our reservations, then hosts with fewer failures, then hosts that already have our data.
+    # sort is stable, so ties stay in checkin order
+    candidates.sort(key=lambda c: c[0])
+
+    found, enough = pick_followers([c for c in candidates if c[1] not in avoided], wanted_cores, hosts, requires, extra_cores)
+    if not enough and avoided:
+        # busy followers elsewhere will free up, but if even all of them are too few,
+        # better a host with failures than a job that can never run
+        others = [k for k, v in followers.items() if not host_avoided(unkey(k)[0]) and follower_fits(v, requires)]
+        other_hosts = set(hosts) | set(unkey(k)[0] for k in others)
+        if sum(followers[k]['cores'] for k in others) < wanted_cores or len(other_hosts) < requires.get('min_nodes', 1):
+            found, enough = pick_followers(candidates, wanted_cores, hosts, requires, extra_cores)
+    if enough or partial:
+        return found
+
+
+def pick_followers(candidates, wanted_cores, hosts, requires, extra_cores):
+    # returns (found, whether it is enough), see find_followers()
+    def take(k, wanted):
+        # a shared follower gives only what is still wanted
+        if followers[k].get('shared'):
+            return min(free_cores(followers[k]), max(wanted, 1))
+        return followers[k]['cores']
+
+    hosts = set(hosts)
+    min_nodes = requires.get('min_nodes', 1)
+    max_nodes = requires.get('max_nodes')
+    found = []
+
+    if len(hosts) < min_nodes:
+        # first spread out over enough hosts
+        for _, k in candidates:
+            host = unkey(k)[0]
+            if host not in hosts:
+                hosts.add(host)
+                cores = take(k, wanted_cores)
+                wanted_cores -= cores
+                found.append((k, cores))
+                if len(hosts) >= min_nodes:
+                    break
+        if len(hosts) < min_nodes:
+            #print('  ff: did not find enough nodes')
+            return found, False
+
+    taken = set(k for k, _ in found)
+    for _, k in candidates:
+        if wanted_cores <= 0:
+            break
+        if k in taken:
+            continue
+        host = unkey(k)[0]
+        if max_nodes and host not in hosts and len(hosts) >= max_nodes:
+            continue
+        hosts.add(host)
+        cores = take(k, wanted_cores)
+        wanted_cores -= cores
+        found.append((k, cores))
+    if wanted_cores > 0:
+        #print('  ff: did not find enough cores')
+        return found, False
+
+    extra_cores += wanted_cores  # any overshoot counts against the extra cores
+    taken = set(k for k, _ in found)
+    for _, k in candidates:
+        if extra_cores <= 0:
+            break
+        if k in taken or take(k, extra_cores) > extra_cores:
+            continue
+        host = unkey(k)[0]
+        if max_nodes and host not in hosts and len(hosts) >= max_nodes:
+            continue
+        hosts.add(host)
+        cores = take(k, extra_cores)
+        extra_cores -= cores
+        found.append((k, cores))
+    #print('  ff: did find enough cores:', ','.join(k for k, _ in found))
+    return found, True
+
+
+def assign_follower(f, lkey, l, jobnumber, cores=None):
+    if followers[f]['state'] == 'reserved':
+        reservation_stats['used'] += 1
+        followers[f].pop('reserved_for')
+        followers[f]['state'] = 'available'
+    if followers[f].get('shared'):
+        # a slice of the follower's cores, the rest stay available to other leaders
+        slots = free_slots(followers[f])[:cores]
+        fs = followers[f]['jobs'][lkey] = {'cores': len(slots), 'slots': slots}
+    else:
+        fs = followers[f]
+    fs['state'] = 'assigned'
+    fs['leader'] = lkey
+    fs['pubkey'] = l['pubkey']
+    fs['fingerprint'] = l.get('fingerprint')
+    for k in prepare_keys:
+        fs[k] = l.get(k)
+    fs['jobnumber'] = jobnumber
+
+
+def follower_slice(f, lkey):
+    # the part of follower f in leader lkey's job: all of an ordinary follower, or one slice of a shared one
+    if f not in followers:
+        return
+    if followers[f].get('shared'):
+        return followers[f]['jobs'].get(lkey)
+    return followers[f]
+
+
+def slice_cores(lkey, l):
+    return sum(follower_slice(f, lkey)['cores'] for f in l['fkeys'])
+
+
+def release_slice(f, lkey):
+    # the job is over for this follower: a shared follower frees the slice, a persistent one rejoins the pool
+    if f not in followers:
+        # timed out, and indexing the defaultdict would bring it back
+        return
+    if followers[f].get('shared'):
+        followers[f]['jobs'].pop(lkey, None)
+        if followers[f].get('preparing') == lkey:
+            followers[f].pop('preparing')
+    else:
+        release_follower(followers[f])
+
+
+def queue_priority(l):
+    # shortest job first, aged by time in the queue so long jobs are not starved.
+    # a job with no runtime history counts as short, so new job shapes are measured early
+    if queue_order == 'sjf':
+        return l['queued_t'] + (l.get('estimate') or 0)
+    return l['queued_t']
+
+
+def head_of_queue():
+    # the first leader in the queue is the only one allowed to hold reservations,
+    # so two partially satisfied leaders can never each hold what the other needs
+    waiting = [(queue_priority(l), k) for k, l in leaders.items() if l.get('state') == 'waiting' and 'queued_t' in l]
+    if waiting:
+        return min(waiting)[1]
+
+
+def expire_reservations():
+    now = time.time()
+    for lkey, l in leaders.items():
+        if 'reserved_t' in l and (l.get('state') != 'waiting' or now - l['reserved_t'] > reservation_timeout):
+            del l['reserved_t']
+            if l.get('state') == 'waiting':
+                # go to the back of the queue, and let the next leader try
+                l['queued_t'] = now
+                print('server: reservations for leader {} expired'.format(lkey))
+    for f in followers.values():
+        if f.get('state') == 'reserved':
+            holder = leaders.get(f['reserved_for'])
+            if not holder or 'reserved_t' not in holder:
+                reservation_stats['expired'] += 1
+                f.pop('reserved_for')
+                f['state'] = 'available'
+
+
+def reserve(lkey, l):
+    # hold whatever followers we can get, so we are not starved by leaders that need fewer
+    if head_of_queue() != lkey:
+        return
+    found = find_followers(l['wanted_cores'] - l['cores'], requires=l.get('requires', {}), hosts=job_hosts(lkey, l),
+                           datasets=l.get('datasets', ()), lkey=lkey, partial=True) or []
+    # shared followers already serving other jobs are not held
+    new = [f for f, _ in found if followers[f]['state'] == 'available' and not followers[f].get('jobs')]
+    if not new:
+        return
+    l.setdefault('reserved_t', time.time())
+    for f in new:
+        followers[f]['state'] = 'reserved'
+        followers[f]['reserved_for'] = lkey
+    reservation_stats['made'] += len(new)
+    print('server: reserved {} more followers for leader {}, hit rate so far {}'.format(
+        len(new), lkey, reservation_hit_rate()))
+
+
+def reservation_hit_rate():
+    # fraction of finished reservations that the leader went on to use
+    done = reservation_stats['used'] + reservation_stats['expired']
+    if done:
+        return '{:.0%}'.format(reservation_stats['used'] / done)
+    return 'n/a'
 
 
 def schedule(lkey, l):
     global jobnumber
     cache_timeout()
+    expire_reservations()
     wanted_cores = l['wanted_cores'] - l['cores']
     print('  schedule: wanted {} cores in addition to leader cores {}'.format(wanted_cores, l['cores']))
     is_reschedule = False
     if l.get('fkeys'):
         is_reschedule = True
-        wanted_cores -= sum(followers[f]['cores'] for f in l['fkeys'])
+        wanted_cores -= slice_cores(lkey, l)
         print('  reschedule, after existing follower cores we still want', wanted_cores)
 
-    if wanted_cores > 0:
-        fkeys = find_followers(wanted_cores)
+    extra_cores = l['max_cores'] - l['wanted_cores']
+    requires = l.get('requires', {})
+    hosts = job_hosts(lkey, l)
+    if wanted_cores > 0 or extra_cores > 0 or len(hosts) < requires.get('min_nodes', 1):
+        found = find_followers(wanted_cores, requires=requires, hosts=hosts, datasets=l.get('datasets', ()),
+                               extra_cores=extra_cores, lkey=lkey, exclude=l.get('fkeys', ()))
     else:
-        fkeys = []
+        found = []
 
-    print('  schedule: return of find_followers was', fkeys)  # None, [], list
+    print('  schedule: return of find_followers was', found)  # None, [], list
 
-    if wanted_cores <= 0 or fkeys is not None:
+    if found is not None:
+        fkeys = [f for f, _ in found]
         if is_reschedule:
             print('  re-scheduled jobnumber', jobnumber)
             pass
@@ -126,21 +621,17 @@ def schedule(lkey, l):
             print('  scheduled jobnumber', jobnumber)
             pass
 
-        for f in fkeys:
-            followers[f]['state'] = 'assigned'
-            followers[f]['leader'] = lkey
-            followers[f]['pubkey'] = l['pubkey']
-            followers[f]['jobnumber'] = jobnumber  # overwritten with the old number for is_reschedule
+        for f, cores in found:
+            assign_follower(f, lkey, l, l['jobnumber'] if is_reschedule else jobnumber, cores=cores)
         if is_reschedule:
             l['fkeys'].extend(fkeys)
-            for f in fkeys:
-                followers[f]['jobnumber'] = l['jobnumber']
         else:
             l['jobnumber'] = jobnumber
             l['fkeys'] = fkeys
             jobnumber += 1
 
         l['state'] = 'scheduled'
+        l.pop('reserved_t', None)
         if len(l['fkeys']) == 0:  # job fits the leader
             print('  schedule: leader-only, setting state to running')
             l['state'] = 'running'
@@ -148,11 +639,35 @@ def schedule(lkey, l):
     print('  failed to schedule')
 
 
-def make_leader_return(l):
+def grow(lkey, l):
+    # offer idle followers to a running malleable job with phases left, which uses them in its next phase
+    if any(v.get('state') == 'waiting' for v in leaders.values()):
+        # waiting jobs come first
+        return
+    extra_cores = l['max_cores'] - l['cores'] - slice_cores(lkey, l)
+    if extra_cores <= 0:
+        return
+    found = find_followers(0, requires=l.get('requires', {}), hosts=job_hosts(lkey, l), datasets=l.get('datasets', ()),
+                           extra_cores=extra_cores, exclude=l['fkeys'])
+    if found:
+        print('server: growing job {} by {} followers'.format(l['jobnumber'], len(found)))
+        for f, cores in found:
+            assign_follower(f, lkey, l, l['jobnumber'], cores=cores)
+        l['fkeys'].extend(f for f, _ in found)
+
+
+def make_leader_return(lkey, l):
     # this is the return value for the leader
     ret = []
     for f in l['fkeys']:
-        ret.append({'fkey': f, 'cores': followers[f]['cores']})
+        fs = follower_slice(f, lkey)
+        fret = {'fkey': f, 'cores': fs['cores'], 'state': fs['state']}
+        if 'slots' in fs:
+            # which of the follower's cores are ours, for rankfiles
+            fret['slots'] = fs['slots']
+        if 'topology' in followers[f]:
+            fret['topology'] = followers[f]['topology']
+        ret.append(fret)
     return {'followers': ret, 'state': l['state'], 'lcores': l['cores'], 'jobnumber': l['jobnumber']}
 
 
@@ -161,17 +676,22 @@ def key(ip, pid):
     return '_'.join((ip, str(pid)))
 
 
-def get_valid_fkeys(l):
+def unkey(k):
+    return k.rsplit('_', 1)
+
+
+def get_valid_fkeys(lkey, l):
     valid_fkeys = []
     for f in l['fkeys']:
-        if f not in followers:
+        fs = follower_slice(f, lkey)
+        if fs is None:
             #print('      not in followers')
             pass
-        elif followers[f]['state'] not in {'assigned', 'running'}:  # XXX test 'running'
+        elif fs['state'] not in {'assigned', 'preparing', 'running'}:  # XXX test 'running'
             # for example, follower timed out and then checked in
-            #print('      not assigned or running, but ', followers[f]['state'])
+            #print('      not assigned or running, but ', fs['state'])
             pass
-        elif followers[f]['jobnumber'] != l['jobnumber']:
+        elif fs['jobnumber'] != l['jobnumber']:
             # for example, follower timed out, checked in, was assigned to some other job
             #print('      wrong jobnumber')
             pass
@@ -180,20 +700,25 @@ def get_valid_fkeys(l):
     return valid_fkeys
 
 
-def leader_checkin(ip, cores, pid, wanted_cores, pubkey, remotestate, lseq_new):
+@traced('leader')
+def leader_checkin(ip, cores, pid, wanted_cores, pubkey, remotestate, lseq_new, status=None, job=None):
     if exiting:
         #print('multimpi_server: saw leader checkin after I was HUPped', file=sys.stderr)
         # XXX if I'm in the leaders table, remove me
         return {'followers': None, 'state': 'exiting'}
+    job = job or {}
 
     lkey = key(ip, pid)
     #print('leader checkin {}, wanted: {}, lseq_new: {}'.format(lkey, wanted_cores, lseq_new))
+    global last_leader_t, draining, leaders_done
+    last_leader_t = time.time()
     # leader states: waiting -> scheduled -> running -> exiting
 
     if lkey in followers:
         # well, this job might or might not have finished... so all we can do is:
         #print('leader checkin used key of an existing follower')
         del followers[lkey]
+        forget('follower', lkey)
 
     l = leaders[lkey]  # defaultdict dict
 
@@ -214,20 +739,45 @@ def leader_checkin(ip, cores, pid, wanted_cores, pubkey, remotestate, lseq_new):
 
     if remotestate == 'exiting':
         # leader announcing an mpirun exit ... ought to be in the 'running' state
+        if status:
+            # only a node failure is held against the follower hosts, never the leader's own
+            hosts = set(unkey(f)[0] for f in l.get('fkeys', [])) if node_failure(status) else ()
+            record_failure(hosts, 'job {} mpirun exited with status {}'.format(l.get('jobnumber'), status))
+        # for stats(), see observe()
+        l['final'] = bool(job.get('final'))
+        l['status'] = status
+        if job.get('final'):
+            # not going to be retried, so one fewer leader for the pool to wait for
+            leaders_done += 1
         if state == 'running':
             for f in l['fkeys']:
-                if f in followers and followers[f]['state'] == 'running':
-                    followers[f]['state'] = 'exiting'
+                # including followers added by grow() that never got to run
+                if f in followers and followers[f].get('shared'):
+                    release_slice(f, lkey)
+                elif f in followers and followers[f]['state'] in {'assigned', 'preparing', 'running'}:
+                    if followers[f].get('persistent') and not pool_drained(followers[f]):
+                        # back in the pool now, not at its next checkin
+                        release_follower(followers[f])
+                    else:
+                        followers[f]['state'] = 'exiting'
             l['state'] = 'exiting'
+            if not status and job.get('wall') and l.get('history_key'):
+                # after the followers are released, so a history problem cannot strand them
+                try:
+                    history.record(l['history_key'], job['wall'])
+                except Exception as e:
+                    print('server: could not record runtime history:', repr(e))
         else:
-            print('server surprised to see leader {} state {} announce remotestate exiting'.format(lkey, state))
+            if state != 'waiting':
+                # waiting is a leader whose mpirun was stopped after a follower disappeared
+                print('server surprised to see leader {} state {} announce remotestate exiting'.format(lkey, state))
             l['state'] = 'exiting'
         return {'followers': None, 'state': 'exiting'}
 
     try_to_schedule = ''
     if state in {'scheduled', 'running'}:
         #print('  leader is already scheduled')
-        valid_fkeys = get_valid_fkeys(l)
+        valid_fkeys = get_valid_fkeys(lkey, l)
 
         if len(valid_fkeys) != len(l['fkeys']):
             #print('  not all followers still exist, so triggering a new schedule')
@@ -239,27 +789,46 @@ def leader_checkin(ip, cores, pid, wanted_cores, pubkey, remotestate, lseq_new):
             elif state == 'running':
                 # if the leader is 'running' mpi is using the list it was already given
                 print('server: leader {} is sad because a follower disappeared'.format(lkey))
+                gone = set(l['fkeys']) - set(valid_fkeys)
+                record_failure(set(unkey(f)[0] for f in gone), 'a follower disappeared from running job {}'.format(l['jobnumber']))
             l['fkeys'] = valid_fkeys
         elif state == 'running':
-            pass
+            if l.get('malleable') and job.get('phases_left', 0) > 0:
+                # followers added during the last phase would sit idle until it ends
+                grow(lkey, l)
         elif state == 'scheduled':
-            if all([followers[f]['state'] == 'running' for f in valid_fkeys]):
+            if all([follower_slice(f, lkey)['state'] == 'running' for f in valid_fkeys]):
                 print('server: job number {} has reached the running state'.format(l['jobnumber']))
                 l['state'] = 'running'
     else:
         # if state is None, this is a new-to-us leader
         # if it's waiting, we overwrite with identical information
         #print('  overwriting leader state, which was', state)
+        l.setdefault('queued_t', time.time())
+        l.setdefault('arrived_t', l['queued_t'])  # queued_t moves when reservations expire, this does not
         if state is None:
             try_to_schedule = 'new leader'
+            # a drain was for an earlier survey
+            draining = False
         elif state == 'waiting':
             try_to_schedule = 'waiting leader'
         l['state'] = 'waiting'
         l['cores'] = cores
         l['wanted_cores'] = int(wanted_cores)
+        # elastic jobs start with wanted_cores and take up to max_cores
+        l['max_cores'] = max(int(job.get('max_cores', wanted_cores)), l['wanted_cores'])
+        l['malleable'] = job.get('malleable', False)
         l['lseq'] = lseq_new
         l['pubkey'] = pubkey
+        l['fingerprint'] = job.get('fingerprint')
+        l['requires'] = job.get('requires', {})
+        l['datasets'] = job.get('datasets', [])
+        for k in prepare_keys:
+            l[k] = job.get(k)
         l['jobnumber'] = None
+        if state is None and job.get('run_args'):
+            l['history_key'] = history.history_key(job['run_args'], l['wanted_cores'], l['max_cores'])
+            l['estimate'] = history.estimate(l['history_key'])
 
     if try_to_schedule:
         print('server: trying schedule because of', try_to_schedule)
@@ -269,16 +838,15 @@ def leader_checkin(ip, cores, pid, wanted_cores, pubkey, remotestate, lseq_new):
         if not ret:
             if state == 'scheduled':
                 if l['fkeys']:
-                    print('server: after failed reschedule, freeing {} followers'.fprmat(len(l['fkeys'])))
+                    print('server: after failed reschedule, freeing {} followers'.format(len(l['fkeys'])))
                     for fkey in l['fkeys']:
-                        f = followers[fkey]
-                        f['state'] = 'available'
-                        del f['leader']
-                        del f['pubkey']
+                        release_slice(fkey, lkey)
                     del l['fkeys']
                 l['state'] = 'waiting'
+                # the freed followers are the first ones we try to reserve
+                reserve(lkey, l)
             elif state is None or state == 'waiting':
-                pass
+                reserve(lkey, l)
             else:
                 raise ValueError('surrised to see state {} after a failed schedule'.format(state))
     else:
@@ -289,17 +857,110 @@ def leader_checkin(ip, cores, pid, wanted_cores, pubkey, remotestate, lseq_new):
 
     if l['state'] in {'scheduled', 'running'}:
         #print('  returning a schedule with {} followers'.format(len(l['fkeys'])))
-        return make_leader_return(l)
+        return make_leader_return(lkey, l)
     else:
         #print('  did not schedule')
         pass
 
 
-def follower_checkin(ip, cores, pid, remotestate, fseq_new):
+def pool_drained(f):
+    if draining:
+        return True
+    if survey_leaders is not None and leaders_done >= survey_leaders:
+        # every leader of the survey is done, no need to wait for the idle timeout
+        return True
+    if last_leader_t is None:
+        # no leader has shown up yet, but do not wait forever
+        return pool_start_t is not None and time.time() - pool_start_t > no_leader_timeout
+    return time.time() - last_leader_t > f.get('idle_timeout', pool_idle_timeout)
+
+
+def release_follower(f):
+    # a persistent follower goes back into the pool after its job ends
+    for k in ('leader', 'pubkey', 'fingerprint', 'jobnumber') + prepare_keys:
+        f.pop(k, None)
+    f['state'] = 'available'
+
+
+def hand_out(ip, f, fs):
+    # give a follower, or a slice of a shared one, the schedule of its leader
+    ret = {'leader': fs['leader'], 'fingerprint': fs.get('fingerprint'), 'state': 'assigned'}
+    fingerprint = fs.get('fingerprint')
+    if not fingerprint or fingerprint not in host_pubkeys[ip]:
+        # otherwise an earlier follower on this host already deployed this key
+        ret['pubkey'] = fs['pubkey']
+        if fingerprint:
+            host_pubkeys[ip].add(fingerprint)
+            f.setdefault('deployed', set()).add(fingerprint)
+    prepare = dict((k, fs[k]) for k in prepare_keys if fs.get(k))
+    if prepare:
+        # the follower checks in again once prepared, and only then is running
+        ret.update(prepare)
+        fs['state'] = 'preparing'
+    else:
+        fs['state'] = 'running'  # XXX how does the follower get to 'running'?
+    return ret
+
+
+def host_keys_in_use(ip, k):
+    # fingerprints of leader keys used by jobs of other followers on this host
+    in_use = set()
+    for fk, v in followers.items():
+        if fk == k or unkey(fk)[0] != ip:
+            continue
+        for fs in v['jobs'].values() if v.get('shared') else [v]:
+            if fs.get('state') in {'assigned', 'preparing', 'running'} and fs.get('fingerprint'):
+                in_use.add(fs['fingerprint'])
+    return in_use
+
+
+def follower_exit(ip, k, f, survey_done=False):
+    # every exiting follower may remove the leader keys it deployed, see client.cleanup_pubkeys()
+    ret = {'state': 'exiting', 'cleanup': True}
+    if survey_done:
+        ret['survey_done'] = True
+    if f.get('cleanup_pubkeys') and f.get('deployed'):
+        keep = f['deployed'] & host_keys_in_use(ip, k)
+        if keep:
+            ret['keep_fingerprints'] = sorted(keep)
+        # so that later followers on this host are sent the removed keys again
+        host_pubkeys[ip] -= f['deployed'] - keep
+        f['deployed'] = keep
+    return ret
+
+
+def shared_follower_checkin(ip, k, f, remotestate):
+    # a shared follower serves a slice to each of several leaders, and prepares for new ones one at a time
+    if remotestate == 'preparing' and f.get('preparing'):
+        return {'state': 'preparing'}
+    if remotestate == 'assigned' and f.get('preparing'):
+        fs = f['jobs'].get(f.pop('preparing'))
+        if fs and fs['state'] == 'preparing':
+            fs['state'] = 'running'
+    for lkey, fs in f['jobs'].items():
+        if fs['state'] == 'assigned':
+            ret = hand_out(ip, f, fs)
+            if fs['state'] == 'preparing':
+                f['preparing'] = lkey
+            # the follower releases what it staged for jobs that are no longer listed
+            ret['jobs'] = f['told_jobs'] = sorted(f['jobs'])
+            return ret
+    if not f['jobs'] and f.get('persistent') and pool_drained(f):
+        print('server: survey pool is drained, shared follower {} is exiting'.format(k))
+        f['state'] = 'exiting'
+        return follower_exit(ip, k, f, survey_done=True)
+    if sorted(f['jobs']) != f.get('told_jobs', []):
+        f['told_jobs'] = sorted(f['jobs'])
+        return {'state': 'assigned' if f['jobs'] else 'available', 'jobs': f['told_jobs']}
+
+
+@traced('follower')
+def follower_checkin(ip, cores, pid, remotestate, fseq_new, info=None):
+    global pool_start_t
     if exiting:
         #print('multimpi_server: saw follower checkin after I was HUPped', file=sys.stderr)
         # XXX remove me from the followers table?
-        return {'state': 'exiting'}
+        return {'state': 'exiting', 'survey_done': True}
 
     k = key(ip, pid)
     #print('follower checkin', k, 'with remotestate', remotestate)
@@ -321,6 +982,7 @@ def follower_checkin(ip, cores, pid, remotestate, fseq_new):
                     #print('GREG this happened')
                     followers[f]['state'] = 'exiting'
         del leaders[k]
+        forget('leader', k)
 
     f = followers[k]  # defaultdict dict
     if f.get('fseq') != fseq_new:
@@ -330,33 +992,132 @@ def follower_checkin(ip, cores, pid, remotestate, fseq_new):
 
     f['t'] = time.time()
     f['fseq'] = fseq_new
+    if info:
+        f['persistent'] = info.get('persistent', False)
+        if info.get('shared') and not f.get('shared'):
+            f['shared'] = True
+            f['jobs'] = {}  # leader key -> slice
+            f['host'] = ip
+            host_shared[ip].add(k)
+        if 'idle_timeout' in info:
+            f['idle_timeout'] = info['idle_timeout']
+        if f['persistent'] and pool_start_t is None:
+            pool_start_t = time.time()
+        f['cleanup_pubkeys'] = info.get('cleanup_pubkeys', False)
+        if 'topology' in info:
+            f['topology'] = info['topology']
+        if 'resources' in info:
+            f['resources'] = info['resources']
+        if info.get('datasets'):
+            host_datasets[ip].update(info['datasets'])
     state = f.get('state')
 
     if state == 'exiting':
-        return {'state': 'exiting'}
+        if f.get('persistent'):
+            if not pool_drained(f):
+                release_follower(f)
+                return {'state': 'available'}
+            return follower_exit(ip, k, f, survey_done=True)
+        return follower_exit(ip, k, f)
+
+    if f.get('shared') and state == 'available':
+        return shared_follower_checkin(ip, k, f, remotestate)
+
+    if state == 'reserved':
+        # held for a leader that is still collecting followers, see reserve()
+        if f.get('persistent') and pool_drained(f):
+            f['state'] = 'exiting'
+            return follower_exit(ip, k, f, survey_done=True)
+        if remotestate == 'assigned':
+            # it was in a schedule that fell apart
+            return {'state': 'available'}
+        return
+
+    if remotestate == 'preparing' and state == 'preparing':
+        # still mounting and staging, which the follower does while it keeps checking in
+        return {'state': 'preparing'}
 
     if remotestate == 'assigned':
         #print('  GREG remotestate assigned, state is', state)
         if state == 'available':
+            if f.get('persistent'):
+                # we released it but the follower missed hearing about it
+                return {'state': 'available'}
             raise ValueError('should not see state available here?')
         if state == 'running':
             # all is well
             return {'state': 'assigned'}
+        if state == 'preparing':
+            # follower finished its mounts and staging
+            f['state'] = 'running'
+            return {'state': 'assigned'}
 
-    if state == 'assigned' and remotestate == 'available':
-        f['state'] = 'running'
+    if state == 'assigned' and remotestate in {'available', 'assigned'}:
+        # 'assigned' is a persistent follower that was released and reassigned before it checked in
         #print('  returning a schedule to the follower')
-        return {'leader': f['leader'], 'pubkey': f['pubkey'], 'state': 'assigned'}  # XXX how does the follower get to 'running'?
+        return hand_out(ip, f, f)
 
     #if f.get('state') == 'running':
     if state == 'running':
         #print('  destroying follower schedule')
         del f['leader']
         del f['pubkey']
+    if f.get('persistent') and pool_drained(f):
+        print('server: survey pool is drained, persistent follower {} is exiting'.format(k))
+        f['state'] = 'exiting'
+        return follower_exit(ip, k, f, survey_done=True)
     f['state'] = 'available'
     f['cores'] = cores
 
 
+def percentile(values, q):
+    values = sorted(values)
+    if values:
+        return round(values[min(int(q * len(values)), len(values) - 1)], 3)
+
+
+def stats():
+    '''Cheap summary of the survey so far, from counters kept up to date at each checkin.
+
+    Worker states are as of their last checkin, so may lag the tables by one checkin interval.'''
+    jobs = {s: n for (kind, s), n in state_counts.items() if kind == 'leader' and n}
+    workers = {s: n for (kind, s), n in state_counts.items() if kind == 'follower' and n}
+    busy = state_cores[('leader', 'scheduled')] + state_cores[('leader', 'running')]
+    busy += sum(state_cores[('follower', s)] for s in ('assigned', 'preparing', 'running'))
+    idle = state_cores[('follower', 'available')] + state_cores[('follower', 'reserved')]
+    return {
+        't': time.time(),
+        'jobs': jobs,
+        'followers': workers,
+        'jobs_finished': jobs_finished,
+        'jobs_failed': jobs_failed,
+        'jobs_retried': jobs_retried,
+        'cores': {'busy': busy, 'idle': idle},
+        'queue_wait': {'p50': percentile(queue_waits, 0.5), 'p90': percentile(queue_waits, 0.9), 'n': len(queue_waits)},
+        'failures': failure_count,
+        'recent_failures': [why for t, why in recent_failures],
+        'reservation_hit_rate': reservation_hit_rate(),
+        'admission': dict(admission_stats, loop_lag=round(loop_lag, 3)),
+    }
+
+
+def start_survey(leaders=None):
+    '''A new survey with this many leaders is starting, and its persistent followers exit once they are all done.'''
+    global draining, survey_leaders, leaders_done, pool_start_t
+    draining = False
+    survey_leaders = leaders
+    leaders_done = 0
+    pool_start_t = time.time()
+    return {'leaders': leaders}
+
+
+def drain():
+    '''tell persistent followers to exit once they are no longer in a job'''
+    global draining
+    draining = True
+    return {'draining': True}
+
+
 def hello_world():
     return {'hello': 'world!'}
 
@@ -374,6 +1135,14 @@ def core_count():
             return multiprocessing.cpu_count()
 
 
+def announce_ready(ready_fd, message):
+    # aiohttp calls this once it is listening. The driver waits for our line on its pipe
+    print(message)
+    if ready_fd is not None:
+        with os.fdopen(ready_fd, 'w') as f:
+            f.write('ready\n')
+
+
 def mysignal(signum, frame):
     if signum == signal.SIGHUP:
         global exiting
@@ -399,24 +1168,141 @@ def mysignal(signum, frame):
         pass
 
 
-if __name__ == '__main__':
-    signal.signal(signal.SIGHUP, mysignal)
-    signal.signal(signal.SIGINT, mysignal)
-    set_pdeathsig()
+async def save_history(app):
+    history.save()
+
+
+async def measure_lag():
+    # checkins are handled one at a time on the event loop, so a timer fires late by about as long
+    # as requests are waiting behind each other
+    global loop_lag, lag_deadline
+    try:
+        while True:
+            start = time.monotonic()
+            lag_deadline = start + lag_interval
+            await asyncio.sleep(lag_interval)
+            loop_lag = max(time.monotonic() - lag_deadline, loop_lag / 2)
+    finally:
+        lag_deadline = None
+
 
+def current_lag():
+    # an overdue measurement shows the loop is behind right now, before the measurement gets to run
+    if lag_deadline is None:
+        return loop_lag
+    return max(loop_lag, time.monotonic() - lag_deadline)
+
+
+async def start_lag_monitor(app):
+    global lag_monitor
+    lag_monitor = asyncio.ensure_future(measure_lag())
+
+
+async def stop_lag_monitor(app):
+    lag_monitor.cancel()
+
+
+@web.middleware
+async def admission(request, handler):
+    # under a thundering herd, turn away new arrivals first so running jobs keep checking in on time
+    running = request.headers.get('X-Multimpi-Priority') == 'running'
+    limit = admission_lag_running if running else admission_lag
+    lag = current_lag()
+    if lag >= limit:
+        admission_stats['rejected_running' if running else 'rejected'] += 1
+        retry_after = admission_retry_after * lag / admission_lag
+        return web.json_response({'error': 'busy'}, status=503, headers={'Retry-After': '{:.2f}'.format(retry_after)})
+    admission_stats['admitted'] += 1
+    return await handler(request)
+
+
+def make_app():
     aiohttp_rpc.rpc_server.add_methods([
         leader_checkin,
         follower_checkin,
         hello_world,
-    ])
-
-    app = web.Application()
+        drain,
+        start_survey,
+        set_host_failure_limit,
+        stats,
+        start_trace,
+        add_trace,
+        trace,
+    ], replace=True)  # a process can make more than one app, e.g. embedded servers one after another
+
+    app = web.Application(middlewares=[admission])
+    app.on_startup.append(start_lag_monitor)
+    app.on_cleanup.append(stop_lag_monitor)
+    app.on_cleanup.append(save_history)
     app.router.add_routes([
         web.post('/jsonrpc', aiohttp_rpc.rpc_server.handle_http_request),
     ])
+    return app
+
+
+def start_embedded(path):
+    '''Run the server on a background thread of this process, listening on the Unix socket path.
+
+    For surveys where every worker is on this host, e.g. the multiprocessing backend.'''
+    global embedded_loop, embedded_thread, exiting
+    if embedded_thread is not None:
+        raise ValueError('embedded server is already running')
+    exiting = False
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(make_app())
+    started = threading.Event()
+    errors = []
+
+    def run():
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.UnixSite(runner, path).start())
+        except Exception as e:
+            errors.append(e)
+            started.set()
+            return
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    thread = threading.Thread(target=run, name='multimpi_server', daemon=True)
+    thread.start()
+    started.wait()
+    if errors:
+        raise ValueError('embedded server failed to start: '+str(errors[0]))
+    embedded_loop, embedded_thread = loop, thread
+    print('server: embedded server listening on', path, file=sys.stderr)
+
+
+def stop_embedded():
+    global embedded_loop, embedded_thread, exiting
+    if embedded_thread is None:
+        return
+    exiting = True
+    embedded_loop.call_soon_threadsafe(embedded_loop.stop)
+    embedded_thread.join()
+    embedded_loop, embedded_thread = None, None
+    exiting = False  # the tables in this process may be used again
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGHUP, mysignal)
+    signal.signal(signal.SIGINT, mysignal)
+    set_pdeathsig()
+
+    app = make_app()
 
     host, port = sys.argv[1:3]
+    ready_fd = int(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3] != '-' else None
+    # workers on this host check in over this Unix socket, everyone else uses tcp
+    path = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != '-' else None
+    if len(sys.argv) > 5 and sys.argv[5] != '-':
+        history.load(sys.argv[5])
 
     print('server: hello from the server, I am bound to host {} port {}'.format(host, port), file=sys.stderr)
+    if path:
+        print('server: and to Unix socket', path, file=sys.stderr)
     sys.stderr.flush()
-    web.run_app(app, host=host, port=port)
+    web.run_app(app, host=host, port=port, path=path, print=functools.partial(announce_ready, ready_fd))
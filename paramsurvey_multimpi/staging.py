@@ -0,0 +1,184 @@
+import os
+import os.path
+import hashlib
+import socket
+import tempfile
+import shutil
+import fcntl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+default_staging_dir = os.path.join(tempfile.gettempdir(), 'paramsurvey_multimpi_staging')
+default_max_bytes = 100 * 1000 * 1000 * 1000  # 100 gigabytes
+staging_lock = threading.Lock()  # flock() below protects against other processes on this host
+leases = set()  # lease files of the staged directories this process is using, see release()
+
+
+def object_generation(path):
+    # gcsfuse shows the object's update time as mtime, which changes with each new generation
+    st = os.stat(path)
+    return '{}-{}'.format(st.st_mtime_ns, st.st_size)
+
+
+def object_key(path, generation):
+    return hashlib.sha256('{}\0{}'.format(path, generation).encode()).hexdigest()
+
+
+def copy_object(src, dest):
+    # copy to a temporary name so that a partial copy is never mistaken for a cached object
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.partial_')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def link_objects(stagedir, names, objects):
+    # links are made in a temporary directory and renamed into place, so stagedir never has a half-made link
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(stagedir), prefix='.partial_')
+    for name, obj in zip(names, objects):
+        os.symlink(obj, os.path.join(tmpdir, name))
+    if not os.path.isdir(stagedir):
+        os.rename(tmpdir, stagedir)
+        return
+    for name in names:
+        os.replace(os.path.join(tmpdir, name), os.path.join(stagedir, name))
+    os.rmdir(tmpdir)
+
+
+def cache_objects(objdir):
+    # returns [(last use, size, path)] for everything in the cache
+    ret = []
+    for name in os.listdir(objdir):
+        if name.startswith('.partial_'):
+            continue
+        path = os.path.join(objdir, name)
+        st = os.stat(path)
+        ret.append((st.st_mtime, st.st_size, path))
+    return ret
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def live_staged(staging_dir):
+    # names of staged directories leased by a running process. Leases of exited processes are removed
+    leasedir = os.path.join(staging_dir, 'leases')
+    live = set()
+    for lease in os.listdir(leasedir):
+        name, rest = lease.split('.', 1)
+        host, pid = rest.rsplit('.', 1)
+        if host != socket.gethostname() or pid_alive(int(pid)):
+            # a staging_dir shared with another host is never cleaned up from here
+            live.add(name)
+        else:
+            os.unlink(os.path.join(leasedir, lease))
+    return live
+
+
+def linked_objects(stagedir):
+    ret = set()
+    for name in os.listdir(stagedir):
+        link = os.path.join(stagedir, name)
+        if os.path.islink(link):
+            ret.add(os.readlink(link))
+    return ret
+
+
+def cleanup(staging_dir, live):
+    # returns the objects still linked from live staged directories, after removing the others
+    stageroot = os.path.join(staging_dir, 'staged')
+    pinned = set()
+    for name in os.listdir(stageroot):
+        if name in live:
+            pinned.update(linked_objects(os.path.join(stageroot, name)))
+        else:
+            shutil.rmtree(os.path.join(stageroot, name), ignore_errors=True)
+    return pinned
+
+
+def release(stagedir=None):
+    '''This process is done with stagedir, or with all of its staged directories.
+
+    Unleased staged directories are removed by the next stage() on this host, and their objects can be evicted.'''
+    for lease in list(leases):
+        if stagedir is None or os.path.basename(lease).split('.', 1)[0] == os.path.basename(stagedir):
+            leases.discard(lease)
+            if os.path.exists(lease):
+                os.unlink(lease)
+
+
+def evict(objdir, needed, max_bytes, pinned):
+    # removes least recently used objects until needed more bytes fit under max_bytes
+    objects = cache_objects(objdir)
+    total = sum(size for _, size, _ in objects)
+    if total + needed <= max_bytes:
+        return 0
+    evicted = 0
+    for _, size, path in sorted(objects):
+        if path in pinned:
+            continue
+        os.unlink(path)
+        total -= size
+        evicted += 1
+        if total + needed <= max_bytes:
+            return evicted
+    raise ValueError('staging cache of {} bytes is too small, need {} more bytes'.format(max_bytes, needed))
+
+
+def stage(inputs, staging_dir=None, max_bytes=None, workers=8):
+    '''Copy inputs into this host's staging cache and return a directory of links to them.
+
+    Objects are cached by path and generation, and the least recently used ones are evicted
+    to stay under max_bytes. The returned directory depends only on the list of inputs,
+    so it has the same name on every host and can be used in run_args as %STAGED%.
+    The directory and its objects are kept until this process calls release() or exits.'''
+    staging_dir = staging_dir or default_staging_dir
+    max_bytes = max_bytes or default_max_bytes
+    objdir = os.path.join(staging_dir, 'objects')
+    name = hashlib.sha256('\0'.join(inputs).encode()).hexdigest()[:16]
+    stagedir = os.path.join(staging_dir, 'staged', name)
+    lease = os.path.join(staging_dir, 'leases', '{}.{}.{}'.format(name, socket.gethostname(), os.getpid()))
+    for d in ('objects', 'staged', 'leases'):
+        os.makedirs(os.path.join(staging_dir, d), exist_ok=True)
+
+    names = [os.path.basename(path) for path in inputs]
+    if len(set(names)) != len(names):
+        raise ValueError('staged inputs must have distinct file names')
+
+    objects = [os.path.join(objdir, object_key(path, object_generation(path))) for path in inputs]
+
+    # the lock only covers the leases, links and eviction. Copies run without it, so
+    # other processes on this host can stage at the same time
+    with staging_lock, open(os.path.join(staging_dir, '.lock'), 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+        # leased before cleanup, so the directory is not removed from under us
+        open(lease, 'w').close()
+        leases.add(lease)
+        pinned = cleanup(staging_dir, live_staged(staging_dir))
+
+        missing = [(path, obj) for path, obj in zip(inputs, objects) if not os.path.exists(obj)]
+        needed = sum(os.path.getsize(path) for path, _ in missing)
+        evict(objdir, needed, max_bytes, pinned | set(objects))
+        # linked before they are copied, which pins them against eviction by other processes
+        link_objects(stagedir, names, objects)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() to raise any exception from the copies
+        list(pool.map(lambda m: copy_object(*m), missing))
+    for obj in objects:
+        os.utime(obj)  # mark as recently used
+
+    return stagedir
@@ -0,0 +1,87 @@
+import os
+import os.path
+import sys
+import glob
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+default_part_size = 64 * 1024 * 1024
+default_workers = 8
+uploader = None  # single background thread, so uploads from consecutive jobs do not compete
+uploader_lock = threading.Lock()
+pending = []
+
+
+def expand_outputs(outputs):
+    # outputs are file names or glob patterns, missing files are reported and skipped
+    ret = []
+    for pattern in outputs:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print('driver: upload found no output matching', pattern, file=sys.stderr)
+        ret.extend(m for m in matches if os.path.isfile(m))
+    return ret
+
+
+def copy_part(src, dest, offset, length):
+    with open(src, 'rb') as fsrc, open(dest, 'r+b') as fdest:
+        data = os.pread(fsrc.fileno(), length, offset)
+        os.pwrite(fdest.fileno(), data, offset)
+
+
+def upload_files(files, dest_dir, part_size=None, workers=None):
+    '''Multipart upload of files into dest_dir, all parts of all files in parallel.
+
+    Each file appears under its final name only after all of its parts are written.'''
+    part_size = part_size or default_part_size
+    os.makedirs(dest_dir, exist_ok=True)
+
+    parts = []
+    renames = []
+    for src in files:
+        dest = os.path.join(dest_dir, os.path.basename(src))
+        partial = dest + '.partial'
+        size = os.path.getsize(src)
+        with open(partial, 'wb') as f:
+            f.truncate(size)
+        parts.extend((src, partial, offset, min(part_size, size - offset)) for offset in range(0, size, part_size))
+        renames.append((partial, dest))
+
+    with ThreadPoolExecutor(max_workers=workers or default_workers) as pool:
+        # list() to raise any exception from the parts
+        list(pool.map(lambda p: copy_part(*p), parts))
+
+    for partial, dest in renames:
+        os.replace(partial, dest)
+    return [dest for _, dest in renames]
+
+
+def report(future):
+    if future.exception():
+        print('driver: background upload failed:', repr(future.exception()), file=sys.stderr)
+
+
+def upload(outputs, dest_dir, part_size=None, workers=None):
+    '''Start uploading outputs in the background and return a Future for the list of uploaded paths.'''
+    global uploader
+    files = expand_outputs(outputs)  # globbed now, so files from a later job are not included
+    with uploader_lock:
+        if uploader is None:
+            uploader = ThreadPoolExecutor(max_workers=1)
+        future = uploader.submit(upload_files, files, dest_dir, part_size=part_size, workers=workers)
+        future.add_done_callback(report)
+        pending.append(future)
+    return future
+
+
+def wait():
+    # returns the exceptions of any failed uploads
+    with uploader_lock:
+        futures = pending[:]
+        pending.clear()
+    return [f.exception() for f in futures if f.exception()]
+
+
+atexit.register(wait)
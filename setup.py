@@ -8,13 +8,12 @@ packages = [
     'paramsurvey_multimpi',
 ]
 
-test_requirements = ['pytest', 'coverage', 'pytest-cov', 'pytest-sugar', 'coveralls', 'pyfakefs', 'requests_mock', 'pylint', 'flake8']
+test_requirements = ['pytest', 'coverage', 'pytest-cov', 'pytest-sugar', 'coveralls', 'pyfakefs', 'pylint', 'flake8']
 
 requires = [
     'paramsurvey>0.4.16',
     'aiohttp',
     'aiohttp-rpc',
-    'requests',
     'psutil'
 ]
 
@@ -4,6 +4,8 @@ import os.path
 from io import StringIO
 import sys
 import signal
+import json
+import tempfile
 
 import pytest
 
@@ -30,6 +32,21 @@ def test_generic():
                 },
             ],
         },
+        'multiprocessing_embedded_test': {
+            'backend': 'multiprocessing',
+            'server_mode': 'embedded',
+            'trace': True,
+            'progress': True,
+            'ncores': 4,
+            'exe': './a.out',
+            'tests': [
+                {
+                    'resources': '4x1',
+                    'returncode': 0,
+                    'stderr': '',
+                },
+            ],
+        },
         'ray_test': {
             'backend': 'ray',
             'exe': './a.out',
@@ -58,7 +75,13 @@ def test_generic():
         client.start_multimpi_server(hostport='localhost:8889')
 
     user_kwargs = {}
-    proc = client.start_multimpi_server(hostport='localhost:8889', user_kwargs=user_kwargs)
+    mode = tests.get('server_mode', 'subprocess')
+    trace_file = os.path.join(tempfile.mkdtemp(), 'trace.json') if tests.get('trace') else None
+    proc = client.start_multimpi_server(hostport='localhost:8889', user_kwargs=user_kwargs, mode=mode,
+                                        trace_file=trace_file)
+    progress_file = os.path.join(tempfile.mkdtemp(), 'progress.json') if tests.get('progress') else None
+    if progress_file:
+        client.start_progress(interval=0.2, snapshot_file=progress_file)
     user_kwargs['mpi'] = 'openmpi'
 
     pslogger_fd = StringIO()
@@ -146,6 +169,20 @@ def test_generic():
             assert r.cli.returncode == returncode
 
     print(pslogger_fd.getvalue(), file=sys.stderr)
+    if mode == 'embedded':
+        client.end_multimpi_server()
+        assert not proc.is_alive(), 'embedded server thread exited'
+        if trace_file:
+            with open(trace_file) as f:
+                names = set(e['name'] for e in json.load(f)['traceEvents'])
+            # worker views of the leader and followers, and the server's
+            assert {'waiting', 'mpirun', 'exit handshake', 'in job', 'running'}.issubset(names)
+        if progress_file:
+            with open(progress_file) as f:
+                stats = json.load(f)
+            assert stats['jobs_finished'] == len(tests['tests'])
+            assert stats['failures'] == 0
+        return
     proc.send_signal(signal.SIGHUP)
     try:
         proc.communicate(timeout=5.0)
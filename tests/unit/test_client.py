@@ -2,9 +2,13 @@ import os.path
 import stat
 import socket
 import sys
+import random
+import time
+import subprocess
+import threading
+import http.server
 import pytest
 
-import requests_mock
 
 from paramsurvey_multimpi import client
 
@@ -31,11 +35,56 @@ def test_pubkey(fs):  # pyfakefs
         assert f.read() == fake  # make sure it doesn't write twice
 
 
-def test_jsonrpc_retries():
-    with requests_mock.Mocker() as m:
-        kwargs = {'status_code': 500}
-        m.post(requests_mock.ANY, **kwargs)
+def test_pubkey_fingerprint():
+    key = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIFBwG3wrH8989mY/JVq7SZpZ+wPlL1WfPq6GS2eHVGEu test@example\n'
+    fp = 'SHA256:gpGZowe5Yi7SxZSwigGicup2xCvugMrhQjUwyFrhZ/U'  # from ssh-keygen -l
+    assert client.pubkey_fingerprint(key) == fp
+    assert client.pubkey_fingerprint('no-pty,from="*" ' + key) == fp, 'authorized_keys options are ignored'
+    assert client.pubkey_fingerprint(key.replace('test@example', 'other')) == fp, 'comment is ignored'
+    assert client.pubkey_fingerprint('a fake public key\n') != fp
+
+
+def test_pubkey_cache(fs):  # pyfakefs
+    client.authorized_keys_index['stat'] = None
+    client.deployed_fingerprints.clear()
+    key1 = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIFBwG3wrH8989mY/JVq7SZpZ+wPlL1WfPq6GS2eHVGEu test@example\n'
+    key2 = 'ssh-rsa AAAAB3NzaC1yc2E= other@example\n'
+    keyfile = os.path.expanduser('~/.ssh/authorized_keys')
+    fs.create_file(keyfile, contents=key2)
+
+    client.deploy_pubkey(key1)
+    client.deploy_pubkey(key2)
+    client.deploy_pubkey(key1)
+    with open(keyfile) as f:
+        assert f.read() == key2 + key1
+    assert client.pubkey_is_deployed(client.pubkey_fingerprint(key1))
+
+    client.cleanup_pubkeys(keep=[client.pubkey_fingerprint(key1)])
+    with open(keyfile) as f:
+        assert f.read() == key2 + key1, 'keys still used by other jobs are kept'
+    client.deployed_fingerprints.add(client.pubkey_fingerprint(key1))  # as if this process deployed it again
 
+    client.cleanup_pubkeys()
+    with open(keyfile) as f:
+        assert f.read() == key2, 'only keys we added are removed'
+    assert not client.pubkey_is_deployed(client.pubkey_fingerprint(key1))
+    assert client.pubkey_is_deployed(client.pubkey_fingerprint(key2))
+
+
+class Always500(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.send_error(500)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_jsonrpc_retries():
+    httpd = http.server.HTTPServer(('localhost', 0), Always500)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    old_url = client.url
+    client.url = 'http://localhost:{}/jsonrpc'.format(httpd.server_address[1])
+    try:
         with pytest.raises(ValueError):
             for i in range(1000):
                 ret = client.leader_checkin(1, 1, 1, 1, 1)
@@ -49,6 +98,50 @@ def test_jsonrpc_retries():
         assert i > 1
         assert 'result' in ret
         assert ret['result'] is None
+    finally:
+        client.url = old_url
+        httpd.shutdown()
+        httpd.server_close()
+
+
+class Always503(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.priority = self.headers.get('X-Multimpi-Priority')
+        self.server.priorities.append(self.priority)
+        self.send_response(503)
+        self.send_header('Retry-After', '2.5')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_server_busy():
+    httpd = http.server.HTTPServer(('localhost', 0), Always503)
+    httpd.priorities = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    old_url = client.url
+    client.url = 'http://localhost:{}/jsonrpc'.format(httpd.server_address[1])
+    try:
+        for i in range(200):
+            ret = client.leader_checkin(1, 1, 1, 'waiting', 1)
+        assert ret['result'] is None
+        assert not client.leader_exceptions, 'busy is not a failure'
+        assert client.busy_until > time.time() + 2
+        assert 1.0 <= client.checkin_delay([], 0.1) <= 4.0
+
+        client.leader_checkin(1, 1, 1, 'running', 1)
+        client.follower_checkin(1, 'assigned', 1)
+        assert httpd.priorities[-3:] == [None, 'running', 'running']
+    finally:
+        client.url = old_url
+        client.busy_until = 0.0
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert client.checkin_delay([], 1.0) <= 1.5
+    assert 5.0 <= client.checkin_delay([ValueError()] * 20, 1.0) <= 1.5 * client.backoff_cap
 
 
 def test_unkey():
@@ -96,6 +189,75 @@ def test_machinefile_openmpi():
     assert machinesfile == me+' slots=3\nfoo1 slots=3\nfoo2 slots=3\n'
 
 
+def reference_DiFX(user_kwargs, sums):
+    # the original quadratic implementation, kept to check that the output is unchanged
+    machinefile = ''
+    leader = socket.gethostname()
+    machinefile += leader + '\n'
+    sums[leader] -= 1
+    datastreams = user_kwargs['DiFX_datastreams']
+    nodelist = list(sums.keys())
+    while len(nodelist) < datastreams:
+        nodelist += nodelist
+    nodelist += nodelist
+    ds_count = 0
+    while ds_count < datastreams:
+        try:
+            ds = nodelist.pop(0)
+        except IndexError:
+            raise ValueError('too few cores to configure datastreams')
+        if sums[ds] > 0:
+            machinefile += ds + '\n'
+            sums[ds] -= 1
+            ds_count += 1
+    threadfile = ''
+    for f in sums:
+        if sums[f] > 0:
+            machinefile += f + '\n'
+            threadfile += str(sums[f]) + '\n'
+    return machinefile, threadfile
+
+
+def test_DiFX_matches_reference():
+    me = socket.gethostname()
+    rng = random.Random(12345)
+    for _ in range(500):
+        sums = {me: rng.randint(1, 4)}
+        for h in range(rng.randint(0, 8)):
+            sums['host{}'.format(h)] = rng.randint(0, 4)
+        user_kwargs = {'DiFX_datastreams': rng.randint(0, 12)}
+        try:
+            expected = reference_DiFX(user_kwargs, sums.copy())
+        except ValueError:
+            with pytest.raises(ValueError):
+                client.machinefile_openmp_DiFX(user_kwargs, sums.copy())
+            continue
+        assert client.machinefile_openmp_DiFX(user_kwargs, sums.copy()) == expected
+
+
+def test_DiFX_machinefile_10k_hosts():
+    me = socket.gethostname()
+    sums = {me: 4}
+    for h in range(10000):
+        sums['host{}'.format(h)] = 16
+    user_kwargs = {'DiFX_datastreams': 10000}
+
+    # pytest -s shows the times, which are not asserted because shared CI machines vary too much
+    t0 = time.time()
+    machinefile, threadfile = client.machinefile_openmp_DiFX(user_kwargs, sums.copy())
+    print('DiFX machinefile for 10k hosts took {:.3f}s'.format(time.time() - t0))
+
+    lines = machinefile.splitlines()
+    assert len(lines) == 1 + 10000 + 10001
+    assert threadfile.splitlines()[-2:] == ['15', '16'], 'the last host did not get a datastream'
+
+    ret = {'lcores': 4, 'followers': [{'fkey': h + '_1', 'cores': 16} for h in sums if h != me]}
+    t0 = time.time()
+    machinefile = client.machinefile_openmpi({}, ret, 160004, {'mpi': 'openmpi'})
+    print('openmpi machinefile for 10k hosts took {:.3f}s'.format(time.time() - t0))
+    assert len(machinefile.splitlines()) == 10001
+
+
 def test_openmpi_DiFX_machinefile(fs):  # pyfakefs
     me = socket.gethostname()
     jobname = 'test_openmpi_DiFX'
@@ -122,3 +284,400 @@ def test_openmpi_DiFX_machinefile(fs):  # pyfakefs
     # 3 nodes of 1 core each, 2 datstreams
     # too few cores
     pass
+
+
+def test_leader_prepare_mpi(fs):  # pyfakefs
+    me = socket.gethostname()
+    calls = []
+    user_kwargs = {'mpi': 'openmpi', 'leader_prepare': lambda pset, ret, user_kwargs: calls.append(ret)}
+    pset = {'run_args': 'mpirun --machinefile %MACHINEFILE% -np 6 ./a.out'}
+
+    ret = {'lcores': 3, 'state': 'scheduled',
+           'followers': [{'fkey': 'foo_1', 'cores': 3}]}
+    prepared = client.leader_prepare_mpi(pset, ret, 6, user_kwargs)
+    assert len(calls) == 1
+    with open(prepared['mfname']) as f:
+        assert f.read() == me+' slots=3\nfoo slots=3\n'
+    assert prepared['cmd'] == ['mpirun', '--machinefile', prepared['mfname'], '-np', '6', './a.out']
+
+    again = client.leader_prepare_mpi(pset, ret, 6, user_kwargs, prepared=prepared)
+    assert again is prepared, 'unchanged schedule reuses the preparation'
+    assert len(calls) == 1
+
+    ret = {'lcores': 3, 'state': 'scheduled',
+           'followers': [{'fkey': 'bar_2', 'cores': 3}]}
+    again = client.leader_prepare_mpi(pset, ret, 6, user_kwargs, prepared=prepared)
+    assert len(calls) == 2, 'changed schedule prepares again'
+    assert not os.path.exists(prepared['mfname']), 'stale machinefile removed'
+    with open(again['mfname']) as f:
+        assert f.read() == me+' slots=3\nbar slots=3\n'
+
+
+def test_dvm_cmd():
+    d = {'flag': '--dvm', 'uri': '/tmp/dvm_uri_x'}
+    cmd = ['mpirun', '--machinefile', 'mf', '-np', '4', './a.out']
+    assert client.dvm_cmd(cmd, d) == ['mpirun', '--dvm', 'file:/tmp/dvm_uri_x', '--machinefile', 'mf', '-np', '4', './a.out']
+    with pytest.raises(ValueError):
+        client.dvm_cmd(['./a.out'], d)
+
+
+def test_get_dvm(monkeypatch):
+    class Proc:
+        def poll(self):
+            return None
+
+    started = []
+
+    def start_dvm(sums):
+        started.append(sums)
+        return {'sums': tuple(sorted(sums.items())), 'proc': Proc()}
+
+    monkeypatch.setattr(client, 'start_dvm', start_dvm)
+    monkeypatch.setattr(client, 'stop_dvm', lambda: monkeypatch.setattr(client, 'dvm', None))
+    monkeypatch.setattr(client, 'dvm', None)
+    monkeypatch.setattr(client.atexit, 'register', lambda f: None)
+
+    first = client.get_dvm({'foo': 2, 'bar': 2})
+    assert client.get_dvm({'bar': 2, 'foo': 2}) is first, 'same hosts and slots reuse the dvm'
+    second = client.get_dvm({'foo': 4, 'bar': 2})
+    assert second is not first, 'changed slots on the same hosts restart the dvm'
+    assert started == [{'foo': 2, 'bar': 2}, {'foo': 4, 'bar': 2}]
+
+
+def test_machinefile_mpich():
+    me = socket.gethostname()
+    ret = {'lcores': 2,
+           'followers': [
+               {'fkey': 'foo_1', 'cores': 3},
+           ]}
+    for mpi in ('mpich', 'intelmpi'):
+        machinefile = client.machinefile_backends[mpi]({}, ret, 5, {'mpi': mpi})
+        assert machinefile == me+':2\nfoo:3\n'
+
+    machinefile = client.machinefile_mpich({}, ret, 5, {'mpi': 'mpich', 'placement': 'by-node'})
+    assert machinefile == me+':1\nfoo:1\n'+me+':1\nfoo:1\nfoo:1\n'
+
+    with pytest.raises(ValueError):
+        client.machinefile_mpich({}, ret, 6, {'mpi': 'mpich'})
+    with pytest.raises(ValueError):
+        client.machinefile_mpich({}, ret, 5, {'mpi': 'mpich', 'placement': 'nope'})
+
+
+def test_placement_mpirun_args(fs):  # pyfakefs
+    pset = {'run_args': 'mpirun --machinefile %MACHINEFILE% -np 2 ./a.out'}
+    ret = {'lcores': 1, 'followers': [{'fkey': 'foo_1', 'cores': 1}]}
+    prepared = client.leader_prepare_mpi(pset, ret, 2, {'mpi': 'openmpi', 'placement': 'by-node'})
+    assert prepared['cmd'][:3] == ['mpirun', '--map-by', 'node']
+    prepared = client.leader_prepare_mpi(pset, ret, 2, {'mpi': 'mpich', 'placement': 'by-node'})
+    assert prepared['cmd'][:2] == ['mpirun', '--machinefile'], 'hydra follows the machinefile order'
+
+    # slices of shared followers, without a rankfile, are not bound to the first cores
+    ret['followers'][0]['slots'] = ['0:1']
+    prepared = client.leader_prepare_mpi(pset, ret, 2, {'mpi': 'openmpi', 'placement': 'numa'})
+    assert prepared['cmd'][:5] == ['mpirun', '--map-by', 'numa', '--bind-to', 'none']
+
+
+def test_parse_cpulist():
+    assert client.parse_cpulist('0-3,8-9,12\n') == [0, 1, 2, 3, 8, 9, 12]
+    assert client.parse_cpulist('') == []
+
+
+def test_get_topology():
+    topology = client.get_topology()
+    cpus = [c for numa in topology['numa'] for c in numa]
+    assert sorted(cpus) == sorted(os.sched_getaffinity(0))
+    assert len(topology['slots']) == len(cpus)
+    assert sorted(topology['cpus'], key=int) == [str(c) for c in sorted(cpus)]
+
+
+def test_rankfile_openmpi():
+    me = socket.gethostname()
+    # 2 numa nodes with 2 cores each, cpus 4-7 are hyperthreads of 0-3
+    twosocket = {
+        'numa': [[0, 1, 4, 5], [2, 3, 6, 7]],
+        'slots': {'0': '0:0', '1': '0:1', '2': '1:0', '3': '1:1',
+                  '4': '0:0', '5': '0:1', '6': '1:0', '7': '1:1'},
+    }
+    ret = {'lcores': 1,
+           'followers': [{'fkey': 'foo_1', 'cores': 3, 'topology': twosocket}]}
+    leader = {'numa': [[0]], 'slots': {'0': '0:0'}}
+    rankfile = client.rankfile_openmpi(ret, leader)
+    assert rankfile == ('rank 0={} slot=0:0\n'
+                        'rank 1=foo slot=0:0\n'
+                        'rank 2=foo slot=0:1\n'
+                        'rank 3=foo slot=1:0\n').format(me)
+
+    # a slice of a shared follower binds to its own cores
+    ret['followers'][0].update(cores=2, slots=['2', '7'])
+    rankfile = client.rankfile_openmpi(ret, leader)
+    assert rankfile.endswith('rank 1=foo slot=1:0\n'
+                             'rank 2=foo slot=1:1\n')
+    del ret['followers'][0]['slots']
+
+    # two followers on one host, each bound to one socket, use the cores of their own socket
+    socket1 = {'numa': [[2, 3, 6, 7]], 'slots': {c: twosocket['slots'][c] for c in ('2', '3', '6', '7')}}
+    socket0 = {'numa': [[0, 1, 4, 5]], 'slots': {c: twosocket['slots'][c] for c in ('0', '1', '4', '5')}}
+    ret = {'lcores': 0,
+           'followers': [{'fkey': 'foo_1', 'cores': 2, 'topology': socket1},
+                         {'fkey': 'foo_2', 'cores': 2, 'topology': socket0}]}
+    assert client.rankfile_openmpi(ret, leader) == ('rank 0=foo slot=1:0\n'
+                                                    'rank 1=foo slot=1:1\n'
+                                                    'rank 2=foo slot=0:0\n'
+                                                    'rank 3=foo slot=0:1\n')
+    # unbound followers with overlapping masks still get distinct cores
+    ret['followers'][1]['topology'] = twosocket
+    assert client.rankfile_openmpi(ret, leader).endswith('rank 2=foo slot=0:0\n'
+                                                         'rank 3=foo slot=0:1\n')
+    ret['followers'][1]['topology'] = socket1
+    ret['followers'][1]['cores'] = 3
+    with pytest.raises(ValueError):
+        client.rankfile_openmpi(ret, leader)
+
+    # ncores counting hyperthreads fills every physical core, then their siblings
+    ret = {'lcores': 0,
+           'followers': [{'fkey': 'foo_1', 'cores': 6, 'topology': twosocket}]}
+    assert client.rankfile_openmpi(ret, leader) == ('rank 0=foo slot=0:0\n'
+                                                    'rank 1=foo slot=0:1\n'
+                                                    'rank 2=foo slot=1:0\n'
+                                                    'rank 3=foo slot=1:1\n'
+                                                    'rank 4=foo slot=0:0\n'
+                                                    'rank 5=foo slot=0:1\n')
+
+    ret = {'lcores': 1,
+           'followers': [{'fkey': 'foo_1', 'cores': 9, 'topology': twosocket}]}
+    with pytest.raises(ValueError):
+        client.rankfile_openmpi(ret, leader)
+    del ret['followers'][0]['topology']
+    ret['followers'][0]['cores'] = 1
+    with pytest.raises(ValueError):
+        client.rankfile_openmpi(ret, leader)
+
+
+def test_layout(fs):  # pyfakefs
+    me = socket.gethostname()
+    sums = {me: 2, 'foo': 4, 'bar': 4}
+    layout = {
+        'roles': [
+            {'name': 'io', 'count': 1, 'on': 'leader', 'threads': 2},
+            {'name': 'reader', 'count': 2, 'spread': True, 'threads': 2},
+            {'name': 'worker', 'count': 'rest', 'threads': 1},
+        ],
+        'threads': 'job.threads',
+    }
+    machinefile, threadfile = client.layout_machinefile(layout, dict(sums))
+    assert machinefile == '{}\nfoo\nbar\nfoo\nfoo\nbar\nbar\n'.format(me)
+    assert threadfile == ''
+
+    user_kwargs = {'mpi': 'mpich', 'layout': layout}
+    ret = {'lcores': 2, 'followers': [{'fkey': 'foo_1', 'cores': 4}, {'fkey': 'bar_1', 'cores': 4}]}
+    assert client.machinefile_mpich({}, ret, 10, user_kwargs) == machinefile
+    assert os.path.exists('job.threads')
+
+    layout['roles'][1]['count'] = 5
+    with pytest.raises(ValueError):
+        client.layout_machinefile(layout, dict(sums))
+
+    assert client.layout_wanted_cores(layout) is None
+    fixed = {'roles': [{'count': 1, 'on': 'leader'}, {'count': 4, 'threads': 2}]}
+    assert client.layout_wanted_cores(fixed) == 9
+    assert client.wanted_cores({}, {'layout': fixed}) == 9
+    assert client.wanted_cores({'wanted': 3}, {'layout': fixed}) == 3
+    with pytest.raises(ValueError):
+        client.wanted_cores({}, {'layout': 'DiFX', 'DiFX_datastreams': 2})
+
+
+def test_google_mount_reuse(monkeypatch, tmpdir):
+    calls = []
+    mounted = set()
+    mountpoint = str(tmpdir.join('bucket'))
+    monkeypatch.setattr(client.shutil, 'which', lambda exe: '/usr/bin/' + exe)
+    monkeypatch.setattr(client.subprocess, 'call', lambda cmd: calls.append(cmd) or mounted.add(cmd[-1]) or 0)
+    monkeypatch.setattr(client.os.path, 'ismount', lambda d: d in mounted)
+    client.mounts.clear()
+
+    client.do_google_mount('bucket1', mountpoint)
+    client.do_google_mount('bucket1', mountpoint)
+    assert calls == [['/usr/bin/gcsfuse', '--implicit-dirs', 'bucket1', mountpoint]], 'mounted once'
+    assert client.local_datasets() == ['bucket1']
+
+    client.mounts.clear()
+    client.do_google_mount('bucket1', mountpoint)
+    assert len(calls) == 1, 'mount made by another worker on this host is reused'
+    client.mounts.clear()
+
+
+def test_elastic_job():
+    pset = {'wanted': 3, 'max_cores': 7, 'phases': ['mpirun -np %NP% ./a', 'mpirun -np %NP% ./b']}
+    job = client.leader_job(pset, {}, '')
+    assert job == {'max_cores': 7, 'malleable': True, 'run_args': 'mpirun -np %NP% ./a ; mpirun -np %NP% ./b'}
+    assert client.wanted_cores(dict(pset, min_cores=2), {}) == 2
+
+    ret = {'lcores': 1, 'followers': [{'fkey': 'a_1', 'cores': 2, 'state': 'running'},
+                                      {'fkey': 'b_2', 'cores': 2, 'state': 'assigned'}]}
+    ready = client.ready_followers(ret)
+    assert [f['fkey'] for f in ready['followers']] == ['a_1']
+    assert client.job_cores(ready, 3, job) == 3
+    assert client.job_cores(ret, 3, job) == 5
+    assert client.job_cores(ret, 3, {}) == 3
+
+
+def test_wait_for_ready():
+    r, w = os.pipe()
+    os.write(w, b'ready\n')
+    assert client.wait_for_ready(r, timeout=1.0)
+    os.close(w)
+
+    r, w = os.pipe()
+    os.close(w)  # server exited without becoming ready
+    assert not client.wait_for_ready(r, timeout=1.0)
+
+
+def test_embedded_server():
+    user_kwargs = {}
+    thread = client.start_multimpi_server(user_kwargs=user_kwargs, mode='embedded')
+    try:
+        assert user_kwargs['multimpi_server_url'].startswith('http+unix://')
+        assert client.hello_world() == 'pass'
+        assert client.follower_checkin(1, 'available', 0)['result'] is None
+    finally:
+        client.end_multimpi_server()
+    assert not thread.is_alive()
+    assert client.hello_world() != 'pass'
+
+
+def test_choose_url(tmp_path):
+    path = str(tmp_path / 'server.sock')
+    open(path, 'w').close()
+    local = {'multimpi_server_url': 'http://localhost:8889/jsonrpc', 'multimpi_server_socket': path}
+    assert client.choose_url(local) == client.unix_url(path)
+    here = dict(local, multimpi_server_url='http://{}.example.com:8889/jsonrpc'.format(socket.gethostname()))
+    assert client.choose_url(here) == client.unix_url(path)
+
+    remote = dict(local, multimpi_server_url='http://elsewhere.example.com:8889/jsonrpc')
+    assert client.choose_url(remote) == remote['multimpi_server_url']
+    missing = dict(local, multimpi_server_socket=str(tmp_path / 'other.sock'))
+    assert client.choose_url(missing) == local['multimpi_server_url']
+    assert client.choose_url({'multimpi_server_url': 'http://localhost:8889/jsonrpc'}) == 'http://localhost:8889/jsonrpc'
+
+
+def test_worker_startup():
+    # every worker imports the client before it knows if it is a leader or a follower
+    # a fresh interpreter, so nothing is already imported. The budget is generous because
+    # a cold import on shared CI varies a lot. The module list below catches smaller regressions
+    code = ('import time, sys; t0 = time.time(); import paramsurvey_multimpi.client; '
+            'print(time.time() - t0); print(" ".join(sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                         universal_newlines=True).stdout.split('\n')
+    elapsed, modules = float(out[0]), set(out[1].split())
+    print('import of paramsurvey_multimpi.client took {:.3f}s'.format(elapsed))
+    assert elapsed < 2.0, 'import of paramsurvey_multimpi.client took {:.3f}s'.format(elapsed)
+    for heavy in ('requests', 'urllib3', 'aiohttp', 'concurrent.futures', 'paramsurvey_multimpi.server'):
+        assert heavy not in modules, heavy+' is imported on the worker hot path'
+
+
+def test_format_progress():
+    stats = {'jobs': {'running': 2, 'scheduled': 1, 'waiting': 4}, 'jobs_finished': 7, 'jobs_failed': 1, 'jobs_retried': 2,
+             'cores': {'busy': 12, 'idle': 3}, 'queue_wait': {'p50': 1.5, 'p90': 9.0, 'n': 10},
+             'failures': 1, 'recent_failures': ['job 3 mpirun exited with status 1']}
+    line = client.format_progress(stats)
+    assert 'jobs running 3 waiting 4 finished 7 (failed 1, retried 2)' in line
+    assert 'cores busy 12 idle 3' in line
+    assert 'p50 1.5s p90 9.0s' in line
+    assert line.endswith('failures 1, last: job 3 mpirun exited with status 1')
+
+
+def test_rpc_connection_per_thread():
+    old_url = client.url
+    client.url = 'http://localhost:1/jsonrpc'
+    try:
+        conn = client.rpc_connection()
+        assert client.rpc_connection() is conn, 'kept alive'
+        other = []
+        t = threading.Thread(target=lambda: other.append(client.rpc_connection()))
+        t.start()
+        t.join()
+        assert other[0] is not conn
+        assert client.rpc_connection() is conn, 'another thread does not replace ours'
+    finally:
+        client.url = old_url
+
+
+def test_upload_outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    with open('out1.dat', 'wb') as f:
+        f.write(b'x' * 100)
+    dest = str(tmp_path / 'bucket')
+
+    assert client.upload_outputs({}, {}) is None
+    ret = client.upload_outputs({'upload_outputs': ['out*.dat']}, {'upload_dest': dest})
+    assert ret['state'] == 'done', 'waits for the upload by default'
+    assert [os.path.basename(p) for p in ret['files']] == ['out1.dat']
+    assert os.path.exists(os.path.join(dest, 'out1.dat'))
+
+    ret = client.upload_outputs({'upload_outputs': ['out1.dat']}, {'upload_dest': str(tmp_path / 'out1.dat' / 'notadir')})
+    assert ret['state'] == 'failed'
+
+    from paramsurvey_multimpi import upload
+    upload.wait()
+    ret = client.upload_outputs({'upload_outputs': ['out1.dat']}, {'upload_dest': dest, 'upload_wait': False})
+    assert ret == {'state': 'pending'}
+    assert upload.wait() == []
+
+
+def test_in_background():
+    event = threading.Event()
+    background = client.in_background(event.wait)
+    assert not client.background_done(background), 'still running'
+    event.set()
+    background[0].join()
+    assert client.background_done(background)
+    assert background[1]['value'] is True
+
+    background = client.in_background(int, 'not a number')
+    background[0].join()
+    with pytest.raises(ValueError):
+        client.background_done(background)
+
+
+def test_release_finished(monkeypatch):
+    released = []
+    monkeypatch.setattr(client, 'release_staged', released.append)
+    staged = {'l1': '/s/x', 'l2': '/s/x', 'l3': '/s/y'}
+    client.release_finished(staged, {'l2', 'l3'})
+    assert staged == {'l2': '/s/x', 'l3': '/s/y'}
+    assert released == [], 'a staged directory still used by another job keeps its lease'
+    client.release_finished(staged, {'l3'})
+    assert released == ['/s/x']
+    client.release_finished(staged, set())
+    assert released == ['/s/x', '/s/y'] and staged == {}
+
+
+def test_leader_attempt_exit_checkin(monkeypatch):
+    checkins = []
+
+    def leader_checkin(cores, wanted, pubkey, state, lseq, status=None, job=None, priority=False):
+        checkins.append((state, job.get('final')))
+        return {'result': {'state': 'exiting'}}
+
+    monkeypatch.setattr(client, 'leader_checkin', leader_checkin)
+    pset = {'ncores': 1, 'wanted': 2, 'run_args': './a.out'}
+    completed = subprocess.CompletedProcess(args=None, returncode=1)
+
+    # stopped because the server sent us back to waiting
+    monkeypatch.setattr(client, 'leader_run', lambda *args: (completed, True, False))
+    assert client.leader_attempt(pset, {}, None, 0, last_attempt=False) == (completed, True)
+    assert client.leader_attempt(pset, {}, None, 0, last_attempt=True) == (completed, True)
+    assert checkins == [('exiting', False), ('exiting', True)], 'the last attempt is final'
+
+    def broken(*args):
+        raise ValueError('mpirun failed to start')
+
+    monkeypatch.setattr(client, 'leader_run', broken)
+    with pytest.raises(ValueError):
+        client.leader_attempt(pset, {}, None, 0, last_attempt=False)
+    assert checkins[-1] == ('exiting', True)
+
+    # leader_run already told the server
+    monkeypatch.setattr(client, 'leader_run', lambda *args: (completed, True, True))
+    client.leader_attempt(pset, {}, None, 0)
+    assert len(checkins) == 3
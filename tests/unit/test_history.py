@@ -0,0 +1,81 @@
+import os
+import json
+import threading
+
+from paramsurvey_multimpi import history
+
+
+def test_normalize():
+    assert history.normalize('mpirun  -np 4 ./a.out out_0012.dat') == 'mpirun -np 4 ./a.out out_#.dat'
+    assert history.normalize('./a.out -n 1000') != history.normalize('./a.out -n 10')
+    assert history.history_key('./a.out run7', 4) == history.history_key('./a.out run8', 4, 4)
+    assert history.history_key('./a.out', 4) != history.history_key('./a.out', 8)
+
+
+def test_record_and_estimate(tmp_path):
+    history.clear()
+    path = str(tmp_path / 'history.json')
+    history.load(path)
+    assert history.estimate('a') is None
+    for wall in (5, 1, 3, 2, 4, 10, 6, 7, 8, 9):
+        history.record('a', wall)
+    assert history.estimate('a') == 6
+    assert history.estimate('a', quantile=0.9) == 10
+
+    history.save()
+    with open(path) as f:
+        assert json.load(f)['a'] == [5, 1, 3, 2, 4, 10, 6, 7, 8, 9]
+    history.clear()
+    history.load(path)
+    assert history.estimate('a') == 6, 'history survives a restart'
+    history.clear()
+
+
+def test_lru(monkeypatch):
+    history.clear()
+    monkeypatch.setattr(history, 'max_entries', 2)
+    monkeypatch.setattr(history, 'max_samples', 3)
+    history.record('a', 1)
+    history.record('b', 1)
+    history.estimate('a')  # a is now used more recently than b
+    history.record('c', 1)
+    assert list(history.entries) == ['a', 'c']
+    for wall in (1, 2, 3, 4):
+        history.record('a', wall)
+    assert history.entries['a'] == [2, 3, 4]
+    history.clear()
+
+
+def test_unwritable(tmp_path):
+    history.clear()
+    path = tmp_path / 'history.json'
+    path.mkdir()  # reading and writing a directory both fail with an OSError
+    history.load(str(path))
+    history.record('a', 1)
+    history.save()
+    assert history.estimate('a') == 1
+    assert os.listdir(str(tmp_path)) == ['history.json'], 'no partial file left behind'
+    history.clear()
+
+
+def test_final_save_waits_for_background(tmp_path, monkeypatch):
+    history.clear()
+    path = str(tmp_path / 'history.json')
+    history.load(path)
+    event = threading.Event()
+    write = history.write
+
+    def slow_write(history_file, text):
+        event.wait()
+        write(history_file, text)
+
+    monkeypatch.setattr(history, 'write', slow_write)
+    history.record('a', 1)
+    history.save(background=True)
+    history.record('a', 2)
+    threading.Timer(0.1, event.set).start()
+    history.save()
+    assert not history.saver.is_alive()
+    with open(path) as f:
+        assert json.load(f)['a'] == [1, 2], 'the older background write did not land last'
+    history.clear()
@@ -0,0 +1,36 @@
+import pytest
+
+from paramsurvey_multimpi import planner
+
+
+def test_worker_cores():
+    assert planner.worker_cores(32, [16, 16]) == 16
+    assert planner.worker_cores(20, [16, 16]) == 4, 'no wasted cores, then fewest workers'
+    assert planner.worker_cores(3, [16]) == 3, 'small job in one worker'
+    assert planner.worker_cores(3, [2, 16]) == 1
+    assert planner.worker_cores(24, [16, 8]) == 8, 'tiles both node sizes'
+    assert planner.worker_cores(24, [16, 12]) == 4
+    assert planner.worker_cores(4, [16], backend='multiprocessing') == 1
+    assert planner.worker_cores(32, [16, 16, 15]) == 16, 'mixed sizes with gcd 1 plan for the common size'
+
+
+def test_node_sizes(monkeypatch):
+    import paramsurvey
+    monkeypatch.setattr(paramsurvey, 'current_resources', lambda: [{'memory': 1}, {'num_cores': 0}, {'num_cores': 8}])
+    assert planner.node_sizes() == [8]
+
+
+def test_plan():
+    jobs = [{'run_args': 'mpirun ./a.out', 'wanted': 20}, {'run_args': 'mpirun ./b.out', 'wanted': 3}]
+    psets = planner.plan(jobs, sizes=[16, 16], backend='ray')
+    assert [(p['kind'], p['ncores']) for p in psets] == [('leader', 4)] + [('follower', 4)] * 4 + [('leader', 3)]
+    assert psets[0]['run_args'] == 'mpirun ./a.out'
+    assert psets[0]['wanted'] == 20
+    assert all(p['ray'] == {'num_cores': p['ncores']} for p in psets)
+
+    psets = planner.plan([{'wanted': 2, 'max_cores': 4}], sizes=[4], backend='multiprocessing')
+    assert [(p['kind'], p['ncores']) for p in psets] == [('leader', 1)] + [('follower', 1)] * 3
+    assert 'ray' not in psets[0]
+
+    with pytest.raises(ValueError):
+        planner.plan([{'wanted': 40}], sizes=[16, 16], backend='ray')
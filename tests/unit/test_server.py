@@ -1,5 +1,13 @@
 from functools import partial
+from collections import defaultdict
+import asyncio
+import time
 
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request, TestClient, TestServer
+import aiohttp_rpc
+
+from paramsurvey_multimpi import server
 from paramsurvey_multimpi.server import leader_checkin, follower_checkin, clear
 
 
@@ -96,3 +104,627 @@ def test_leadfollow():
     assert 'leader' in ret
     assert 'pubkey' in ret
     assert ret['state'] == 'assigned'
+
+
+def test_host_failures():
+    clear()
+    lseq = 0
+    fseq = 0
+
+    bad = partial(follower_checkin, 'badhost', 1, 101)
+    good = partial(follower_checkin, 'goodhost', 1, 102)
+
+    assert not bad('available', fseq)
+    assert not good('available', fseq)
+
+    l = partial(leader_checkin, 'localhost', 1, 100, 2, 'pubkey')
+    for status in (1, 255):
+        ret = l('waiting', lseq)
+        assert [f['fkey'] for f in ret['followers']] == ['badhost_101'], 'first follower is picked when no host has failed'
+        assert bad('available', fseq)['state'] == 'assigned'
+        assert l('waiting', lseq)['state'] == 'running'
+        assert l('exiting', lseq, status=status)['state'] == 'exiting'
+        if status == 1:
+            assert not server.host_failures, 'the job failing is not a node failure'
+        # leader requeues with a new sequence number, followers come back
+        lseq += 1
+        fseq += 1
+        assert not bad('available', fseq)
+    assert len(server.host_failures['badhost']) == 1
+    assert 'localhost' not in server.host_failures, 'the leader host is not blamed'
+    assert 'goodhost' not in server.host_failures
+
+    ret = l('waiting', lseq)
+    assert [f['fkey'] for f in ret['followers']] == ['goodhost_102'], 'host without failures is preferred'
+
+    # with a limit, a failing host is avoided while other hosts can run the job
+    clear()
+    server.set_host_failure_limit(1)
+    server.host_failures['badhost'] = [time.time()]
+    assert not good('available', fseq)
+    other = partial(leader_checkin, 'localhost', 1, 200, 2, 'pubkey')
+    assert len(other('waiting', 0)['followers']) == 1
+    assert good('available', fseq)['state'] == 'assigned'
+    assert not bad('available', fseq)
+    assert not l('waiting', lseq), 'avoided host is not scheduled'
+
+    server.host_failures['badhost'] = [time.time() - server.host_failure_decay - 1]
+    ret = l('waiting', lseq)
+    assert [f['fkey'] for f in ret['followers']] == ['badhost_101'], 'old failures decay'
+
+    clear()
+    server.host_failures['badhost'] = [time.time()]
+    assert not bad('available', fseq)
+    ret = l('waiting', lseq)
+    assert [f['fkey'] for f in ret['followers']] == ['badhost_101'], 'unless no other host could ever run the job'
+    server.set_host_failure_limit(None)
+
+
+def test_persistent_follower():
+    clear()
+    fseq = 0
+    info = {'persistent': True}
+
+    f = partial(follower_checkin, 'localhost', 1, 101)
+    assert not f('available', fseq, info=info)
+
+    for lseq, lpid in enumerate((100, 102)):
+        l = partial(leader_checkin, 'localhost', 1, lpid, 2, 'pubkey')
+        ret = l('waiting', lseq)
+        assert len(ret['followers']) == 1, 'leader {} gets the persistent follower'.format(lpid)
+        ret = f('available', fseq, info=info)
+        assert ret['state'] == 'assigned'
+        assert l('waiting', lseq)['state'] == 'running'
+        assert f('assigned', fseq, info=info)['state'] == 'assigned'
+
+        assert l('exiting', lseq, status=0)['state'] == 'exiting'
+        ret = f('assigned', fseq, info=info)
+        assert ret['state'] == 'available', 'persistent follower returns to the pool'
+        assert not f('available', fseq, info=info)
+
+    server.drain()
+    ret = f('available', fseq, info=info)
+    assert ret['state'] == 'exiting', 'drained pool tells persistent followers to exit'
+
+
+def test_persistent_follower_idle():
+    clear()
+    info = {'persistent': True, 'idle_timeout': 0}
+    f = partial(follower_checkin, 'localhost', 1, 101)
+    assert not f('available', 0, info=info), 'no leader seen yet, keep waiting'
+
+    assert not leader_checkin('localhost', 1, 100, 3, 'pubkey', 'waiting', 0), 'too few cores to schedule'
+    server.last_leader_t -= 1
+    ret = f('available', 0, info=info)
+    assert ret['state'] == 'exiting', 'no leader checkins for idle_timeout drains the pool'
+
+    clear()
+    assert not f('available', 0, info=info)
+    server.pool_start_t -= server.no_leader_timeout + 1
+    ret = f('available', 0, info=info)
+    assert ret['state'] == 'exiting', 'no leader ever checking in does not keep the pool forever'
+
+
+def test_persistent_follower_survey():
+    clear()
+    server.drain()
+    server.start_survey(2)
+    info = {'persistent': True}
+    f = partial(follower_checkin, 'localhost', 1, 101)
+    assert not f('available', 0, info=info), 'start_survey undoes the drain of the last survey'
+
+    for lseq, lpid in enumerate((100, 102)):
+        l = partial(leader_checkin, 'localhost', 1, lpid, 2, 'pubkey')
+        assert len(l('waiting', 0)['followers']) == 1
+        assert f('available', 0, info=info)['state'] == 'assigned'
+        assert l('waiting', 0)['state'] == 'running'
+        if lpid == 100:
+            assert l('exiting', 0, status=1, job={'final': False})['state'] == 'exiting'
+            assert f('assigned', 0, info=info)['state'] == 'available', 'a leader that retries is not done'
+            l = partial(leader_checkin, 'localhost', 1, lpid, 2, 'pubkey')
+            assert len(l('waiting', 1)['followers']) == 1
+            assert f('available', 0, info=info)['state'] == 'assigned'
+            assert l('waiting', 1)['state'] == 'running'
+            assert l('exiting', 1, status=0, job={'final': True})['state'] == 'exiting'
+            assert f('assigned', 0, info=info)['state'] == 'available'
+        else:
+            assert l('exiting', 0, status=0, job={'final': True})['state'] == 'exiting'
+            ret = f('assigned', 0, info=info)
+            assert ret['state'] == 'exiting', 'the last leader of the survey drains the pool without an idle wait'
+
+    server.drain()
+    leader_checkin('localhost', 1, 103, 2, 'pubkey', 'waiting', 0)
+    assert not server.draining, 'a new leader means a new survey'
+
+
+def test_pubkey_once_per_host():
+    clear()
+    f1 = partial(follower_checkin, 'otherhost', 1, 101)
+    f2 = partial(follower_checkin, 'otherhost', 1, 102)
+    assert not f1('available', 0)
+    assert not f2('available', 0)
+
+    l = partial(leader_checkin, 'localhost', 1, 100, 3, 'pubkey')
+    ret = l('waiting', 0, job={'fingerprint': 'SHA256:abc'})
+    assert len(ret['followers']) == 2
+
+    ret = f1('available', 0)
+    assert ret['pubkey'] == 'pubkey', 'first follower on a host gets the key'
+    assert ret['fingerprint'] == 'SHA256:abc'
+    ret = f2('available', 0)
+    assert 'pubkey' not in ret, 'second follower on the host only gets the fingerprint'
+    assert ret['fingerprint'] == 'SHA256:abc'
+
+
+def test_topology_passthrough():
+    clear()
+    topology = {'numa': [[0, 1]], 'slots': {'0': '0:0', '1': '0:1'}}
+    assert not follower_checkin('otherhost', 2, 101, 'available', 0, info={'topology': topology})
+    ret = leader_checkin('localhost', 1, 100, 3, 'pubkey', 'waiting', 0)
+    assert ret['followers'][0]['topology'] == topology
+
+
+def test_requires():
+    clear()
+    GB = 1000000000
+    small = partial(follower_checkin, 'small', 2, 101)
+    big = partial(follower_checkin, 'big', 2, 102)
+    assert not small('available', 0, info={'resources': {'memory': 4*GB, 'scratch': 0, 'labels': []}})
+    assert not big('available', 0, info={'resources': {'memory': 64*GB, 'scratch': 500*GB, 'labels': ['ssd']}})
+
+    l = partial(leader_checkin, 'localhost', 1, 100, 3, 'pubkey')
+    ret = l('waiting', 0, job={'requires': {'memory': 32*GB}})
+    assert [f['fkey'] for f in ret['followers']] == ['big_102'], 'small-memory node skipped'
+
+    clear()
+    assert not small('available', 0, info={'resources': {'memory': 4*GB, 'scratch': 0, 'labels': []}})
+    ret = l('waiting', 0, job={'requires': {'labels': ['ssd']}})
+    assert not ret, 'no follower has the label'
+
+    clear()
+    f1 = partial(follower_checkin, 'a', 2, 101)
+    f2 = partial(follower_checkin, 'a', 2, 102)
+    f3 = partial(follower_checkin, 'b', 2, 103)
+    for f in (f1, f2, f3):
+        assert not f('available', 0)
+    ret = l('waiting', 0, job={'requires': {'min_nodes': 3}})
+    assert [f['fkey'] for f in ret['followers']] == ['a_101', 'b_103'], 'spread over 3 nodes including the leader'
+
+    clear()
+    for f in (f1, f2, f3):
+        assert not f('available', 0)
+    l = partial(leader_checkin, 'localhost', 1, 100, 5, 'pubkey')
+    ret = l('waiting', 0, job={'requires': {'max_nodes': 2}})
+    assert [f['fkey'] for f in ret['followers']] == ['a_101', 'a_102'], 'stays on 2 nodes including the leader'
+
+    clear()
+    assert not l('waiting', 0, job={'requires': {'min_nodes': 2}}), 'no followers, cannot reach min_nodes'
+
+
+def test_datasets_and_mounts():
+    clear()
+    cold = partial(follower_checkin, 'cold', 1, 101)
+    warm = partial(follower_checkin, 'warm', 1, 102)
+    assert not cold('available', 0, info={'datasets': []})
+    assert not warm('available', 0, info={'datasets': ['bucket1']})
+
+    l = partial(leader_checkin, 'localhost', 1, 100, 2, 'pubkey')
+    job = {'datasets': ['bucket1'], 'mounts': [['bucket1', '/mnt/bucket1']]}
+    ret = l('waiting', 0, job=job)
+    assert [f['fkey'] for f in ret['followers']] == ['warm_102'], 'follower with warm data preferred'
+
+    ret = warm('available', 0)
+    assert ret['state'] == 'assigned'
+    assert ret['mounts'] == [['bucket1', '/mnt/bucket1']]
+    assert server.followers['warm_102']['state'] == 'preparing'
+    assert l('waiting', 0)['state'] == 'scheduled', 'job waits for the follower to mount'
+
+    assert warm('assigned', 0)['state'] == 'assigned'
+    assert server.followers['warm_102']['state'] == 'running'
+    assert l('waiting', 0)['state'] == 'running'
+
+
+def test_stage_inputs():
+    clear()
+    f = partial(follower_checkin, 'localhost', 1, 101)
+    assert not f('available', 0)
+
+    l = partial(leader_checkin, 'localhost', 1, 100, 2, 'pubkey')
+    stage = {'inputs': ['/mnt/bucket1/a'], 'staging_dir': None, 'max_bytes': None}
+    assert l('waiting', 0, job={'stage': stage})
+
+    ret = f('available', 0)
+    assert ret['stage'] == stage
+    assert 'mounts' not in ret
+    assert server.followers['localhost_101']['state'] == 'preparing'
+    for _ in range(3):
+        assert f('preparing', 0)['state'] == 'preparing', 'follower keeps checking in while it stages'
+    assert l('waiting', 0)['state'] == 'scheduled'
+    assert f('assigned', 0)['state'] == 'assigned'
+    assert server.followers['localhost_101']['state'] == 'running'
+
+
+def test_release_at_leader_exit():
+    clear()
+    info = {'persistent': True}
+    f = partial(follower_checkin, 'localhost', 1, 101)
+    assert not f('available', 0, info=info)
+
+    l = partial(leader_checkin, 'localhost', 1, 100, 2, 'pubkey')
+    assert l('waiting', 0)
+    assert f('available', 0, info=info)['state'] == 'assigned'
+    assert l('waiting', 0)['state'] == 'running'
+
+    l('exiting', 0, status=0)
+    assert server.followers['localhost_101']['state'] == 'available', 'released before its next checkin'
+
+    l2 = partial(leader_checkin, 'localhost', 1, 102, 2, 'pubkey')
+    assert len(l2('waiting', 0)['followers']) == 1
+    ret = f('assigned', 0, info=info)
+    assert ret['state'] == 'assigned'
+    assert ret['leader'] == 'localhost_102', 'follower still running the old job gets the new schedule'
+    assert l2('waiting', 0)['state'] == 'running'
+
+
+def test_elastic():
+    clear()
+    f1 = partial(follower_checkin, 'host1', 2, 101)
+    f2 = partial(follower_checkin, 'host2', 2, 102)
+    f3 = partial(follower_checkin, 'host3', 2, 103)
+    assert not f1('available', 0)
+    assert not f2('available', 0)
+
+    l = partial(leader_checkin, 'localhost', 1, 100, 3, 'pubkey')
+    ret = l('waiting', 0, job={'max_cores': 7, 'malleable': True})
+    assert [f['fkey'] for f in ret['followers']] == ['host1_101', 'host2_102'], 'takes more than min_cores when available'
+    f1('available', 0)
+    f2('available', 0)
+    assert l('waiting', 0)['state'] == 'running'
+
+    assert not f3('available', 0)
+    ret = l('running', 0, job={'phases_left': 0})
+    assert len(ret['followers']) == 2, 'no growing in the last phase'
+    ret = l('running', 0, job={'phases_left': 1})
+    assert [(f['fkey'], f['state']) for f in ret['followers']][-1] == ('host3_103', 'assigned'), 'grows up to max_cores'
+    assert f3('available', 0)['state'] == 'assigned'
+    ret = l('running', 0, job={'phases_left': 1})
+    assert ret['state'] == 'running'
+    assert all(f['state'] == 'running' for f in ret['followers'])
+
+    l('exiting', 0, status=0)
+    assert server.followers['host3_103']['state'] == 'exiting'
+
+    clear()
+    assert not f1('available', 0)
+    ret = l('waiting', 0, job={'max_cores': 7})
+    assert len(ret['followers']) == 1, 'starts with min_cores when the cluster is busy'
+
+
+def test_reservations():
+    clear()
+    f1 = partial(follower_checkin, 'host1', 1, 101)
+    f2 = partial(follower_checkin, 'host2', 1, 102)
+    f3 = partial(follower_checkin, 'host3', 1, 103)
+    assert not f1('available', 0)
+    assert not f2('available', 0)
+
+    big = partial(leader_checkin, 'localhost', 1, 100, 4, 'pubkey')
+    small = partial(leader_checkin, 'localhost', 1, 200, 3, 'pubkey')
+    assert not big('waiting', 0)
+    assert server.followers['host1_101']['state'] == 'reserved'
+    assert not f1('available', 0), 'reserved follower stays reserved'
+    assert not small('waiting', 0), 'followers held for the leader that has waited longest'
+
+    assert not f3('available', 0)
+    ret = big('waiting', 0)
+    assert len(ret['followers']) == 3
+    assert server.reservation_stats['used'] == 2
+    assert server.reservation_hit_rate() == '100%'
+
+    clear()
+    server.reservation_timeout = 0
+    try:
+        assert not f1('available', 0)
+        assert not f2('available', 0)
+        assert not big('waiting', 0)
+        ret = small('waiting', 0)
+        assert len(ret['followers']) == 2, 'reservation expired, so the next leader gets the followers'
+        assert server.reservation_stats['expired'] == 2
+        assert server.head_of_queue() == 'localhost_100'
+    finally:
+        server.reservation_timeout = 30
+
+
+def test_trace():
+    clear()
+    server.start_trace()
+    f = partial(follower_checkin, 'localhost', 1, 101)
+    l = partial(leader_checkin, 'localhost', 1, 100, 2, 'pubkey')
+    assert not f('available', 0)
+    assert l('waiting', 0)
+    f('available', 0)
+    assert l('waiting', 0)['state'] == 'running'
+    server.add_trace('localhost', 100, 'leader', [['mpirun', 1.0, 2.0]])
+
+    events = server.trace()['traceEvents']
+    threads = dict(((e['pid'], e['tid']), e['args']['name']) for e in events if e['name'] == 'thread_name')
+    spans = [(threads[(e['pid'], e['tid'])], e['name']) for e in events if e['ph'] == 'X']
+    assert ('leader localhost_100', 'scheduled') in spans
+    assert ('leader localhost_100', 'running') in spans
+    assert ('follower localhost_101', 'assigned') in spans, 'follower transition during the leader checkin'
+    assert ('leader 100', 'mpirun') in spans
+    mpirun = [e for e in events if e['name'] == 'mpirun'][0]
+    assert mpirun['ts'] == 1000000 and mpirun['dur'] == 1000000
+
+
+def test_admission():
+    async def handler(request):
+        return web.json_response({'result': 'ok'})
+
+    def call(priority=None):
+        headers = {'X-Multimpi-Priority': priority} if priority else {}
+        request = make_mocked_request('POST', '/jsonrpc', headers=headers)
+        return asyncio.run(server.admission(request, handler))
+
+    assert call().status == 200
+
+    old = server.loop_lag
+    server.loop_lag = server.admission_lag
+    try:
+        ret = call()
+        assert ret.status == 503
+        assert float(ret.headers['Retry-After']) == server.admission_retry_after
+        assert call('running').status == 200, 'running jobs are still admitted'
+        server.loop_lag = server.admission_lag_running
+        assert call('running').status == 503
+    finally:
+        server.loop_lag = old
+    assert server.admission_stats['rejected'] >= 1
+    assert server.admission_stats['rejected_running'] >= 1
+
+
+def test_admission_under_load(monkeypatch):
+    # checkins that hog the event loop, as many thousands of them would
+    def slow_checkin():
+        time.sleep(0.05)
+        return {'ok': True}
+
+    monkeypatch.setattr(server, 'admission_lag', 0.2)
+    monkeypatch.setattr(server, 'admission_stats', defaultdict(int))
+
+    async def survey():
+        app = server.make_app()
+        aiohttp_rpc.rpc_server.add_methods([slow_checkin], replace=True)
+        async with TestClient(TestServer(app)) as http:
+            async def post():
+                payload = {'method': 'slow_checkin', 'params': [], 'jsonrpc': '2.0', 'id': 0}
+                return (await http.post('/jsonrpc', json=payload)).status
+
+            statuses = await asyncio.gather(*[post() for _ in range(40)])
+            await asyncio.sleep(0.5)  # the loop catches up
+            after = await post()
+        return statuses, after
+
+    statuses, after = asyncio.run(survey())
+    assert statuses.count(200) >= 4, 'requests are admitted until the loop falls behind'
+    assert statuses.count(503) >= 10, 'then new arrivals are told to retry later'
+    assert after == 200
+    assert server.admission_stats['rejected'] == statuses.count(503)
+
+
+def test_runtime_history():
+    clear()
+    lead = partial(leader_checkin, 'localhost', 1, 100, 1, 'pubkey')
+    job = {'run_args': './a.out out_1.dat'}
+    assert lead('waiting', 0, job=job)['state'] == 'running'
+    assert lead('exiting', 0, job=dict(job, wall=12.5))['state'] == 'exiting'
+    k = server.history.history_key('./a.out out_2.dat', 1)
+    assert server.history.estimate(k) == 12.5
+
+    # shortest job first, unless the long one has waited longer than its runtime
+    server.history.record(server.history.history_key('./a.out out_1.dat', 4), 12.5)
+    assert not leader_checkin('localhost', 1, 200, 4, 'pubkey', 'waiting', 0, job={'run_args': './a.out out_2.dat'})
+    assert server.leaders['localhost_200']['estimate'] == 12.5
+    assert not leader_checkin('localhost', 1, 300, 4, 'pubkey', 'waiting', 0, job={'run_args': './b.out'})
+    assert server.head_of_queue() == 'localhost_300'
+    server.leaders['localhost_200']['queued_t'] -= 20
+    assert server.head_of_queue() == 'localhost_200'
+    server.queue_order = 'fifo'
+    server.leaders['localhost_200']['queued_t'] += 20
+    try:
+        assert server.head_of_queue() == 'localhost_200'
+    finally:
+        server.queue_order = 'sjf'
+    clear()
+
+
+def test_stats():
+    clear()
+    assert not follower_checkin('host1', 4, 101, 'available', 0)
+    assert not follower_checkin('host2', 4, 102, 'available', 0)
+    ret = server.stats()
+    assert ret['followers'] == {'available': 2}
+    assert ret['cores'] == {'busy': 0, 'idle': 8}
+
+    lead = partial(leader_checkin, 'localhost', 1, 100, 5, 'pubkey')
+    assert lead('waiting', 0)['state'] == 'scheduled'
+    ret = server.stats()
+    assert ret['jobs'] == {'scheduled': 1}
+    assert ret['followers'] == {'assigned': 1, 'available': 1}
+    assert ret['cores'] == {'busy': 5, 'idle': 4}
+    assert ret['queue_wait']['n'] == 1
+
+    assert lead('exiting', 0, status=1)['state'] == 'exiting'
+    ret = server.stats()
+    assert ret['jobs_finished'] == 0 and ret['jobs_retried'] == 1, 'a failed attempt that is retried is not finished'
+    assert ret['failures'] == 1
+    assert 'status 1' in ret['recent_failures'][-1]
+
+    # the retry fails too, and is final
+    assert lead('waiting', 1)['state'] == 'scheduled'
+    assert lead('exiting', 1, status=1, job={'final': True})['state'] == 'exiting'
+    ret = server.stats()
+    assert (ret['jobs_finished'], ret['jobs_failed'], ret['jobs_retried']) == (1, 1, 1)
+
+    server.cache_lifetime = -1
+    try:
+        server.cache_timeout()
+    finally:
+        server.cache_lifetime = 30
+    ret = server.stats()
+    assert ret['jobs'] == {} and ret['followers'] == {}
+    assert ret['cores'] == {'busy': 0, 'idle': 0}
+    clear()
+
+
+def test_shared_followers():
+    clear()
+    info = {'shared': True, 'persistent': True}
+    f1 = partial(follower_checkin, 'host1', 16, 101)
+    assert not f1('available', 0, info=info)
+
+    a = partial(leader_checkin, 'localhost', 1, 100, 5, 'pubkey')
+    b = partial(leader_checkin, 'localhost', 1, 200, 7, 'pubkey')
+    ret = a('waiting', 0)
+    assert ret['followers'][0]['cores'] == 4, 'only the slots this leader wants'
+    assert ret['followers'][0]['slots'] == [0, 1, 2, 3]
+    ret = b('waiting', 0)
+    assert ret['followers'][0]['cores'] == 6, 'the same follower serves a second leader'
+    assert ret['followers'][0]['slots'] == [4, 5, 6, 7, 8, 9]
+    assert server.free_cores(server.followers['host1_101']) == 6
+
+    # the follower gets one schedule per checkin, and each job is running once it has
+    ret = f1('available', 0, info=info)
+    assert ret['leader'] == 'localhost_100' and 'pubkey' in ret
+    ret = f1('assigned', 0, info=info)
+    assert ret['leader'] == 'localhost_200'
+    assert a('waiting', 0)['state'] == 'running'
+    assert b('waiting', 0)['state'] == 'running'
+    assert server.stats()['cores'] == {'busy': 12, 'idle': 6}
+
+    assert a('exiting', 0)['state'] == 'exiting'
+    assert server.free_cores(server.followers['host1_101']) == 10
+    assert f1('assigned', 0, info=info) == {'state': 'assigned', 'jobs': ['localhost_200']}, 'still serving leader b'
+    assert leader_checkin('localhost', 1, 300, 5, 'pubkey', 'waiting', 0)['followers'][0]['slots'] == [0, 1, 2, 3]
+
+    assert f1('assigned', 0, info=info)['leader'] == 'localhost_300'
+    c = partial(leader_checkin, 'localhost', 1, 300, 5, 'pubkey')
+    assert c('waiting', 0)['state'] == 'running'
+    server.draining = True
+    assert not f1('assigned', 0, info=info), 'jobs finish before the follower exits'
+    assert b('exiting', 0)['state'] == 'exiting'
+    assert c('exiting', 0)['state'] == 'exiting'
+    assert f1('assigned', 0, info=info)['state'] == 'exiting'
+    clear()
+
+
+def test_shared_follower_reschedule():
+    clear()
+    info = {'shared': True, 'persistent': True}
+    shared = partial(follower_checkin, 'host1', 8, 101)
+    assert not shared('available', 0, info=info)
+    other = partial(leader_checkin, 'localhost', 1, 50, 5, 'pubkey')
+    assert other('waiting', 0)['followers'][0]['cores'] == 4
+    assert shared('available', 0, info=info)['leader'] == 'localhost_50'
+    assert other('waiting', 0)['state'] == 'running'
+
+    plain = partial(follower_checkin, 'host2', 2, 102)
+    assert not plain('available', 0)
+    l = partial(leader_checkin, 'localhost', 1, 100, 7, 'pubkey')
+    ret = l('waiting', 0)
+    assert [(f['fkey'], f['cores']) for f in ret['followers']] == [('host1_101', 4), ('host2_102', 2)]
+
+    # the shared follower has free cores again, when the plain one drops out and forces a reschedule
+    assert other('exiting', 0)['state'] == 'exiting'
+    assert not plain('available', 1)
+    ret = l('waiting', 0)
+    assert [(f['fkey'], f['cores']) for f in ret['followers']] == [('host1_101', 4), ('host2_102', 2)], \
+        'no second slice of the same shared follower'
+    assert server.followers['host1_101']['jobs']['localhost_100']['cores'] == 4
+
+    # a follower that timed out stays gone when its job releases it
+    del server.followers['host1_101']
+    server.release_slice('host1_101', 'localhost_100')
+    assert 'host1_101' not in server.followers
+    clear()
+
+
+def test_shared_followers_one_host():
+    clear()
+    info = {'shared': True, 'persistent': True,
+            'topology': {'numa': [[0, 1], [2, 3]], 'cpus': ['0', '1', '2', '3']}}
+    f1 = partial(follower_checkin, 'host1', 2, 101)
+    f2 = partial(follower_checkin, 'host1', 2, 102)
+    assert not f1('available', 0, info=info)
+    assert not f2('available', 0, info=info)
+
+    a = partial(leader_checkin, 'localhost', 1, 100, 3, 'pubkey')
+    ret = a('waiting', 0)
+    assert [(f['fkey'], f['slots']) for f in ret['followers']] == [('host1_101', ['0', '1'])]
+    b = partial(leader_checkin, 'localhost', 1, 200, 3, 'pubkey')
+    ret = b('waiting', 0)
+    assert [(f['fkey'], f['slots']) for f in ret['followers']] == [('host1_102', ['2', '3'])], \
+        'a second follower on the host gets the cores nobody is using'
+    assert server.free_cores(server.followers['host1_101']) == 0
+    assert not leader_checkin('localhost', 1, 300, 2, 'pubkey', 'waiting', 0), 'every core of the host is in use'
+
+    # hwthreads count as cores, as they do in the follower's ncores
+    clear()
+    smt = {'shared': True, 'persistent': True,
+           'topology': {'numa': [[0, 1, 2, 3]], 'slots': {'0': '0:0', '1': '0:1', '2': '0:0', '3': '0:1'},
+                        'cpus': ['0', '1', '2', '3']}}
+    assert not follower_checkin('host1', 4, 101, 'available', 0, info=smt)
+    ret = leader_checkin('localhost', 1, 100, 5, 'pubkey', 'waiting', 0)
+    assert [(f['fkey'], f['slots']) for f in ret['followers']] == [('host1_101', ['0', '1', '2', '3'])]
+    clear()
+
+
+def test_history_failure_releases_followers(monkeypatch):
+    clear()
+    assert not follower_checkin('host1', 1, 101, 'available', 0, info={'persistent': True})
+    lead = partial(leader_checkin, 'localhost', 1, 100, 2, 'pubkey')
+    job = {'run_args': './a.out'}
+    assert lead('waiting', 0, job=job)['state'] == 'scheduled'
+    follower_checkin('host1', 1, 101, 'available', 0)
+
+    def broken(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(server.history, 'record', broken)
+    assert lead('waiting', 0, job=job)['state'] == 'running'
+    assert lead('exiting', 0, job=dict(job, wall=3.0))['state'] == 'exiting'
+    assert server.followers['host1_101']['state'] == 'available'
+    clear()
+
+
+def test_pubkey_cleanup():
+    clear()
+    info = {'cleanup_pubkeys': True}
+    f1 = partial(follower_checkin, 'otherhost', 1, 101)
+    f2 = partial(follower_checkin, 'otherhost', 1, 102)
+    assert not f1('available', 0, info=info)
+    assert not f2('available', 0, info=info)
+    l = partial(leader_checkin, 'localhost', 1, 100, 3, 'pubkey')
+    assert len(l('waiting', 0, job={'fingerprint': 'SHA256:abc'})['followers']) == 2
+    assert f1('available', 0, info=info)['pubkey'] == 'pubkey'
+    assert 'pubkey' not in f2('available', 0, info=info)
+
+    # the other follower's job still needs the key
+    server.followers['otherhost_101']['state'] = 'exiting'
+    ret = f1('assigned', 0, info=info)
+    assert ret['cleanup'] and ret['keep_fingerprints'] == ['SHA256:abc']
+    assert 'SHA256:abc' in server.host_pubkeys['otherhost']
+
+    # the other follower exits, it did not deploy the key so has nothing to keep or remove
+    server.followers['otherhost_102']['state'] = 'exiting'
+    ret = f2('assigned', 0, info=info)
+    assert ret['cleanup'] and 'keep_fingerprints' not in ret, 'ordinary followers clean up too'
+    assert server.followers['otherhost_102']['fingerprint'] == 'SHA256:abc'
+    assert 'SHA256:abc' not in server.followers['otherhost_102'].get('deployed', set())
+    assert 'SHA256:abc' in server.host_pubkeys['otherhost'], 'still deployed by the first follower'
+
+    # now nobody needs it, and the first follower removes it at its next checkin
+    ret = f1('assigned', 0, info=info)
+    assert ret['cleanup'] and 'keep_fingerprints' not in ret
+    assert server.followers['otherhost_101']['deployed'] == set()
+    assert not server.host_pubkeys['otherhost'], 'the next follower on this host is sent the key again'
+    clear()
@@ -0,0 +1,106 @@
+import os
+import time
+import socket
+import fcntl
+
+import pytest
+
+from paramsurvey_multimpi import staging
+
+
+def make_input(path, size):
+    with open(path, 'w') as f:
+        f.write('x' * size)
+    return str(path)
+
+
+def test_stage(tmp_path):
+    a = make_input(tmp_path / 'a', 10)
+    b = make_input(tmp_path / 'b', 20)
+    cache = str(tmp_path / 'cache')
+
+    staged = staging.stage([a, b], staging_dir=cache, max_bytes=100)
+    assert sorted(os.listdir(staged)) == ['a', 'b']
+    with open(os.path.join(staged, 'b')) as f:
+        assert f.read() == 'x' * 20
+    assert staging.stage([a, b], staging_dir=cache, max_bytes=100) == staged
+    assert len(os.listdir(os.path.join(cache, 'objects'))) == 2, 'cached objects reused'
+
+    # a new generation of a is a new object
+    time.sleep(0.01)
+    make_input(tmp_path / 'a', 11)
+    staged = staging.stage([a, b], staging_dir=cache, max_bytes=100)
+    with open(os.path.join(staged, 'a')) as f:
+        assert f.read() == 'x' * 11
+    assert len(os.listdir(os.path.join(cache, 'objects'))) == 3
+
+    with pytest.raises(ValueError):
+        staging.stage([a, str(tmp_path / 'other' / 'a')], staging_dir=cache)
+    staging.release()
+
+
+def test_stage_lru(tmp_path):
+    cache = str(tmp_path / 'cache')
+    inputs = [make_input(tmp_path / name, 40) for name in ('a', 'b', 'c')]
+    objdir = os.path.join(cache, 'objects')
+
+    # each job releases its staged inputs when it is done
+    for job in (inputs[:1], inputs[1:2], inputs[:1]):  # a is now more recent than b
+        staging.stage(job, staging_dir=cache, max_bytes=100)
+        staging.release()
+        time.sleep(0.01)
+    staging.stage(inputs[2:], staging_dir=cache, max_bytes=100)
+
+    assert len(os.listdir(objdir)) == 2
+    keys = set(os.listdir(objdir))
+    assert staging.object_key(inputs[1], staging.object_generation(inputs[1])) not in keys, 'b was least recently used'
+    assert staging.object_key(inputs[0], staging.object_generation(inputs[0])) in keys
+
+    staging.release()
+    with pytest.raises(ValueError):
+        staging.stage(inputs, staging_dir=cache, max_bytes=100)
+    staging.release()
+
+
+def test_stage_in_use(tmp_path):
+    cache = str(tmp_path / 'cache')
+    a = make_input(tmp_path / 'a', 60)
+    b = make_input(tmp_path / 'b', 60)
+
+    staged_a = staging.stage([a], staging_dir=cache, max_bytes=100)
+    with pytest.raises(ValueError):
+        staging.stage([b], staging_dir=cache, max_bytes=100)
+    assert os.path.exists(os.path.join(staged_a, 'a')), 'objects of a staged directory in use are not evicted'
+
+    staging.release(staged_a)
+    staged_b = staging.stage([b], staging_dir=cache, max_bytes=100)
+    assert not os.path.exists(staged_a), 'staged directories nobody uses are removed'
+    assert os.listdir(os.path.join(cache, 'objects')) == [os.path.basename(os.readlink(os.path.join(staged_b, 'b')))]
+
+    # a lease left by a process that exited does not count
+    lease, = [lease for lease in staging.leases if os.path.basename(lease).startswith(os.path.basename(staged_b))]
+    staging.leases.discard(lease)
+    os.rename(lease, os.path.join(cache, 'leases', '{}.{}.{}'.format(os.path.basename(staged_b), socket.gethostname(), 2**22 + 1)))
+    staging.stage([a], staging_dir=cache, max_bytes=100)
+    assert not os.path.exists(staged_b)
+    staging.release()
+
+
+def test_stage_copies_unlocked(tmp_path, monkeypatch):
+    cache = str(tmp_path / 'cache')
+    a = make_input(tmp_path / 'a', 10)
+    copy_object = staging.copy_object
+
+    def copy_unlocked(src, dest):
+        # another process can take the lock while we copy
+        with open(os.path.join(cache, '.lock'), 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+        copy_object(src, dest)
+
+    monkeypatch.setattr(staging, 'copy_object', copy_unlocked)
+    staged = staging.stage([a], staging_dir=cache, max_bytes=100)
+    with open(os.path.join(staged, 'a')) as f:
+        assert f.read() == 'x' * 10
+    assert os.listdir(os.path.join(cache, 'staged')) == [os.path.basename(staged)], 'no temporary directories left'
+    staging.release()
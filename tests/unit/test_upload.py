@@ -0,0 +1,23 @@
+import os
+
+from paramsurvey_multimpi import upload
+
+
+def test_upload(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    with open('out1.dat', 'wb') as f:
+        f.write(os.urandom(1000))
+    with open('out2.dat', 'wb') as f:
+        f.write(b'')
+    dest = str(tmp_path / 'bucket')
+
+    future = upload.upload(['out*.dat', 'missing.log'], dest, part_size=64, workers=4)
+    assert sorted(os.path.basename(p) for p in future.result()) == ['out1.dat', 'out2.dat']
+    assert upload.wait() == []
+    for name in ('out1.dat', 'out2.dat'):
+        with open(name, 'rb') as f, open(os.path.join(dest, name), 'rb') as g:
+            assert f.read() == g.read()
+    assert sorted(os.listdir(dest)) == ['out1.dat', 'out2.dat'], 'no partial files left'
+
+    upload.upload(['out1.dat'], str(tmp_path / 'out1.dat' / 'notadir'))
+    assert len(upload.wait()) == 1